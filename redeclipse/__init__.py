@@ -3,9 +3,11 @@ import gzip
 import struct
 from collections import OrderedDict
 from redeclipse.enums import EntType, Faces, VTYPE, OCT, TextNum
-from redeclipse.objects import VSlot, SlotShaderParam, cube, SurfaceInfo
+from redeclipse.objects import VSlot, SlotShaderParam, cube, SurfaceInfo, MAXFACEVERTS, SOLID_EDGES, EMPTY, TEXCUBE_EXT
 from redeclipse.vector import FineVector
 from redeclipse.entities import Entity
+from redeclipse.pgzip import ParallelGzipFile
+from redeclipse.octree import OctreeStore, LazyCubes
 from tqdm import tqdm
 import simplejson as json
 import logging
@@ -13,6 +15,123 @@ log = logging.getLogger(__name__)
 __version__ = "0.6"
 MAXSTRLEN = 512
 
+# Precompiled structs for the fixed width fields and records of the map
+# format. Native byte order/alignment, same as the bare format strings.
+INT = struct.Struct('i')
+UCHAR = struct.Struct('B')
+USHORT = struct.Struct('H')
+FLOAT = struct.Struct('f')
+TEXTURE = struct.Struct('6H')
+EDGES = struct.Struct('12B')
+ENTBASE = struct.Struct('fffcccc')
+SURFHEADER = struct.Struct('BB')
+_STRUCTS = {}
+
+# Plain int copies of the OCT values, the enum lookups are far too slow to
+# do per octree node.
+OCTSAV_CHILDREN = OCT.OCTSAV_CHILDREN.value
+OCTSAV_EMPTY = OCT.OCTSAV_EMPTY.value
+OCTSAV_SOLID = OCT.OCTSAV_SOLID.value
+OCTSAV_NORMAL = OCT.OCTSAV_NORMAL.value
+OCTSAV_LODCUBE = OCT.OCTSAV_LODCUBE.value
+
+#: Sections of a map file, in the order they are stored, see MapParser.read
+SECTIONS = ('header', 'vars', 'texmru', 'ents', 'vslots', 'world')
+
+
+def get_struct(fmt):
+    """
+    Return a (cached) precompiled ``struct.Struct`` for a format string
+    """
+    try:
+        return _STRUCTS[fmt]
+    except KeyError:
+        _STRUCTS[fmt] = struct.Struct(fmt)
+        return _STRUCTS[fmt]
+
+
+# Format of the packed SurfaceInfo records (4 uchars each) for every surfmask
+SURFACE_FORMATS = ['%dB' % (4 * bin(mask).count('1')) for mask in range(64)]
+
+
+class BlockWriter(object):
+    """
+    Serialises fields into a growing ``bytearray`` with precompiled structs
+    (``pack_into``) and hands the data to the underlying (compressing)
+    handle in large blocks, rather than one tiny write per field.
+    """
+
+    def __init__(self, handle, block_size=1 << 20):
+        self.handle = handle
+        self.block_size = block_size
+        self.buf = bytearray(block_size + 4096)
+        self.pos = 0
+
+    def _grow(self, size):
+        self.buf.extend(bytes(max(size, len(self.buf)) - len(self.buf)))
+
+    def pack(self, s, *values):
+        """
+        Append ``values`` packed with the ``struct.Struct`` s
+        """
+        end = self.pos + s.size
+        if end > len(self.buf):
+            self._grow(end)
+        s.pack_into(self.buf, self.pos, *values)
+        self.pos = end
+        if end >= self.block_size:
+            self.flush()
+
+    def write(self, data):
+        """
+        Append raw bytes
+        """
+        end = self.pos + len(data)
+        if end > len(self.buf):
+            self._grow(end)
+        self.buf[self.pos:end] = data
+        self.pos = end
+        if end >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.pos:
+            self.handle.write(self.buf[:self.pos])
+            self.pos = 0
+
+
+# Encoded bytes of the canonical leaves, see leafkey()
+LEAF_CACHE = {}
+MAX_LEAF_CACHE = 4096
+TEXCUBE_OCTSAV = OCTSAV_NORMAL | 0x20
+# Packed surfaces of a textured cube, see cube.texturize
+TEXCUBE_SURFACES = (2, 0, 0, 32) * 6
+# Encoding of a node with children, and the cube used for empty subtrees
+CHILDREN_CUBE = UCHAR.pack(OCTSAV_CHILDREN)
+EMPTY_CUBE = EMPTY
+
+
+def leafkey(c):
+    """
+    Cache key for the encoding of leaves that only differ in their
+    textures, or None if the cube is not one of these canonical shapes:
+
+    - plain empty and solid leaves (``cube.newcube()``)
+    - textured solid leaves (``cube.newtexcube()``), octsav 35, surfmask 63
+      with six ``SurfaceInfo(2, 0, 0, 32)``
+    """
+    octsav = c.octsav
+    if octsav == OCTSAV_EMPTY or octsav == OCTSAV_SOLID:
+        return (octsav, tuple(c.texture))
+    if octsav != TEXCUBE_OCTSAV or c.surfmask != 63 or c.totalverts != 0:
+        return None
+    if tuple(c.edges) != SOLID_EDGES:
+        return None
+    for surf in c.ext.surfaces:
+        if surf.verts != 0 or surf.numverts != 32 or surf.lmid[0] != 2 or surf.lmid[1] != 0:
+            return None
+    return (octsav, tuple(c.texture))
+
 
 def tb(str_or_bytes):
     """
@@ -81,16 +200,78 @@ class Map:
         self.chg = chg
         self.world = worldroot
         self.cfg_extra = []
-
-    def write(self, path):
+        #: Sections that were parsed, the others are None
+        self.sections = SECTIONS
+        # Encoded vslots and world as they were parsed, see write() and
+        # MapParser.read(keep_world_bytes=)
+        self.world_bytes = None
+        self._parsed_world = worldroot
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if isinstance(self.world_bytes, memoryview):
+            # A view into the parser's buffer, cannot be pickled
+            state['world_bytes'] = self.world_bytes.tobytes()
+        return state
+
+    def write(self, path, compresslevel=9, threads=1, voxels=None, reuse_world=False, collapse=False):
         """
         Write map to disk
 
         :param path: Path to write to
         :type path: str
+
+        :param compresslevel: gzip compression level, 1 is fastest, 9
+                              produces the smallest files.
+        :type compresslevel: int
+
+        :param threads: Compress blocks of the map in parallel on this many
+                        threads, see :mod:`redeclipse.pgzip`.
+        :type threads: int
+
+        :param voxels: Write this world as the octree instead of
+                       ``self.world``. It is streamed straight to disk
+                       without building any cubes, the result is the same
+                       as writing ``voxels.to_octree()`` with the first
+                       root cube's octsav set to 0.
+        :type voxels: redeclipse.voxel.VoxelWorld
+
+        :param collapse: Merge uniform octants of ``voxels`` into larger
+                         cubes, see ``VoxelWorld.to_octree``
+        :type collapse: bool
+
+        :param reuse_world: Write the vslots and world exactly as they were
+                            parsed (``world_bytes``) instead of encoding
+                            them again, for maps where only the header,
+                            vars, texmru or entities were changed. The map
+                            has to be read with ``keep_world_bytes``, which
+                            is the default for ``lazy=True``. Cheapest with
+                            a lazy map, as then the world is never decoded
+                            at all.
+        :type reuse_world: bool
         """
+        missing = [name for name in SECTIONS[:-1] if name not in self.sections]
+        if voxels is None and not reuse_world and 'world' not in self.sections:
+            missing.append('world')
+        if missing:
+            raise ValueError("Map was read without the %s section(s), cannot write it" % ', '.join(missing))
+        if reuse_world:
+            if self.world_bytes is None:
+                raise ValueError("Map was not read with keep_world_bytes, no world to reuse")
+            if voxels is not None or self.world is not self._parsed_world:
+                raise ValueError("World was replaced, cannot reuse the parsed one")
+
         log.info('WRITING')
-        handle = gzip.open(path, 'wb')
+        if threads > 1:
+            gz = ParallelGzipFile(path, compresslevel=compresslevel, threads=threads)
+        else:
+            gz = gzip.open(path, 'wb', compresslevel=compresslevel)
+        with gz:
+            handle = BlockWriter(gz)
+            self._write_map(handle, voxels, reuse_world, collapse)
+            handle.flush()
+
+    def _write_map(self, handle, voxels=None, reuse_world=False, collapse=False):
         self._write_str(handle, tb(self.magic), null=False)
         # Write the version
         self._write_int(handle, self.version)
@@ -134,11 +315,22 @@ class Map:
         # Entities
         self._write_ents(handle, self.ents)
 
+        if reuse_world:
+            handle.write(self.world_bytes)
+            return
+
         # sys.exit()
         # Textures
         self.__write_vslots(handle, self.vslots, self.chg)
 
         # World
+        if voxels is not None:
+            self._savevoxels(handle, voxels, collapse)
+            return
+        if isinstance(self.world, OctreeStore):
+            self.world.write(handle)
+            return
+
         self.pbar_0 = tqdm(total=8)
         # self.pbar_1 = tqdm(total=8)
         self._savechildren(handle, self.world)
@@ -146,44 +338,39 @@ class Map:
         # self.pbar_1.close()
 
     def _write_custom(self, handle, fmt, data):
-        handle.write(struct.pack(fmt, *data))
+        handle.pack(get_struct(fmt), *data)
 
     def _write_char(self, handle, char):
-        handle.write(struct.pack('B', char))
+        handle.pack(UCHAR, char)
 
     def _write_int_as_chr(self, handle, data):
-        handle.write(struct.pack('c', str.encode(chr(data))))
+        handle.pack(UCHAR, data)
 
     def _write_int(self, handle, value):
         if isinstance(value, int):
-            handle.write(struct.pack('i', value))
+            handle.pack(INT, value)
         elif isinstance(value, float):
-            handle.write(struct.pack('i', int(value)))
+            handle.pack(INT, int(value))
         else:
-            handle.write(struct.pack('i', value.value))
+            handle.pack(INT, value.value)
 
     def _write_ushort(self, handle, value):
-        handle.write(struct.pack('H', value))
+        handle.pack(USHORT, value)
 
     def _write_float(self, handle, value):
-        handle.write(struct.pack('f', value))
+        handle.pack(FLOAT, value)
 
     def _write_str(self, handle, value, null=True):
         strlen = len(value)
         if null:
             strlen += 1
 
-        fmt = '%ds' % strlen
-        handle.write(struct.pack(fmt, value))
+        handle.pack(get_struct('%ds' % strlen), value)
 
     def _write_ents(self, handle, ents):
         for ent in ents:
             # (x, y, z, etype, a, b, c) = self._read_custom('fffcccc', sizeof_entbase)
-            self._write_custom(
-                handle,
-                'fffcccc',
-                ent.serialize()
-            )
+            handle.pack(ENTBASE, *ent.serialize())
 
             self._write_int(handle, len(ent.attrs))
             for at in ent.attrs:
@@ -205,29 +392,90 @@ class Map:
         pass
 
     def _savechildren(self, handle, cube_arr, indent=0):
-        if cube_arr:
-            for i, c in enumerate(cube_arr):
-                # TODO: Progress
-                if indent == 0:
-                    self.pbar_0.update(i)
-                # elif indent == 1:
-                    # self.pbar_1.update(i)
-                self._savec(handle, c, indent=indent)
+        """
+        Write a children array and everything below it. The octree is
+        walked with an explicit stack of (array, child index, depth) rather
+        than recursing per level.
+        """
+        stack = [(cube_arr, 0, indent)]
+        while stack:
+            cube_arr, i, indent = stack.pop()
+            if i == 0:
+                if isinstance(cube_arr, LazyChildren) and not cube_arr.loaded:
+                    # Never touched, the original bytes are still valid.
+                    handle.write(cube_arr.raw())
+                    continue
+                if isinstance(cube_arr, LazyCubes) and not cube_arr.loaded:
+                    # Same for cubes still in their store
+                    cube_arr.store.write(handle, cube_arr.first)
+                    continue
+                if not cube_arr:
+                    continue
+
+            c = cube_arr[i]
+            # TODO: Progress
+            if indent == 0:
+                self.pbar_0.update(i)
+            # elif indent == 1:
+                # self.pbar_1.update(i)
+            if i + 1 < len(cube_arr):
+                stack.append((cube_arr, i + 1, indent))
+
+            self._savecube(handle, c)
+            if c.octsav & 0x7 == OCTSAV_CHILDREN:
+                stack.append((c.children, 0, indent + 1))
+
+    def _savevoxels(self, handle, voxels, collapse=False):
+        """Write a VoxelWorld as the octree, see VoxelWorld.octree_walk"""
+        walk = voxels.octree_walk(collapse=collapse)
+        # The first root cube is always marked as having children, even if
+        # it is empty (then nothing follows).
+        next(walk)
+        handle.write(CHILDREN_CUBE)
+        for item in walk:
+            if item is OCT.OCTSAV_CHILDREN:
+                handle.write(CHILDREN_CUBE)
+            elif item is None:
+                self._savecube(handle, EMPTY_CUBE)
+            else:
+                self._savecube(handle, item)
 
     def _savec(self, handle, c, indent=0):
         """Inverse of _loadc"""
-
-        self._write_int_as_chr(handle, c.octsav)
-        if c.octsav & 0x7 == OCT.OCTSAV_CHILDREN.value:
+        self._savecube(handle, c)
+        if c.octsav & 0x7 == OCTSAV_CHILDREN:
             self._savechildren(handle, c.children, indent=indent + 1)
+
+    def _savecube(self, handle, c):
+        """Write a single cube, without its children"""
+        key = leafkey(c)
+        if key is None:
+            self._encodecube(handle, c)
             return
-        elif c.octsav & 0x7 == OCT.OCTSAV_EMPTY.value:
+
+        try:
+            data = LEAF_CACHE[key]
+        except KeyError:
+            scratch = BlockWriter(None)
+            self._encodecube(scratch, c)
+            data = bytes(scratch.buf[:scratch.pos])
+            if len(LEAF_CACHE) >= MAX_LEAF_CACHE:
+                LEAF_CACHE.clear()
+            LEAF_CACHE[key] = data
+        handle.write(data)
+
+    def _encodecube(self, handle, c):
+        self._write_int_as_chr(handle, c.octsav)
+        kind = c.octsav & 0x7
+        if kind == OCTSAV_CHILDREN:
+            return  # Children are written by the caller
+        elif kind == OCTSAV_EMPTY:
             pass  # Nothing to write
-        elif c.octsav & 0x7 == OCT.OCTSAV_SOLID.value:
+        elif kind == OCTSAV_SOLID:
             pass  # Nothing to write, simply that c is solid
-        elif c.octsav & 0x7 == OCT.OCTSAV_NORMAL.value:
-            self._write_custom(handle, 'BBBBBBBBBBBB', c.edges)
-        elif c.octsav & 0x7 == OCT.OCTSAV_LODCUBE.value:
+        elif kind == OCTSAV_NORMAL:
+            handle.pack(EDGES, *c.edges)
+        elif kind == OCTSAV_LODCUBE:
             # Nothing to do, this just set c.children, which we know
             # from other sources.
             pass
@@ -235,36 +483,32 @@ class Map:
             sys.exit(42)
             return
 
-        for i, t in enumerate(c.texture):
-            if isinstance(t, TextNum):
-                self._write_ushort(handle, t.value)
-            else:
-                self._write_ushort(handle, t)
+        handle.pack(TEXTURE, *[t.value if isinstance(t, TextNum) else t for t in c.texture])
 
         if c.octsav & 0x40:
             self._write_ushort(handle, c.material)
         if c.octsav & 0x80:
             self._write_int_as_chr(handle, c.merged)
         if c.octsav & 0x20:
-            self._write_int_as_chr(handle, c.surfmask)
-            self._write_int_as_chr(handle, c.totalverts)
+            handle.pack(SURFHEADER, c.surfmask, c.totalverts)
 
+            surfaces = []
             for i in range(6):
                 if not c.surfmask & (1 << i):
                     pass
                 else:
                     surfinfo = c.ext.surfaces[i]
-
-                    self._write_char(handle, surfinfo.lmid[0])
-                    self._write_char(handle, surfinfo.lmid[1])
-                    self._write_char(handle, surfinfo.verts)
-                    self._write_char(handle, surfinfo.numverts)
+                    surfaces.extend(surfinfo.lmid)
+                    surfaces.append(surfinfo.verts)
+                    surfaces.append(surfinfo.numverts)
 
                     if surfinfo.verts == 0:
                         continue
                     else:
                         raise NotImplementedError("Gross out")
 
+            handle.pack(get_struct(SURFACE_FORMATS[c.surfmask & 0x3F]), *surfaces)
+
     def to_dict(self):
         """
         return represnetation of map as dictionary
@@ -331,43 +575,199 @@ class Map:
         self.meta['skybox'] = sb.get_short_path()
 
 
+class LazyChildren(object):
+    """
+    The 8 children of a cube in a lazily parsed map. The cubes are only
+    decoded (from the skip index built by the parser) on first access,
+    their own children are again lazy.
+
+    Behaves like the plain list of 8 cubes it stands in for.
+    """
+
+    def __init__(self, parser, offset, size):
+        self.parser = parser
+        self.offset = offset
+        self.size = size
+        self.cubes = None
+
+    @property
+    def loaded(self):
+        return self.cubes is not None
+
+    def load(self):
+        """
+        Decode the children, returns the list of cubes
+        """
+        if self.cubes is None:
+            self.cubes = self.parser._loadlazy(self.offset, self.size)
+        return self.cubes
+
+    def raw(self):
+        """
+        The original encoded bytes of this subtree
+        """
+        end = self.parser.skip_index[self.offset][1]
+        return self.parser.bytes[self.offset:end]
+
+    def __len__(self):
+        return 8
+
+    def __bool__(self):
+        return True
+
+    def __getitem__(self, i):
+        return self.load()[i]
+
+    def __setitem__(self, i, value):
+        self.load()[i] = value
+
+    def __iter__(self):
+        return iter(self.load())
+
+
 class MapParser(object):
+    """
+    Decodes a gzipped map file into a :class:`Map`.
+
+    The decompressed map is wrapped in a ``memoryview`` and every field is
+    decoded in place with precompiled structs (``unpack_from``), so no
+    intermediate bytes objects are created per field.
+
+    In streaming mode only a small window of the decompressed data is held
+    at any time, it is refilled from the gzip stream as the parser advances.
+
+    In lazy mode the octree is only scanned once to build ``skip_index``, a
+    mapping from the offset of every children array to the offsets of its
+    8 cubes and the end of the array. Children are then decoded on demand,
+    see :class:`LazyChildren`.
+    """
+
+    #: Size of the decompressed chunks pulled in by a streaming read
+    window_size = 1 << 16
+
+    def _refill(self, width):
+        """
+        Make sure ``width`` bytes are available at ``self.index``. Consumed
+        data is dropped from the window before new data is appended.
+        """
+        if self._handle is None:
+            raise EOFError("Unexpected end of map data")
+
+        if self._capture is not None:
+            self._capture += self.bytes[self._capture_start:self.index]
+            self._capture_start = 0
+        del self.bytes[:self.index]
+        self.offset += self.index
+        self.index = 0
+        while len(self.bytes) < width:
+            chunk = self._handle.read(max(self.window_size, width))
+            if not chunk:
+                raise EOFError("Unexpected end of map data")
+            self.bytes += chunk
+        self.end = len(self.bytes)
+
+    def tell(self):
+        """
+        Absolute position in the decompressed map data
+        """
+        return self.offset + self.index
+
+    def _begin_capture(self):
+        """
+        Start recording the raw bytes read from here on, see _end_capture.
+        Only when the map is read with ``keep_world_bytes``.
+        """
+        if not self.keep_world_bytes:
+            return
+        self._capture = bytearray() if self._handle is not None else None
+        self._capture_start = self.index
 
-    def __read_custom(self, pattern, width):
-        val = struct.unpack(pattern, self.bytes[self.index:self.index + width])
-        self.index += width
+    def _end_capture(self):
+        """
+        Stop recording and return the raw bytes read since _begin_capture,
+        None if nothing was recorded
+        """
+        if not self.keep_world_bytes:
+            return None
+        if self._capture is not None:
+            data = bytes(self._capture + self.bytes[self._capture_start:self.index])
+            self._capture = None
+            return data
+        if self.lazy:
+            # The whole map is kept for the lazy cubes anyway, no need to
+            # copy.
+            return self.bytes[self._capture_start:self.index]
+        # Only keep the world, not the whole decompressed map
+        return self.bytes[self._capture_start:self.index].tobytes()
+
+    def _read_custom(self, pattern):
+        s = get_struct(pattern)
+        if self.index + s.size > self.end:
+            self._refill(s.size)
+        val = s.unpack_from(self.bytes, self.index)
+        self.index += s.size
         return val
 
     def _read_int(self):
-        val = self._read_custom('i', 4)[0]
+        if self.index + 4 > self.end:
+            self._refill(4)
+        val = INT.unpack_from(self.bytes, self.index)[0]
+        self.index += 4
         return val
 
     def _read_char(self):
-        val = self._read_custom('B', 1)[0]
-        return val
-
-    def _read_custom(self, pattern, width):
-        val = self.__read_custom(pattern, width)
+        if self.index >= self.end:
+            self._refill(1)
+        val = self.bytes[self.index]
+        self.index += 1
         return val
 
     def _read_float(self):
-        val = self._read_custom('f', 4)[0]
+        if self.index + 4 > self.end:
+            self._refill(4)
+        val = FLOAT.unpack_from(self.bytes, self.index)[0]
+        self.index += 4
         return val
 
     def _read_ushort(self):
-        val = self._read_custom('H', 2)[0]
+        if self.index + 2 > self.end:
+            self._refill(2)
+        val = USHORT.unpack_from(self.bytes, self.index)[0]
+        self.index += 2
+        return val
+
+    def _read_texture(self):
+        if self.index + 12 > self.end:
+            self._refill(12)
+        val = TEXTURE.unpack_from(self.bytes, self.index)
+        self.index += 12
+        return val
+
+    def _read_edges(self):
+        if self.index + 12 > self.end:
+            self._refill(12)
+        val = EDGES.unpack_from(self.bytes, self.index)
+        self.index += 12
+        return val
+
+    def _read_entbase(self):
+        if self.index + 16 > self.end:
+            self._refill(16)
+        val = ENTBASE.unpack_from(self.bytes, self.index)
+        self.index += 16
         return val
 
     def _read_str(self, strlen, null=True):
         if null:
             # Strings are null terminated
             strlen += 1
-        fmt = '%ds' % strlen
-        data = struct.unpack(fmt, self.bytes[self.index:self.index + strlen])
+        if self.index + strlen > self.end:
+            self._refill(strlen)
+        data = bytes(self.bytes[self.index:self.index + strlen])
         self.index += strlen
         if null:
-            return data[0][0:-1]
-        return data[0]
+            return data[0:-1]
+        return data
 
     def _loadvslots(self, numvslots):
         prev = [-1] * numvslots
@@ -447,43 +847,126 @@ class MapParser(object):
             vs.coastscale = self._read_float()
 
     def _loadchildren(self, size, failed, indent=0):
+        """
+        Decode a children array and everything below it. The octree is
+        walked with an explicit stack of (array, child index, size) rather
+        than recursing per level.
+        """
         cube_arr = cube.newcubes(Faces.F_EMPTY, 0)
-        for i in range(8):
-            failed, c_x = self._loadc(
-                cube_arr[i],  # c
-                size,
-                failed,
-                indent=indent
-            )
-            cube_arr[i] = c_x
+        stack = [(cube_arr, 0, size)]
+        while stack:
+            arr, i, size = stack.pop()
+            c = arr[i]
+            if self._loadcube(c):
+                # Rest of this array is left empty
+                continue
+            if i < 7:
+                stack.append((arr, i + 1, size))
+            if c.octsav & 0x7 == OCTSAV_CHILDREN:
+                c.children = cube.newcubes(Faces.F_EMPTY, 0)
+                stack.append((c.children, 0, size >> 1))
+        return cube_arr
 
+    def _loadlazy(self, offset, size):
+        """Decode a single children array of a lazily parsed map"""
+        offsets = self.skip_index[offset][0]
+        index = self.index
+        cube_arr = cube.newcubes(Faces.F_EMPTY, 0)
+        failed = False
+        for i, child in enumerate(offsets):
+            self.index = child
+            failed, cube_arr[i] = self._loadc(cube_arr[i], size, failed)
             if failed:
                 break
+        self.index = index
+
+        cube.validatec(cube_arr, size, recursive=False)
         return cube_arr
 
+    def _indexchildren(self, offset):
+        """
+        Walk a children array without decoding it, recording the offset of
+        each cube in ``skip_index``. Returns the offset past the array.
+        """
+        buf = self.bytes
+        skip_index = self.skip_index
+        # Frames of [array start, cube offsets, done]
+        stack = [[offset, [], False]]
+        while stack:
+            frame = stack[-1]
+            offsets = frame[1]
+            if frame[2] or len(offsets) == 8:
+                skip_index[frame[0]] = (offsets, offset)
+                stack.pop()
+                continue
+
+            offsets.append(offset)
+            octsav = buf[offset]
+            offset += 1
+            kind = octsav & 0x7
+            if kind == OCTSAV_CHILDREN:
+                stack.append([offset, [], False])
+                continue
+            elif kind == OCTSAV_NORMAL:
+                offset += 12
+            elif kind not in (OCTSAV_EMPTY, OCTSAV_SOLID, OCTSAV_LODCUBE):
+                # Same as _loadchildren, the rest of this array is skipped
+                frame[2] = True
+                continue
+
+            # Textures
+            offset += 12
+            if octsav & 0x40:
+                offset += 2
+            if octsav & 0x80:
+                offset += 1
+            if octsav & 0x20:
+                surfmask = buf[offset]
+                offset += 2
+                for j in range(6):
+                    if surfmask & (1 << j):
+                        if buf[offset + 3] & MAXFACEVERTS:
+                            raise NotImplementedError("Gross in")
+                        offset += 4
+
+        return offset
+
     def _loadc(self, c, size, failed, indent=0):
         """Loads a single cube? Or rather, based on C, processes it into a cube object?"""
+        if self._loadcube(c):
+            return True, c
+        if c.octsav & 0x7 == OCTSAV_CHILDREN:
+            if self.lazy:
+                c.children = LazyChildren(self, self.tell(), size >> 1)
+            else:
+                c.children = self._loadchildren(size >> 1, failed, indent=indent + 1)
+        return failed, c
+
+    def _loadcube(self, c):
+        """
+        Decode a single cube, leaving its children (if any) to the caller.
+        Returns True if the cube could not be decoded.
+        """
         octsav = self._read_char()
         c.octsav = octsav
         c.haschildren = False
-        if octsav & 0x7 == OCT.OCTSAV_CHILDREN.value:
-            c.children = self._loadchildren(size >> 1, failed, indent=indent + 1)
-            return False, c
-        elif octsav & 0x7 == OCT.OCTSAV_EMPTY.value:
+        kind = octsav & 0x7
+        if kind == OCTSAV_CHILDREN:
+            return False
+        elif kind == OCTSAV_EMPTY:
             c.setfaces(Faces.F_EMPTY)
-        elif octsav & 0x7 == OCT.OCTSAV_SOLID.value:
+        elif kind == OCTSAV_SOLID:
             c.setfaces(Faces.F_SOLID)
-        elif octsav & 0x7 == OCT.OCTSAV_NORMAL.value:
-            c.edges = self._read_custom('BBBBBBBBBBBB', 12)
-        elif octsav & 0x7 == OCT.OCTSAV_LODCUBE.value:
+        elif kind == OCTSAV_NORMAL:
+            c.edges = self._read_edges()
+        elif kind == OCTSAV_LODCUBE:
             c.haschildren = True
         else:
-            failed = True
-            return failed, c
+            return True
 
-        c.texture = []
-        for i in range(6):
-            c.texture.append(self._read_ushort())
+        texture = self._read_texture()
+        # Few distinct ones, share them
+        c.texture = self._textures.setdefault(texture, texture)
 
         if octsav & 0x40:
             c.material = self._read_ushort()
@@ -494,22 +977,25 @@ class MapParser(object):
             c.surfmask = surfmask
             totalverts = self._read_char()
             c.totalverts = totalverts
+            # All present surfaces are stored back to back, decode them in
+            # one go.
+            packed = self._read_custom(SURFACE_FORMATS[surfmask & 0x3F])
+            if packed == TEXCUBE_SURFACES and totalverts == 0:
+                # Same as every cube.newtexcube, share their surfaces
+                c.ext = TEXCUBE_EXT
+                return False
             c.newcubeext(totalverts, False)
+            surfaces = c.ext.surfaces
+            j = 0
             # offset = 0
             for i in range(6):
                 if not surfmask & (1 << i):
-                    c.ext.surfaces.append(None)
+                    surfaces.append(None)
                 else:
-                    c.ext.surfaces.append(
-                        SurfaceInfo(
-                            self._read_char(),
-                            self._read_char(),
-                            self._read_char(),
-                            self._read_char()
-                        )
-                    )
-
-                    surf = c.ext.surfaces[i]
+                    surf = SurfaceInfo(packed[j], packed[j + 1], packed[j + 2], packed[j + 3])
+                    surfaces.append(surf)
+                    j += 4
+
                     # vertmask = surf.verts
                     numverts = surf.totalverts()
                     if not numverts:
@@ -518,13 +1004,12 @@ class MapParser(object):
 
                     raise NotImplementedError("Gross in")
 
-        return failed, c
+        return False
 
     def _loadents(self, numents):
-        sizeof_entbase = 16
         ents = []
         for i in range(int(numents)):
-            (x, y, z, etype, a, b, c) = self._read_custom('fffcccc', sizeof_entbase)
+            (x, y, z, etype, a, b, c) = self._read_entbase()
 
             # This says reserved but we've seen values in it so...
             reserved = [
@@ -547,24 +1032,120 @@ class MapParser(object):
             ents.append(e)
         return ents
 
-    def read(self, base_path):
+    def read(self, base_path, streaming=False, lazy=False, sections=None, arrays=False, keep_world_bytes=None):
         """
         Parse a map into a ``redeclipse.Map`` object
 
         :param base_path: path to gzipped map file.
         :type base_path: str
+
+        :param streaming: Decompress the map incrementally through a window
+                          of ``window_size`` bytes rather than reading all
+                          of it into memory first.
+        :type streaming: bool
+
+        :param lazy: Only index the octree, cubes are decoded when they are
+                     accessed. The decompressed map is kept in memory for
+                     as long as the map is.
+        :type lazy: bool
+
+        :param sections: Only parse up to and including the last of these
+                         sections (names from ``SECTIONS``). Decompression
+                         stops there, the sections after it are left as
+                         ``None`` on the map. Everything before the last
+                         requested section has to be walked anyway and is
+                         decoded as well. E.g. ``SECTIONS[:-1]`` loads a
+                         template without its world, which is enough to
+                         write it with a new ``voxels`` world.
+        :type sections: list(str)
+
+        :param arrays: Decode the octree into an
+                       :class:`redeclipse.octree.OctreeStore` rather than
+                       cube objects, a fraction of the memory for big maps.
+        :type arrays: bool
+
+        :param keep_world_bytes: Keep the encoded vslots and world on the
+                                 map as ``world_bytes``, for
+                                 ``Map.write(reuse_world=True)``. Defaults
+                                 to ``lazy``, where they are a view of the
+                                 data kept anyway. Otherwise they are a copy
+                                 of most of the decompressed map, which
+                                 streaming then has to collect as well.
+        :type keep_world_bytes: bool
         """
+        if streaming and (lazy or arrays):
+            raise ValueError("Lazy and array loading need the whole map in memory, cannot stream")
+        if lazy and arrays:
+            raise ValueError("Cannot load lazily into arrays")
+
+        self.last_section = len(SECTIONS) - 1
+        if sections is not None:
+            unknown = set(sections) - set(SECTIONS)
+            if unknown:
+                raise ValueError("Unknown map sections: %s" % ', '.join(sorted(unknown)))
+            if not sections:
+                raise ValueError("No map sections requested")
+            self.last_section = max(SECTIONS.index(name) for name in sections)
+            if self.last_section < SECTIONS.index('world'):
+                # Only decompress as much as needed
+                streaming = True
+                lazy = False
+
         self.base_path = base_path
         self.index = 0
-
-        with gzip.open(base_path) as handle:
-            self.bytes = handle.read()
-
+        self.offset = 0
+        self.lazy = lazy
+        self.arrays = arrays
+        self.keep_world_bytes = lazy if keep_world_bytes is None else keep_world_bytes
+        self.skip_index = {}
+        self._capture = None
+        self._textures = {}
+
+        if streaming:
+            self._handle = gzip.open(base_path)
+            self.bytes = bytearray()
+        else:
+            self._handle = None
+            with gzip.open(base_path) as handle:
+                self.bytes = memoryview(handle.read())
+        self.end = len(self.bytes)
+
+        try:
+            return self._read_map()
+        finally:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+            elif not self.lazy:
+                # The cubes are decoded, the buffer is no longer needed
+                self.bytes = memoryview(b'')
+                self.end = 0
+
+    def _attach(self, data, skip_index):
+        """
+        Set up for lazily decoding already decompressed and indexed map
+        data, see :mod:`redeclipse.cache`
+        """
+        self.base_path = None
+        self.bytes = data
+        self.end = len(data)
+        self.index = 0
+        self.offset = 0
+        self.lazy = True
+        self.arrays = False
+        self.keep_world_bytes = True
+        self.skip_index = skip_index
+        self.last_section = len(SECTIONS) - 1
+        self._handle = None
+        self._capture = None
+        self._textures = {}
+
+    def _read_map(self):
         magic = self._read_str(4, null=False)
         if magic not in (b'MAPZ', b'BFGZ'):
             raise Exception("Not a mapz file")
 
-        log.debug('Loading map: %s', base_path)
+        log.debug('Loading map: %s', self.base_path)
         log.debug('Header Magic: %s', magic)
         version = self._read_int()
         log.debug('Version: %s', version)
@@ -585,6 +1166,9 @@ class MapParser(object):
         log.debug(meta)
         log.debug('Header Worldsize: %s', meta['worldsize'])
 
+        if self.last_section < 1:
+            return self._partial_map(magic, version, headersize, meta)
+
         map_vars = OrderedDict()
         for i in range(meta['numvars']):
             # +1 for null term string
@@ -606,31 +1190,57 @@ class MapParser(object):
 
             map_vars[var_name] = var_val
 
+        if self.last_section < 2:
+            return self._partial_map(magic, version, headersize, meta, map_vars)
+
         texmru = []
         nummru = self._read_ushort()
         log.debug('Nummru %s', nummru)
         for i in range(nummru):
             texmru.append(self._read_ushort())
 
+        if self.last_section < 3:
+            return self._partial_map(magic, version, headersize, meta, map_vars, texmru)
+
         # Entities
         log.debug('Header.numents %s', meta['numents'])
         ents = self._loadents(meta['numents'])
         log.debug("Loaded %s entities", len(ents))
+        if self.last_section < 4:
+            return self._partial_map(magic, version, headersize, meta, map_vars, texmru, ents)
 
         # Textures?
+        self._begin_capture()
         vslots, chg = self._loadvslots(meta['numvslots'])
         log.debug("Loaded %s vslots", len(vslots))
+        if self.last_section < 5:
+            self._capture = None
+            return self._partial_map(magic, version, headersize, meta, map_vars, texmru, ents, vslots, chg)
 
         # arggghhh
         worldroot = []
         failed = False
-        log.debug("_loadchildren")
-        worldroot = self._loadchildren(
-            meta['worldsize'] >> 1,
-            failed
-        )
+        if self.lazy:
+            log.debug("_indexchildren")
+            start = self.index
+            try:
+                self.index = self._indexchildren(start)
+            except IndexError:
+                raise EOFError("Unexpected end of map data")
+            worldroot = LazyChildren(self, start, meta['worldsize'] >> 1)
+        elif self.arrays:
+            log.debug("OctreeStore.decode")
+            worldroot, self.index = OctreeStore.decode(self.bytes, self.index)
+            worldroot.validate(meta['worldsize'] >> 1)
+        else:
+            log.debug("_loadchildren")
+            worldroot = self._loadchildren(
+                meta['worldsize'] >> 1,
+                failed
+            )
 
-        cube.validatec(worldroot, meta['worldsize'] >> 1)
+            cube.validatec(worldroot, meta['worldsize'] >> 1)
+        world_bytes = self._end_capture()
 
         worldscale = 0
         while 1 << worldscale < meta['worldsize']:
@@ -646,4 +1256,11 @@ class MapParser(object):
 
         m = Map(magic, version, headersize, meta, map_vars, texmru, ents, vslots, chg,
                 worldroot)
+        m.world_bytes = world_bytes
+        return m
+
+    def _partial_map(self, magic, version, headersize, meta, map_vars=None, texmru=None, ents=None, vslots=None, chg=None):
+        """Map of the sections read so far, see the ``sections`` of read()"""
+        m = Map(magic, version, headersize, meta, map_vars, texmru, ents, vslots, chg, None)
+        m.sections = SECTIONS[:self.last_section + 1]
         return m
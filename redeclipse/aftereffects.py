@@ -1,11 +1,17 @@
 import random
 from tqdm import tqdm
-import math
+import numpy as np
 from redeclipse.objects import cube
 from redeclipse.prefabs.construction_kit import cube_points
 import logging
 log = logging.getLogger(__name__)
 
+#: Number of z levels processed at once
+SLAB = 16
+
+# The position functions below take single coordinates or NumPy arrays of
+# them, the effects evaluate them on whole slabs of the world at once.
+
 
 def vertical_gradient(x, y, z, slope=256):
     """
@@ -39,7 +45,7 @@ def gradient3(x, y, z):
     :returns: a float for that specific point.
     :rtype: float
     """
-    return 2 - (2 / (1 + math.pow(1.001, - z)))
+    return 2 - (2 / (1 + 1.001 ** -z))
 
 
 def vertical_gradient2(x, y, z):
@@ -57,6 +63,8 @@ def vertical_gradient2(x, y, z):
     :rtype: float
     """
     result = 1.004742 - 0.0002448721 * z - 0.00001396083 * z * z
+    if isinstance(result, np.ndarray):
+        return np.clip(result, 0, 1)
     if result < 0:
         result = 0
     if result > 1:
@@ -81,6 +89,76 @@ def vertical_gradient2inv(x, y, z):
     return 1 - vertical_gradient2(x, y, z)
 
 
+def _slabs(world, depth):
+    """
+    Yield (z0, z1, x, y, z) for the slabs of the world's columns up to
+    depth, x, y and z being the coordinates of their cells as arrays that
+    broadcast to shape (world.size, world.size, z1 - z0), indexed [x, y, z]
+    """
+    x = np.arange(world.size).reshape(-1, 1, 1)
+    y = np.arange(world.size).reshape(1, -1, 1)
+    for z0 in tqdm(range(0, depth, SLAB)):
+        z1 = min(z0 + SLAB, depth)
+        yield z0, z1, x, y, np.arange(z0, z1).reshape(1, 1, -1)
+
+
+def _evaluate(position_function, x, y, z):
+    """The position function on every cell of a slab"""
+    shape = np.broadcast(x, y, z).shape
+    try:
+        return np.broadcast_to(np.asarray(position_function(x, y, z), dtype=float), shape)
+    except (TypeError, ValueError):
+        # Only takes single coordinates
+        return np.vectorize(position_function, otypes=[float])(x, y, z)
+
+
+def _random_state():
+    """A NumPy RandomState continuing from where ``random`` is"""
+    (version, internal, gauss) = random.getstate()
+    state = np.random.RandomState()
+    state.set_state(('MT19937', np.array(internal[:-1], dtype=np.uint32), internal[-1]))
+    return state
+
+
+def _continue_random(state):
+    """Continue ``random`` from where the RandomState is"""
+    (version, internal, gauss) = random.getstate()
+    (name, key, pos) = state.get_state()[:3]
+    random.setstate((version, tuple(key.tolist()) + (int(pos), ), gauss))
+
+
+def _random(state, shape):
+    """
+    ``random.random()`` for each cell of a slab of the given shape [x, y,
+    z], drawn in the order of the loops z, x, y
+    """
+    return state.random_sample((shape[2], shape[0], shape[1])).transpose(1, 2, 0)
+
+
+def _vacant(world, lower, where):
+    """
+    The cells of where (a box at lower) that are True and do not hold a
+    true value, like ``not world.get_point``
+    """
+    if world.chunked:
+        data, mask = world.world.get_block(lower, where.shape)
+        truth = np.array([bool(value) for value in world.world.palette] or [False])
+        return where & ~(mask & truth[data])
+    # Only look up the candidates
+    cells = np.argwhere(where)
+    get = world.world.get
+    filled = [bool(get(key)) for key in zip(*(cells + lower).T.tolist())]
+    result = where.copy()
+    cells = cells[np.array(filled, dtype=bool).reshape(-1)]
+    result[cells[:, 0], cells[:, 1], cells[:, 2]] = False
+    return result
+
+
+def _add(world, lower, where, tex=2):
+    """Fill the cells of the box at lower where ``where`` is True"""
+    world.paste(lower, np.full(where.shape, tex), mask=where)
+
+
 def grid(world, size=24):
     """
     A grid effect applied to the world.
@@ -96,19 +174,12 @@ def grid(world, size=24):
     log.info('Applying Grid Effect')
 
     def pos_func(x, y, z):
-        return (x % size == 0 and y % size == 0) or \
-            (z % size == 0 and y % size == 0) or \
-            (z % size == 0 and x % size == 0)
+        return ((x % size == 0) & (y % size == 0)) | \
+            ((z % size == 0) & (y % size == 0)) | \
+            ((z % size == 0) & (x % size == 0))
 
-    for z in tqdm(range(world.zmax)):
-        for x in range(world.size):
-            for y in range(world.size):
-                if pos_func(x, y, z):
-                    if not world.get_point(x, y, z):
-                        world.set_point(
-                            x, y, z,
-                            cube.newtexcube(tex=2)
-                        )
+    for (z0, z1, x, y, z) in _slabs(world, world.zmax):
+        _add(world, (0, 0, z0), _vacant(world, (0, 0, z0), pos_func(x, y, z)))
 
 
 def decay(world, position_function):
@@ -125,15 +196,11 @@ def decay(world, position_function):
     :rtype: None
     """
     log.info('Applying Decay Effect')
-    for z in tqdm(range(world.zmax)):
-        for x in range(world.size):
-            for y in range(world.size):
-                if random.random() > position_function(x, y, z):
-                    # sys.stdout.write('.')
-                    world.del_point(x, y, z)
-                # else:
-                    # pass
-                    # sys.stdout.write('|')
+    state = _random_state()
+    for (z0, z1, x, y, z) in _slabs(world, world.zmax):
+        limit = _evaluate(position_function, x, y, z)
+        world.clear_box((0, 0, z0), (world.size, world.size, z1), mask=_random(state, limit.shape) > limit)
+    _continue_random(state)
 
 
 def growth(world, position_function):
@@ -150,15 +217,11 @@ def growth(world, position_function):
     :rtype: None
     """
     log.info('Applying Growth Effect')
-    for z in tqdm(range(world.zmax)):
-        for x in range(world.size):
-            for y in range(world.size):
-                if random.random() > position_function(x, y, z):
-                    if not world.get_point(x, y, z):
-                        world.set_point(
-                            x, y, z,
-                            cube.newtexcube(tex=2)
-                        )
+    state = _random_state()
+    for (z0, z1, x, y, z) in _slabs(world, world.zmax):
+        limit = _evaluate(position_function, x, y, z)
+        _add(world, (0, 0, z0), _vacant(world, (0, 0, z0), _random(state, limit.shape) > limit))
+    _continue_random(state)
 
 
 def box(world, height=None):
@@ -176,14 +239,15 @@ def box(world, height=None):
     max_height = world.size
     if height:
         max_height = height
-    for z in tqdm(range(max_height)):
-        for x in range(world.size):
-            for y in range(world.size):
-                if x == 0 or y == 0 or z == 0 or x == world.size - 1 or y == world.size - 1 or z == world.size - 1:
-                    world.set_point(
-                        x, y, z,
-                        cube.newtexcube(tex=2)
-                    )
+    size = world.size
+    # Floor, ceiling (if the box reaches it) and the four walls
+    world.fill_box((0, 0, 0), (size, size, min(1, max_height)), tex=2)
+    if max_height >= size:
+        world.fill_box((0, 0, size - 1), (size, size, size), tex=2)
+    world.fill_box((0, 0, 0), (1, size, max_height), tex=2)
+    world.fill_box((size - 1, 0, 0), (size, size, max_height), tex=2)
+    world.fill_box((0, 0, 0), (size, 1, max_height), tex=2)
+    world.fill_box((0, size - 1, 0), (size, size, max_height), tex=2)
 
 
 def box_outline(world, height=None):
@@ -201,22 +265,11 @@ def box_outline(world, height=None):
     max_height = world.size
     if height:
         max_height = height
-    for z in tqdm(range(max_height)):
-        for x in range(world.size):
-            for y in range(world.size):
-                xa = x == 0
-                ya = y == 0
-                za = z == 0
-                xb = x == world.size - 1
-                yb = y == world.size - 1
-                zb = z == world.size - 1
-
-                # Fun property of booleans, they can be interpreted as ints, 0/1
-                if sum([xa, ya, za, xb, yb, zb]) > 1:
-                    world.set_point(
-                        x, y, z,
-                        cube.newtexcube(tex=2)
-                    )
+    edge = world.size - 1
+    for (z0, z1, x, y, z) in _slabs(world, max_height):
+        # Fun property of booleans, they can be interpreted as ints, 0/1
+        sides = (x == 0).astype(int) + (y == 0) + (z == 0) + (x == edge) + (y == edge) + (z == edge)
+        _add(world, (0, 0, z0), sides > 1)
 
 
 def endcap(world, upm):
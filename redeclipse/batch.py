@@ -0,0 +1,119 @@
+"""
+Parse many maps at once on a pool of worker processes.
+
+Decoding a map is pure Python and bound by the GIL, so threads would not
+help, every map is handed to its own process instead. Results are yielded
+as soon as they are ready, in completion order, see :func:`parse_many`.
+"""
+import os
+import traceback
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from redeclipse import MapParser
+
+
+class MapSummary(object):
+    """
+    Small, picklable digest of a map: the header, map vars and entity
+    counts. Only needs the sections up to the entities, so the world is
+    never decompressed.
+    """
+
+    #: Sections read to build a summary
+    sections = ('ents',)
+
+    def __init__(self, path, m):
+        self.path = path
+        self.version = m.version
+        self.meta = OrderedDict((key, value.decode('utf-8', 'replace') if isinstance(value, bytes) else value) for key, value in m.meta.items())
+        self.map_vars = OrderedDict(
+            (key.decode('utf-8', 'replace'), value.decode('utf-8', 'replace') if isinstance(value, bytes) else value)
+            for key, value in m.map_vars.items()
+        )
+        self.numents = len(m.ents)
+        self.entity_types = dict(Counter(ent.type.name for ent in m.ents))
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'version': self.version,
+            'meta': self.meta,
+            'map_vars': self.map_vars,
+            'numents': self.numents,
+            'entity_types': self.entity_types,
+        }
+
+
+class BatchResult(object):
+    """
+    Outcome of parsing one file. Exactly one of ``value`` (a
+    :class:`redeclipse.Map` or :class:`MapSummary`) and ``error`` (the
+    formatted exception) is set.
+    """
+
+    def __init__(self, path, value=None, error=None):
+        self.path = path
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return 'BatchResult(%r, %s)' % (self.path, 'ok' if self.ok else 'failed')
+
+
+def _parse_one(path, summary, sections):
+    try:
+        if summary:
+            return BatchResult(path, MapSummary(path, MapParser().read(path, sections=MapSummary.sections)))
+        return BatchResult(path, MapParser().read(path, sections=sections))
+    except Exception:
+        return BatchResult(path, error=traceback.format_exc())
+
+
+def parse_many(paths, workers=None, summary=False, sections=None):
+    """
+    Parse ``paths`` on a pool of ``workers`` processes, yielding a
+    :class:`BatchResult` per file as it completes. A file that fails to
+    parse yields a result with the error, the others carry on.
+
+    Closing the generator (or breaking out of the loop over it) cancels
+    the files that have not started yet.
+
+    :param paths: Map files to parse
+    :type paths: list(str)
+
+    :param workers: Number of processes, defaults to the number of CPUs.
+                    With 1 the maps are parsed in this process.
+    :type workers: int
+
+    :param summary: Yield a :class:`MapSummary` instead of the full map.
+                    Much cheaper, both to parse and to send back from the
+                    worker.
+    :type summary: bool
+
+    :param sections: Sections of the full maps to parse, see
+                     :meth:`redeclipse.MapParser.read`
+    :type sections: list(str)
+    """
+    paths = list(paths)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers == 1:
+        for path in paths:
+            yield _parse_one(path, summary, sections)
+        return
+
+    pool = ProcessPoolExecutor(max_workers=workers)
+    futures = [pool.submit(_parse_one, path, summary, sections) for path in paths]
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.shutdown()
@@ -0,0 +1,231 @@
+"""
+On-disk cache of parsed maps.
+
+Entries are keyed by the hash of the map file and the library version, so
+an edited file or an upgrade simply misses. An entry holds the parsed map
+in a form that loads without parsing:
+
+- the decompressed sections before the world (header, vars, texmru,
+  entities, vslots), a few KB which are parsed again
+- the decoded and validated octree, as the buffers of an
+  :class:`redeclipse.octree.OctreeStore`
+
+both zlib compressed. A warm load never inflates the map file nor walks
+its octree: array loads use the store as is and lazy loads build cubes
+from it on access, both some ten times faster than parsing. Eager loads
+build all the cubes at once, creating them is most of what parsing costs,
+so they gain about half. Only ``keep_world_bytes`` needs the original
+encoding and inflates the file.
+
+Entries are plain data, nothing in them is executed (no pickles). They are
+still trusted to be written by this module: a tampered entry can make a
+load fail or return a different map, so keep the cache directory private.
+
+The cache directory is bounded to ``max_size`` bytes, the least recently
+used entries are evicted first.
+"""
+import gzip
+import hashlib
+import os
+import struct
+import sys
+import zlib
+
+from redeclipse import Map, MapParser, SECTIONS, __version__
+from redeclipse.octree import OctreeStore, LazyCubes
+
+CACHE_MAGIC = b'RMC3'
+# magic, world start, vslots start and world end in the decompressed map,
+# compressed sections length, compressed octree length
+CACHE_HEADER = struct.Struct('<4sQQQQQ')
+
+
+def default_directory():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'redeclipse')
+
+
+def file_hash(path):
+    """sha1 of the (compressed) file contents"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _key(digest):
+    data = '%s:%s:%s' % (digest, __version__, sys.byteorder)
+    return hashlib.sha1(data.encode('ascii')).hexdigest()
+
+
+class MapCache(object):
+    """
+    Cache of parsed maps in ``directory``.
+
+    :param directory: Where to keep the entries, defaults to
+                      ``$XDG_CACHE_HOME/redeclipse``
+    :type directory: str
+
+    :param max_size: Maximum total size of the entries in bytes
+    :type max_size: int
+
+    :param enabled: If False every read goes straight to the parser
+    :type enabled: bool
+    """
+
+    def __init__(self, directory=None, max_size=1 << 30, enabled=True):
+        self.directory = directory or default_directory()
+        self.max_size = max_size
+        self.enabled = enabled
+
+    def key(self, path):
+        return _key(file_hash(path))
+
+    def entry(self, key):
+        return os.path.join(self.directory, key + '.rmc')
+
+    def read(self, path, bypass=False, lazy=False, arrays=False, keep_world_bytes=None):
+        """
+        Return the map at ``path``, using the cache if possible. The map is
+        the one ``MapParser().read(path)`` returns for the same options,
+        except that a lazy map holds :class:`redeclipse.octree.LazyCubes`.
+
+        :param bypass: Parse the file and leave the cache alone
+        :type bypass: bool
+
+        :param lazy: Build the cubes on access, see
+                     :meth:`redeclipse.MapParser.read`
+        :type lazy: bool
+
+        :param arrays: See :meth:`redeclipse.MapParser.read`, the cache
+                       saves the most here
+        :type arrays: bool
+
+        :param keep_world_bytes: See :meth:`redeclipse.MapParser.read`.
+                                 Defaults to False for cached maps, as a
+                                 warm load has to inflate the file for them.
+        :type keep_world_bytes: bool
+        """
+        if lazy and arrays:
+            raise ValueError("Cannot load lazily into arrays")
+        if bypass or not self.enabled:
+            return MapParser().read(path, lazy=lazy, arrays=arrays, keep_world_bytes=keep_world_bytes)
+
+        with open(path, 'rb') as handle:
+            source = handle.read()
+        entry = self.entry(_key(hashlib.sha1(source).hexdigest()))
+        try:
+            offsets, head, store = self._load(entry)
+        except Exception:
+            # Missing, or a broken, stale or foreign entry. Parse the map
+            # again and replace it.
+            if os.path.exists(entry):
+                os.remove(entry)
+        else:
+            # Mark as recently used
+            os.utime(entry)
+            data = memoryview(gzip.decompress(source)) if keep_world_bytes else None
+            return self._open(offsets, head, store, data, lazy, arrays, keep_world_bytes)
+
+        data = memoryview(gzip.decompress(source))
+        mp = MapParser()
+        mp._attach(data, {})
+        mp.base_path = path
+        mp.last_section = SECTIONS.index('ents')
+        m = mp._read_map()
+        vslots_start = mp.index
+        mp._loadvslots(m.meta['numvslots'])
+        world_start = mp.index
+        store, world_end = OctreeStore.decode(data, world_start)
+        store.validate(m.meta['worldsize'] >> 1)
+        offsets = (world_start, vslots_start, world_end)
+        head = data[:world_start]
+        self._store(entry, offsets, head, store)
+        self.evict()
+        return self._open(offsets, head, store, data, lazy, arrays, keep_world_bytes)
+
+    def _open(self, offsets, head, store, data, lazy, arrays, keep_world_bytes):
+        """
+        The map of the sections before the world and the octree, ``data``
+        is the decompressed map if it is at hand
+        """
+        (world_start, vslots_start, world_end) = offsets
+        mp = MapParser()
+        mp._attach(head, {})
+        mp.last_section = SECTIONS.index('vslots')
+        head = mp._read_map()
+        if arrays:
+            world = store
+        elif lazy:
+            world = LazyCubes(store, 0)
+        else:
+            world = store.to_cubes()
+        m = Map(head.magic, head.version, head.headersize, head.meta, head.map_vars, head.texmru,
+                head.ents, head.vslots, head.chg, world)
+        if keep_world_bytes:
+            m.world_bytes = data[vslots_start:world_end].tobytes()
+        return m
+
+    def _store(self, entry, offsets, head, store):
+        head = zlib.compress(head)
+        octree = zlib.compress(store.to_bytes())
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = '%s.%d.tmp' % (entry, os.getpid())
+        with open(tmp, 'wb') as handle:
+            handle.write(CACHE_HEADER.pack(CACHE_MAGIC, *(offsets + (len(head), len(octree)))))
+            handle.write(head)
+            handle.write(octree)
+        os.replace(tmp, entry)
+
+    def _load(self, entry):
+        """The world offsets, sections before the world and octree store in an entry"""
+        with open(entry, 'rb') as handle:
+            raw = handle.read()
+        if len(raw) < CACHE_HEADER.size:
+            raise ValueError("Truncated cache entry")
+        (magic, world_start, vslots_start, world_end, head_size, octree_size) = CACHE_HEADER.unpack_from(raw)
+        pos = CACHE_HEADER.size
+        if magic != CACHE_MAGIC or pos + head_size + octree_size != len(raw):
+            raise ValueError("Not a cache entry")
+        head = memoryview(zlib.decompress(raw[pos:pos + head_size]))
+        if len(head) != world_start or not vslots_start <= world_start <= world_end:
+            raise ValueError("Broken cache entry")
+        pos += head_size
+        store = OctreeStore.from_bytes(zlib.decompress(raw[pos:]))
+        return (world_start, vslots_start, world_end), head, store
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in
+        ``max_size``
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.rmc'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove all entries"""
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.rmc'):
+                    os.remove(os.path.join(self.directory, name))
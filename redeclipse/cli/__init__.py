@@ -1,21 +1,27 @@
 import argparse
 import json
 import logging
-from redeclipse import MapParser
+from redeclipse import MapParser, SECTIONS
 from redeclipse.magicavoxel.writer import to_magicavoxel
 
 log = logging.getLogger(__name__)
+# Everything the generators need from their template maps, they bring
+# their own world.
+TEMPLATE_SECTIONS = SECTIONS[:-1]
 
 
-def parse(input):
+def parse(input, sections=None):
     mp = MapParser()
-    return mp.read(input)
+    return mp.read(input, sections=sections)
 
 
 def output_args(parser):
     parser.add_argument('--mpz_out', type=argparse.FileType('w'), help='Output .mpz file')
     parser.add_argument('--magica', type=argparse.FileType('wb'), help='Output .vox file')
     parser.add_argument('--graph', type=argparse.FileType('w'), help='Output .json file')
+    parser.add_argument('--compresslevel', type=int, default=9, choices=range(1, 10), help='gzip level of the .mpz file, 1 is fastest')
+    parser.add_argument('--threads', type=int, default=1, help='Compress the .mpz file on this many threads')
+    parser.add_argument('--collapse', action='store_true', help='Merge uniform octants into larger cubes, for a smaller .mpz file')
 
 
 def output(v, mymap, upm, prefabs, args):
@@ -31,9 +37,7 @@ def output(v, mymap, upm, prefabs, args):
             for line in mymap.cfg_extra:
                 handle.write(line + '\n')
 
-        mymap.world = v.to_octree()
-        mymap.world[0].octsav = 0
-        mymap.write(args.mpz_out.name)
+        mymap.write(args.mpz_out.name, compresslevel=args.compresslevel, threads=args.threads, voxels=v, collapse=args.collapse)
 
     if args.graph:
         data = {
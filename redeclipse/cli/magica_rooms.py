@@ -9,7 +9,7 @@ from redeclipse import prefabs
 # prefabs.TEXMAN = RainbowPukeTextureManager()
 # Back to our normally scheduled imports.
 prefabs.LIGHTMAN.brightness = 0.3
-from redeclipse.cli import parse, output, output_args
+from redeclipse.cli import parse, output, output_args, TEMPLATE_SECTIONS
 from redeclipse.entities import Sunlight
 from redeclipse.prefabs import STARTING_POSITION
 from redeclipse.prefabs import castle, dungeon, spacestation, original, egypt  # noqa
@@ -24,7 +24,7 @@ log = logging.getLogger(__name__)
 
 def main(mpz_in, size=2**8, seed=42, rooms=200, debug=False, ctf=False, mirror=2, flavor=None, **kwargs):
     random.seed(seed)
-    mymap = parse(mpz_in.name)
+    mymap = parse(mpz_in.name, sections=TEMPLATE_SECTIONS)
     v = VoxelWorld(size=size)
     # Update with chosen world flavouring
     mymap = redeclipse.worldflavors.update(mymap, flavor)
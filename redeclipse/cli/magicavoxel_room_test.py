@@ -5,7 +5,7 @@ import logging
 from redeclipse import prefabs
 # We must override this ASAP since everyone else (e.g. prefabs) also imports the TEXMAN from prefab.
 # Back to our normally scheduled imports.
-from redeclipse.cli import parse
+from redeclipse.cli import parse, TEMPLATE_SECTIONS
 from redeclipse.entities import Sunlight
 from redeclipse.magicavoxel.writer import to_magicavoxel
 from redeclipse.prefabs import castle, dungeon, spacestation, original, egypt  # noqa
@@ -58,7 +58,7 @@ def main(magica=False, redeclipse=False):
     ]
 
     for idx, Room in enumerate(magica_classes):
-        mymap = parse('maps/empty-day.mpz')
+        mymap = parse('maps/empty-day.mpz', sections=TEMPLATE_SECTIONS)
 
         upm = UnusedPositionManager(2**8, mirror=4, noclip=True)
         v = VoxelWorld(size=2**8)
@@ -89,9 +89,7 @@ def main(magica=False, redeclipse=False):
                 prefabs.TEXMAN.emit_conf(mpz_out)
                 prefabs.TEXMAN.copy_data()
 
-                mymap.world = v.to_octree()
-                mymap.world[0].octsav = 0
-                mymap.write(mpz_out.name)
+                mymap.write(mpz_out.name, voxels=v)
 
 
 if __name__ == '__main__':
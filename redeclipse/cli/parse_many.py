@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+import sys
+import simplejson as json
+import argparse
+from redeclipse.batch import parse_many
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarise many maps in parallel, one JSON document per line')
+    parser.add_argument('input', nargs='+', help='Input .mpz files')
+    parser.add_argument('--workers', type=int, help='Number of worker processes, defaults to the number of CPUs')
+    args = parser.parse_args()
+
+    failed = 0
+    for result in parse_many(args.input, workers=args.workers, summary=True):
+        if result.ok:
+            sys.stdout.write(json.dumps(result.value.to_dict()) + '\n')
+        else:
+            failed += 1
+            sys.stderr.write('%s: %s' % (result.path, result.error))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
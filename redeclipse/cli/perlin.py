@@ -1,11 +1,10 @@
 #!/usr/bin/env python
 from redeclipse.voxel import VoxelWorld
-from redeclipse.cli import parse
-from redeclipse.objects import cube
+from redeclipse.cli import parse, TEMPLATE_SECTIONS
 import argparse
 import sys  # noqa
 import random  # noqa
-import math  # noqa
+import math
 import noise  # noqa
 random.seed(22)
 IJ_SIZE = 2**7
@@ -19,9 +18,11 @@ def main():
     parser = argparse.ArgumentParser(description='Add trees to map')
     parser.add_argument('input', help='Input .mpz file')
     parser.add_argument('output', help='Output .mpz file')
+    parser.add_argument('--collapse', action='store_true', help='Merge uniform octants into larger cubes')
+    parser.add_argument('--cull', action='store_true', help='Remove the solid cubes which can not be seen')
     args = parser.parse_args()
 
-    mymap = parse(args.input)
+    mymap = parse(args.input, sections=TEMPLATE_SECTIONS)
     v = VoxelWorld(size=2**7)
 
     treeDensityMap = {}
@@ -46,35 +47,36 @@ def main():
                         for j2 in range(4 * j, 4 * (j + 1)):
                             bldgDensityMap[i2, j2] = True
 
-    def point(i, j, k):
+    def column(i, j):
+        # The filled (start, end, texture) runs of the column at i, j
         q = noise.pnoise2(i / noise_scaling, j / noise_scaling, octaves=octaves, base=MAP_SEED)
         q *= 5
         q += 30
 
-        if i % 10 == 0 and j == 0 and k == 0:
+        if i % 10 == 0 and j == 0:
             sys.stderr.write('%s / %s %s %s\n' % (i, IJ_SIZE, q, w))
 
         if (i, j) in treeDensityMap:
-            return [58, 58, 58, 58, 59, 59]
+            return [(0, K_SIZE, [58, 58, 58, 58, 59, 59])]
 
-        if (i, j) in bldgDensityMap and k < q + 4 and k >= q:
-            return [57, 57, 57, 57, 57, 57]
-
-        if k < q:
-            return [23, 23, 23, 23, 22, 61]
-
-        return False
+        # Integer k with k < q, and q <= k < q + 4
+        ground = min(max(math.ceil(q), 0), K_SIZE)
+        runs = [(0, ground, [23, 23, 23, 23, 22, 61])]
+        if (i, j) in bldgDensityMap:
+            runs.append((ground, min(max(math.ceil(q + 4), 0), K_SIZE), [57, 57, 57, 57, 57, 57]))
+        return runs
 
     for i in range(IJ_SIZE):
         for j in range(IJ_SIZE):
-            for k in range(K_SIZE):
-                q = point(i, j, k)
-                if q:
-                    v.set_point(i, j, k, cube.newtexcube(tex=q))
+            for (start, end, tex) in column(i, j):
+                v.fill_column(i, j, start, end, tex=tex)
+
+    if args.cull:
+        # Removing the inside breaks up uniform octants, rather make it one
+        # value when they are merged
+        v.cull_hidden(uniform=args.collapse)
 
-    mymap.world = v.to_octree()
-    mymap.world[0].octsav = 0
-    mymap.write(args.output)
+    mymap.write(args.output, voxels=v, collapse=args.collapse)
 
 
 if __name__ == '__main__':
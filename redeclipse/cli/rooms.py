@@ -3,7 +3,7 @@ import argparse
 import random
 import logging
 from redeclipse.voxel import VoxelWorld
-from redeclipse.cli import parse
+from redeclipse.cli import parse, TEMPLATE_SECTIONS
 from redeclipse.entities import Sunlight
 from redeclipse import prefabs as p
 from redeclipse.upm import UnusedPositionManager
@@ -15,9 +15,9 @@ logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
 
-def main(mpz_in, mpz_out, size=2**7, seed=42, rooms=200, debug=False, magica=None):
+def main(mpz_in, mpz_out, size=2**7, seed=42, rooms=200, debug=False, magica=None, collapse=False):
     random.seed(seed)
-    mymap = parse(mpz_in.name)
+    mymap = parse(mpz_in.name, sections=TEMPLATE_SECTIONS)
     v = VoxelWorld(size=size)
 
     possible_rooms = [
@@ -82,9 +82,7 @@ def main(mpz_in, mpz_out, size=2**7, seed=42, rooms=200, debug=False, magica=Non
         to_magicavoxel(v, magica, TEXMAN)
         print('voxel')
 
-    mymap.world = v.to_octree()
-    mymap.world[0].octsav = 0
-    mymap.write(mpz_out.name)
+    mymap.write(mpz_out.name, voxels=v, collapse=collapse)
 
 
 if __name__ == '__main__':
@@ -98,5 +96,6 @@ if __name__ == '__main__':
     parser.add_argument('--seed', default=42, type=int, help="Random seed")
     parser.add_argument('--rooms', default=200, type=int, help="Number of rooms to place")
     parser.add_argument('--debug', action='store_true', help="Debugging")
+    parser.add_argument('--collapse', action='store_true', help="Merge uniform octants into larger cubes")
     args = parser.parse_args()
     main(**vars(args))
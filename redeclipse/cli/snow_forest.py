@@ -2,8 +2,7 @@
 from redeclipse.voxel import VoxelWorld
 from redeclipse.entities.model import MapModel
 from redeclipse.entities import PlayerSpawn
-from redeclipse.cli import parse
-from redeclipse.objects import cube
+from redeclipse.cli import parse, TEMPLATE_SECTIONS
 import argparse
 import random
 import noise
@@ -75,9 +74,11 @@ def main():
     parser = argparse.ArgumentParser(description='Snowy forest map')
     parser.add_argument('input', help='Input .mpz file')
     parser.add_argument('output', help='Output .mpz file')
+    parser.add_argument('--collapse', action='store_true', help='Merge uniform octants into larger cubes')
+    parser.add_argument('--cull', action='store_true', help='Remove the solid cubes which can not be seen')
     args = parser.parse_args()
 
-    mymap = parse(args.input)
+    mymap = parse(args.input, sections=TEMPLATE_SECTIONS)
     v = VoxelWorld(size=WORLD_SIZE)
 
     heightmap = {}
@@ -88,17 +89,20 @@ def main():
             heightmap[(i, j)] = height
             snow = point_snow(i, j)
 
-            for k in range(height - 2, height):
-                tex = 11
-                if snow:
-                    tex = 13
+            tex = 11
+            if snow:
+                tex = 13
 
-                v.set_point(i, j, k, cube.newtexcube(tex=tex))
+            # # Border wall
+            if i == 0 or j == 0 or i == IJ_SIZE - 1 or j == IJ_SIZE - 1:
+                v.fill_column(i, j, height - 2, height + 9, tex=tex)
+            else:
+                v.fill_column(i, j, height - 2, height, tex=tex)
 
-                # # Border wall
-                if i == 0 or j == 0 or i == IJ_SIZE - 1 or j == IJ_SIZE - 1:
-                    for q in range(10):
-                        v.set_point(i, j, k + q, cube.newtexcube(tex=tex))
+    if args.cull:
+        # Removing the inside breaks up uniform octants, rather make it one
+        # value when they are merged
+        v.cull_hidden(uniform=args.collapse)
 
     tree_count = 0
     for i in tqdm(range(IJ_SIZE), desc='Placing Entities'):
@@ -139,9 +143,7 @@ def main():
                 )
                 mymap.ents.append(rock)
 
-    mymap.world = v.to_octree()
-    mymap.world[0].octsav = 0
-    mymap.write(args.output)
+    mymap.write(args.output, voxels=v, collapse=args.collapse)
 
 
 if __name__ == '__main__':
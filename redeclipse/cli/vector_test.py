@@ -2,7 +2,7 @@
 import argparse
 import logging
 from redeclipse.voxel import VoxelWorld
-from redeclipse.cli import parse
+from redeclipse.cli import parse, TEMPLATE_SECTIONS
 from redeclipse import prefabs as p
 from redeclipse.prefabs import magica as m, TEXMAN
 from redeclipse.upm import UnusedPositionManager
@@ -18,7 +18,7 @@ log = logging.getLogger(__name__)
 def main(mpz_in, redeclipse=None, magica=None, world_size=2**7):
     Room = m.castle_large
 
-    mymap = parse(mpz_in.name)
+    mymap = parse(mpz_in.name, sections=TEMPLATE_SECTIONS)
     upm = UnusedPositionManager(world_size, mirror=4, noclip=True)
     v = VoxelWorld(size=world_size)
 
@@ -46,9 +46,7 @@ def main(mpz_in, redeclipse=None, magica=None, world_size=2**7):
     if redeclipse:
         TEXMAN.emit_conf(redeclipse)
         TEXMAN.copy_data()
-        mymap.world = v.to_octree()
-        mymap.world[0].octsav = 0
-        mymap.write(redeclipse.name)
+        mymap.write(redeclipse.name, voxels=v)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,7 @@
 import struct
 
+import numpy as np
+
 
 def to_magicavoxel(voxel_world, handle, texman):
     cs = 4 * (1 + len(voxel_world.world))
@@ -24,7 +26,23 @@ def to_magicavoxel(voxel_world, handle, texman):
     def m(x):
         return int(x)
 
-    for ((x, y, z), value) in voxel_world.world.items():
+    if voxel_world.chunked:
+        # Whole arrays at once, the colour is looked up once per palette
+        # entry in use
+        coords, indices = voxel_world.world.occupied()
+        inside = ((coords >= 0) & (coords <= 255)).all(axis=1)
+        colours = np.zeros(len(voxel_world.world.palette), dtype=np.uint8)
+        for index in np.unique(indices[inside]).tolist():
+            colours[index] = m(voxel_world.world.palette[index].texture[0] + 1)
+        records = np.empty((int(inside.sum()), 4), dtype=np.uint8)
+        records[:, :3] = coords[inside]
+        records[:, 3] = colours[indices[inside]]
+        handle.write(records.tobytes())
+        items = voxel_world.world.extra.items()
+    else:
+        items = voxel_world.world.items()
+
+    for ((x, y, z), value) in items:
         if x > 255 or y > 255 or z > 255 or x < 0 or y < 0 or z < 0:
             continue
         handle.write(struct.pack('BBBB', m(x), m(y), m(z), m(value.texture[0] + 1)))
@@ -1,4 +1,5 @@
-from redeclipse.enums import Faces, TextNum, OctLayers
+import itertools
+from redeclipse.enums import Faces, TextNum, OctLayers, OCT
 from redeclipse.vector.re import ivec2, ivec3, vec2, vec3
 
 MAXENTATTRS = 100
@@ -6,7 +7,16 @@ VSLOT_SHPARAM = 0
 DEFAULT_ALPHA_FRONT = 0.5
 DEFAULT_ALPHA_BACK = 0.0
 ALLOCNODES = 0
-CUBE_ID = 0
+#: Give every cube a unique ``cube_id``, off by default to save memory.
+#: Without it ``cube.to_dict()['_id']`` (and so the ``to_json`` output) is
+#: None.
+TRACK_CUBE_IDS = False
+CUBE_ID = itertools.count()
+LAYER_DUP = OctLayers.LAYER_DUP.value
+MAXFACEVERTS = OctLayers.MAXFACEVERTS.value
+OCTSAV_CHILDREN = OCT.OCTSAV_CHILDREN.value
+OCTSAV_EMPTY = OCT.OCTSAV_EMPTY.value
+OCTSAV_SOLID = OCT.OCTSAV_SOLID.value
 
 
 def dimension(orient):
@@ -21,6 +31,26 @@ def opposite(orient):
     return orient ^ 1
 
 
+_FACEVALID = {}
+
+
+def facevalid(f):
+    """
+    Whether the 4 edges packed in a face value describe a valid face,
+    results are cached as nearly all faces are F_EMPTY or F_SOLID.
+    """
+    try:
+        return _FACEVALID[f]
+    except KeyError:
+        pass
+    v = f if isinstance(f, int) else f.value
+    e0 = v & 0x0F0F0F0F
+    e1 = (v >> 4) & 0x0F0F0F0F
+    valid = not (e0 == e1 or ((e1 + 0x07070707) | (e1 - e0)) & 0xF0F0F0F0)
+    _FACEVALID[f] = valid
+    return valid
+
+
 class VSlot:
 
     def __init__(self, a, b):
@@ -70,17 +100,18 @@ class VSlot:
 
 
 class SurfaceInfo:
+    __slots__ = ('lmid', 'verts', 'numverts')
 
     def __init__(self, lmid0, lmid1, verts, numverts):
-        self.lmid = [lmid0, lmid1]
+        self.lmid = (lmid0, lmid1)
         self.verts = verts
         self.numverts = numverts
 
     def totalverts(self):
-        if self.numverts & OctLayers.LAYER_DUP.value:
-            return (self.numverts & OctLayers.MAXFACEVERTS.value) * 2
+        if self.numverts & LAYER_DUP:
+            return (self.numverts & MAXFACEVERTS) * 2
         else:
-            return (self.numverts & OctLayers.MAXFACEVERTS.value)
+            return (self.numverts & MAXFACEVERTS)
 
     def __str__(self):
         return 'Surf: lmid %d %d verts %d numverts %d' % (
@@ -134,6 +165,7 @@ class SlotShaderParam:
 
 
 class cubext:
+    __slots__ = ('va', 'ents', 'tjoints', 'surfaces', 'verts', 'surfaceinfo', 'maxverts')
 
     def __init__(self, old=None, maxverts=0):
         if old:
@@ -160,6 +192,16 @@ class cubext:
             'surfaces': [x.to_dict() for x in self.surfaces],
         }
 
+    def copy(self):
+        ce = cubext(None, maxverts=self.maxverts)
+        ce.va = self.va
+        ce.ents = self.ents
+        ce.tjoints = self.tjoints
+        ce.verts = self.verts
+        ce.surfaceinfo = list(self.surfaceinfo)
+        ce.surfaces = [None if x is None else SurfaceInfo(x.lmid[0], x.lmid[1], x.verts, x.numverts) for x in self.surfaces]
+        return ce
+
     @classmethod
     def from_dict(cls, d):
         ce = cubext(None, maxverts=d['maxverts'])
@@ -178,7 +220,37 @@ class cubeedge:
         self.flags = flags
 
 
+# Shared immutable defaults of the cube fields
+SOLID_EDGES = (128,) * 12
+DEFAULT_TEXTURE = (TextNum.DEFAULT_GEOM,) * 6
+EMPTY_FACES = (Faces.F_EMPTY,) * 3
+SOLID_FACES = (Faces.F_SOLID,) * 3
+# Surfaces of a textured solid cube, see cube.texturize
+TEXCUBE_SURFACE = SurfaceInfo(2, 0, 0, 32)
+TEXCUBE_EXT = cubext()
+TEXCUBE_EXT.surfaces = (TEXCUBE_SURFACE,) * 6
+# Shared textured cubes, see cube.newtexcube
+_TEXCUBES = {}
+MAX_TEXCUBES = 4096
+
+
 class cube:
+    """
+    A node of the octree.
+
+    ``edges``, ``faces`` and ``texture`` are tuples, replace them rather
+    than changing them in place. Textured leaves (:meth:`newtexcube`) and
+    the empty leaf :data:`EMPTY` are shared between every place they are
+    used and cannot be changed at all, call :meth:`mutable` to get a cube
+    of your own first (copy on write).
+    """
+    __slots__ = (
+        'children', 'ext', 'edges', 'faces', 'texture', 'material', 'merged',
+        'escaped', 'visible', 'surfmask', 'totalverts', 'octsav', 'mat',
+        'haschildren', 'cube_id',
+    )
+    #: Whether this is a shared instance, see mutable()
+    shared = False
 
     def __init__(self):
         # points to 8 cube structures which are its children, or NULL. -Z first, then -Y, -X
@@ -186,13 +258,14 @@ class cube:
         # extended info for the cube
         self.ext = None  # extended info
         # edges of the cube, each uchar is 2 4bit values denoting the range.
-        self.edges = [128] * 12  # 12
+        self.edges = SOLID_EDGES  # 12
         # 4 edges of each dimension together representing 2 perpendicular faces
-        self.faces = []  # 3
+        self.faces = ()  # 3
         # one for each face. same order as orient.
-        self.texture = [TextNum.DEFAULT_GEOM] * 6
+        self.texture = DEFAULT_TEXTURE
         # empty-space material
         self.material = None
+        self.mat = 0
         # merged faces of the cube
         self.merged = 0
         # mask of which children have escaped merges
@@ -203,13 +276,46 @@ class cube:
         self.surfmask = 0
         self.totalverts = 0
         self.octsav = 1
+        self.haschildren = False
 
         # Secret internal ID to make my life less painful
-        global CUBE_ID
-        self.cube_id = CUBE_ID
-        CUBE_ID += 1
+        self.cube_id = next(CUBE_ID) if TRACK_CUBE_IDS else None
+
+    def copy(self):
+        """
+        Unshared copy of this cube, its children (if any) are not copied
+        """
+        c = cube()
+        for name in cube.__slots__:
+            if name != 'cube_id':
+                setattr(c, name, getattr(self, name))
+        if c.ext is not None:
+            c.ext = c.ext.copy()
+        return c
+
+    def mutable(self):
+        """
+        Return a cube that may be changed: this cube, or a copy if it is
+        shared. Store the result in place of the original.
+        """
+        if self.shared:
+            return self.copy()
+        return self
+
+    def setsurface(self, i, surf):
+        """
+        Replace surface i, the surfaces are copied first if they are
+        shared with other cubes.
+        """
+        if self.ext is TEXCUBE_EXT:
+            self.ext = self.ext.copy()
+        self.ext.surfaces[i] = surf
 
     def to_dict(self, children=True):
+        """
+        The cube as a dictionary. ``_id`` is the ``cube_id``, which is None
+        unless ``TRACK_CUBE_IDS`` was set when the cube was created.
+        """
         d = {
             '_id': self.cube_id,
             'ext': self.ext.to_dict() if self.ext else None,
@@ -248,27 +354,37 @@ class cube:
 
     @classmethod
     def newtexcube(cls, tex=2):
-        c = cube.newcube()
-        return cube.texturize(c, tex=tex)
+        """
+        Textured solid leaf. There is a single, shared and read only
+        instance per set of textures, see :meth:`mutable`.
+        """
+        key = (tex,) * 6 if isinstance(tex, int) else tuple(tex)
+        try:
+            return _TEXCUBES[key]
+        except KeyError:
+            pass
+        c = cube.texturize(cube.newcube(), tex=key)
+        c.__class__ = _SharedCube
+        if len(_TEXCUBES) >= MAX_TEXCUBES:
+            _TEXCUBES.clear()
+        _TEXCUBES[key] = c
+        return c
 
     @classmethod
     def texturize(cls, c, tex=2):
+        """
+        Make c a textured solid cube. Returns it, or the copy that was
+        changed if c is shared (see :meth:`mutable`).
+        """
+        c = c.mutable()
         c.set_solid()
         if isinstance(tex, int):
-            c.texture = [tex, tex, tex, tex, tex, tex]
+            c.texture = (tex,) * 6
         else:
-            c.texture = tex
-
-        c.ext = cubext()
-        c.ext.verts = 0
-        c.ext.surfaces = [
-            SurfaceInfo(2, 0, 0, 32),
-            SurfaceInfo(2, 0, 0, 32),
-            SurfaceInfo(2, 0, 0, 32),
-            SurfaceInfo(2, 0, 0, 32),
-            SurfaceInfo(2, 0, 0, 32),
-            SurfaceInfo(2, 0, 0, 32),
-        ]
+            c.texture = tuple(tex)
+
+        # Identical for all textured cubes, copied by setsurface()
+        c.ext = TEXCUBE_EXT
         c.octsav = 35
         c.surfmask = 63
         return c
@@ -292,11 +408,12 @@ class cube:
 
     def setfaces(self, face):
         # octa.h L256
-        self.faces = [
-            face,
-            face,
-            face
-        ]
+        if face is Faces.F_EMPTY:
+            self.faces = EMPTY_FACES
+        elif face is Faces.F_SOLID:
+            self.faces = SOLID_FACES
+        else:
+            self.faces = (face, face, face)
 
     def newcubeext(self, maxverts, init):
         if self.ext and self.ext.maxverts >= maxverts:
@@ -452,29 +569,102 @@ class cube:
             ]
 
     @classmethod
-    def validatec(cls, cube_arr, size, depth=0):
-
-        for i in range(8):
-            if cube_arr[i].children:
-                if size <= 1:
-                    cls.solidfaces(cube.children[i])
-                    cls.discardchildren(cube.children[i], True)
+    def validatec(cls, cube_arr, size, depth=0, recursive=True):
+        """
+        Fix up the octree the way the engine does after loading a map:
+        children of unit cubes are dropped (the cube is made solid),
+        leaves larger than 0x1000 are split and leaves with an invalid
+        face are emptied.
+
+        Shared cubes (see :meth:`mutable`) that need changing are replaced
+        in ``cube_arr`` by a copy.
+        """
+        # Explicit stack of (array, size) rather than recursing per level
+        stack = [(cube_arr, size)]
+        while stack:
+            cube_arr, size = stack.pop()
+            for i in range(8):
+                c = cube_arr[i]
+                if c.children:
+                    if size <= 1:
+                        cube_arr[i] = cls.discardchildren(cls.solidfaces(c), True)
+                    elif recursive:
+                        stack.append((c.children, size >> 1))
+                elif size > 0x1000:
+                    c = cube_arr[i] = cls.subdividecube(c, True, False)
+                    if recursive:
+                        stack.append((c.children, size >> 1))
                 else:
-                    cls.validatec(cube_arr[i].children, size >> 1, depth + 1)
-            elif size > 0x1000:
-                cls.subdividecube(cube_arr[i], True, False)
-                cls.validatec(cube_arr[i].children, size >> 1, depth + 1)
-            else:
-                for j in range(3):
-                    f = cube_arr[i].faces[j]
-                    if not isinstance(f, int):
-                        f = f.value
-                    e0 = f & 0x0F0F0F0F
-                    e1 = (f >> 4) & 0x0F0F0F0F
-                    if (e0 == e1 or ((e1 + 0x07070707) | (e1 - e0)) & 0xF0F0F0F0):
-                        cls.emptyfaces(cube_arr[i])
-                        break
+                    for f in c.faces:
+                        if not facevalid(f):
+                            cube_arr[i] = cls.emptyfaces(c)
+                            break
 
     @classmethod
-    def emptyfaces(cls, cube):
-        cube.setfaces(Faces.F_EMPTY)
+    def emptyfaces(cls, c):
+        """
+        Empty the faces of c. Returns it, or the copy that was changed if c
+        is shared and not empty already.
+        """
+        if c.faces == EMPTY_FACES:
+            return c
+        c = c.mutable()
+        c.setfaces(Faces.F_EMPTY)
+        return c
+
+    @classmethod
+    def solidfaces(cls, c):
+        """
+        Make the faces (and edges) of c solid. Returns it, or the copy that
+        was changed if c is shared.
+        """
+        c = c.mutable()
+        c.set_solid()
+        c.edges = SOLID_EDGES
+        return c
+
+    @classmethod
+    def discardchildren(cls, c, fixtex=False):
+        """
+        Drop the children of c, it becomes a solid or empty leaf depending
+        on its faces. The textures are left as they are. Returns c, or the
+        copy that was changed if c is shared.
+        """
+        c = c.mutable()
+        c.children = None
+        c.octsav = OCTSAV_SOLID if c.faces == SOLID_FACES else OCTSAV_EMPTY
+        return c
+
+    @classmethod
+    def subdividecube(cls, c, fullcheck=True, brighten=True):
+        """
+        Split the leaf c into 8 children with the same fields. Returns c,
+        or the copy that was changed if c is shared.
+        """
+        c = c.mutable()
+        c.children = [c.copy() for i in range(8)]
+        c.octsav = OCTSAV_CHILDREN
+        return c
+
+
+class _SharedCube(cube):
+    """A cube shared between many places, see cube.mutable()"""
+    __slots__ = ()
+    shared = True
+
+    def __setattr__(self, name, value):
+        raise TypeError("Shared cube, call .mutable() to get a copy that may be changed")
+
+    def setsurface(self, i, surf):
+        raise TypeError("Shared cube, call .mutable() to get a copy that may be changed")
+
+    def __reduce__(self):
+        # Unpickle as the shared instance again
+        if self is EMPTY:
+            return 'EMPTY'
+        return (cube.newtexcube, (self.texture, ))
+
+
+#: The shared empty leaf
+EMPTY = cube.newcube()
+EMPTY.__class__ = _SharedCube
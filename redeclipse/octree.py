@@ -0,0 +1,597 @@
+"""
+Octree stored as flat arrays ("struct of arrays") instead of a graph of
+:class:`redeclipse.objects.cube` objects.
+
+Nodes are numbered, the 8 children of a node are always stored next to
+each other and ``child[node]`` points at the first of them (-1 for a
+leaf). Nodes 0-7 are the root cubes. Per node fields are kept in
+``bytearray``/``array`` buffers in the same native layout the map format
+uses (textures as 6 ushorts, edges as 12 bytes, ...) so reading and writing
+a map is mostly copying slices.
+
+A store takes a few dozen bytes per node, none of which are Python objects
+the garbage collector has to track. :class:`CubeView` provides the familiar
+cube interface on top of it where needed, while traversals of the whole
+tree go a level at a time with NumPy, see :meth:`OctreeStore.leaves`.
+"""
+import struct
+from array import array
+
+import numpy as np
+
+from redeclipse.enums import OCT, TextNum
+from redeclipse.objects import cube, cubext, SurfaceInfo, MAXFACEVERTS, TEXCUBE_EXT, EMPTY_FACES, SOLID_FACES
+
+OCTSAV_CHILDREN = OCT.OCTSAV_CHILDREN.value
+OCTSAV_EMPTY = OCT.OCTSAV_EMPTY.value
+OCTSAV_SOLID = OCT.OCTSAV_SOLID.value
+OCTSAV_NORMAL = OCT.OCTSAV_NORMAL.value
+OCTSAV_LODCUBE = OCT.OCTSAV_LODCUBE.value
+
+USHORT = struct.Struct('H')
+TEXTURE = struct.Struct('6H')
+EDGES = struct.Struct('12B')
+SURFHEADER = struct.Struct('BB')
+
+# Fields of 8 fresh nodes, the same as cube.newcube()
+BLOCK_OCTSAV = bytes([OCTSAV_EMPTY]) * 8
+BLOCK_EDGES = bytes([128]) * 12 * 8
+BLOCK_TEXTURES = TEXTURE.pack(*[TextNum.DEFAULT_GEOM.value] * 6) * 8
+BLOCK_CHILD = array('i', [-1] * 8)
+BLOCK_MATERIAL = array('H', [0] * 8)
+BLOCK_ZERO = bytes(8)
+BLOCK_SURFACES = bytes(24 * 8)
+CHILDREN_BYTE = bytes([OCTSAV_CHILDREN])
+# Surfaces of a textured cube, see cube.texturize
+TEXCUBE_SURFACES = bytes((2, 0, 0, 32) * 6)
+# Offset of each of the 8 children in units of their size, child i is at
+# x = i & 1, y = i >> 1 & 1, z = i >> 2 & 1
+CORNERS = np.array([(i & 1, (i >> 1) & 1, (i >> 2) & 1) for i in range(8)])
+# The per node buffers in the order of to_bytes, with their array typecode
+# (None for a bytearray) and bytes per node
+FIELDS = (
+    ('octsav', None, 1),
+    ('child', 'i', array('i').itemsize),
+    ('edges', None, 12),
+    ('textures', None, 12),
+    ('material', 'H', array('H').itemsize),
+    ('merged', None, 1),
+    ('surfmask', None, 1),
+    ('totalverts', None, 1),
+    ('surfaces', None, 24),
+)
+NODE_BYTES = sum(width for (name, typecode, width) in FIELDS)
+
+
+class OctreeStore(object):
+    """
+    Array backed octree, see the module documentation.
+
+    Behaves like the list of the 8 root cubes (as :class:`CubeView`), so
+    it can be used as ``Map.world``.
+    """
+
+    def __init__(self):
+        self.octsav = bytearray()
+        self.child = array('i')
+        self.edges = bytearray()
+        self.textures = bytearray()
+        self.material = array('H')
+        self.merged = bytearray()
+        self.surfmask = bytearray()
+        self.totalverts = bytearray()
+        # 4 bytes (lmid0, lmid1, verts, numverts) for each of the 6 faces
+        self.surfaces = bytearray()
+        self.alloc()
+
+    def __len__(self):
+        return 8
+
+    def __getitem__(self, i):
+        if not 0 <= i < 8:
+            raise IndexError(i)
+        return CubeView(self, i)
+
+    def __iter__(self):
+        for i in range(8):
+            yield CubeView(self, i)
+
+    @property
+    def nodes(self):
+        return len(self.octsav)
+
+    def alloc(self):
+        """
+        Add a block of 8 empty nodes, returns the number of the first
+        """
+        start = len(self.octsav)
+        self.octsav += BLOCK_OCTSAV
+        self.child.extend(BLOCK_CHILD)
+        self.edges += BLOCK_EDGES
+        self.textures += BLOCK_TEXTURES
+        self.material.extend(BLOCK_MATERIAL)
+        self.merged += BLOCK_ZERO
+        self.surfmask += BLOCK_ZERO
+        self.totalverts += BLOCK_ZERO
+        self.surfaces += BLOCK_SURFACES
+        return start
+
+    @classmethod
+    def decode(cls, buf, offset):
+        """
+        Decode the encoded octree in ``buf`` starting at ``offset``.
+        Returns the store and the offset past the octree.
+        """
+        store = cls()
+        octsav = store.octsav
+        child = store.child
+        edges = store.edges
+        textures = store.textures
+        material = store.material
+        merged = store.merged
+        surfmask = store.surfmask
+        totalverts = store.totalverts
+        surfaces = store.surfaces
+
+        # Explicit stack of (block, index in the block) to continue at
+        stack = [(0, 0)]
+        try:
+            while stack:
+                block, start = stack.pop()
+                for node in range(block + start, block + 8):
+                    o = buf[offset]
+                    offset += 1
+                    octsav[node] = o
+                    kind = o & 0x7
+                    if kind == OCTSAV_CHILDREN:
+                        if node < block + 7:
+                            stack.append((block, node - block + 1))
+                        first = store.alloc()
+                        child[node] = first
+                        stack.append((first, 0))
+                        break
+                    elif kind == OCTSAV_NORMAL:
+                        edges[12 * node:12 * node + 12] = buf[offset:offset + 12]
+                        offset += 12
+                    elif kind not in (OCTSAV_EMPTY, OCTSAV_SOLID, OCTSAV_LODCUBE):
+                        # Same as the cube parser, the rest of the block is
+                        # left empty.
+                        break
+
+                    textures[12 * node:12 * node + 12] = buf[offset:offset + 12]
+                    offset += 12
+                    if o & 0xE0:
+                        if o & 0x40:
+                            material[node] = USHORT.unpack_from(buf, offset)[0]
+                            offset += 2
+                        if o & 0x80:
+                            merged[node] = buf[offset]
+                            offset += 1
+                        if o & 0x20:
+                            mask = buf[offset]
+                            surfmask[node] = mask
+                            totalverts[node] = buf[offset + 1]
+                            offset += 2
+                            if mask == 63 and buf[offset:offset + 24] == TEXCUBE_SURFACES:
+                                # Nearly all of them
+                                surfaces[24 * node:24 * node + 24] = TEXCUBE_SURFACES
+                                offset += 24
+                                continue
+                            for j in range(6):
+                                if mask & (1 << j):
+                                    if buf[offset + 3] & MAXFACEVERTS:
+                                        raise NotImplementedError("Gross in")
+                                    pos = 24 * node + 4 * j
+                                    surfaces[pos:pos + 4] = buf[offset:offset + 4]
+                                    offset += 4
+        except (IndexError, ValueError):
+            raise EOFError("Unexpected end of map data")
+        return store, offset
+
+    def to_bytes(self):
+        """
+        All the buffers one after the other, in native byte order. See
+        :meth:`from_bytes`.
+        """
+        return b''.join(bytes(getattr(self, name)) for (name, typecode, width) in FIELDS)
+
+    @classmethod
+    def from_bytes(cls, buf):
+        """The store saved with :meth:`to_bytes`"""
+        nodes, rest = divmod(len(buf), NODE_BYTES)
+        if rest or nodes < 8 or nodes % 8:
+            raise ValueError("Not an octree store")
+        store = cls.__new__(cls)
+        pos = 0
+        for (name, typecode, width) in FIELDS:
+            part = buf[pos:pos + nodes * width]
+            pos += nodes * width
+            if typecode is None:
+                setattr(store, name, bytearray(part))
+            else:
+                field = array(typecode)
+                field.frombytes(part)
+                setattr(store, name, field)
+        return store
+
+    def write(self, handle, block=0):
+        """
+        Encode the octree to ``handle`` (anything with ``write``, e.g. a
+        :class:`redeclipse.BlockWriter`), or only the children array
+        starting at node ``block`` and everything below it
+        """
+        octsav = self.octsav
+        child = self.child
+        edges = self.edges
+        textures = self.textures
+        write = handle.write
+        stack = [(block, 0)]
+        while stack:
+            block, start = stack.pop()
+            for node in range(block + start, block + 8):
+                o = octsav[node]
+                kind = o & 0x7
+                if kind == OCTSAV_CHILDREN:
+                    write(CHILDREN_BYTE)
+                    if node < block + 7:
+                        stack.append((block, node - block + 1))
+                    stack.append((child[node], 0))
+                    break
+                elif kind == OCTSAV_NORMAL:
+                    data = octsav[node:node + 1] + edges[12 * node:12 * node + 12] + textures[12 * node:12 * node + 12]
+                elif kind in (OCTSAV_EMPTY, OCTSAV_SOLID, OCTSAV_LODCUBE):
+                    data = octsav[node:node + 1] + textures[12 * node:12 * node + 12]
+                else:
+                    raise ValueError("Invalid octsav %d of node %d" % (o, node))
+
+                if o & 0xE0:
+                    if o & 0x40:
+                        data += USHORT.pack(self.material[node])
+                    if o & 0x80:
+                        data += self.merged[node:node + 1]
+                    if o & 0x20:
+                        mask = self.surfmask[node]
+                        data += SURFHEADER.pack(mask, self.totalverts[node])
+                        surfaces = self.surfaces[24 * node:24 * node + 24]
+                        if mask == 63 and surfaces == TEXCUBE_SURFACES:
+                            data += surfaces
+                        else:
+                            for j in range(6):
+                                if mask & (1 << j):
+                                    if surfaces[4 * j + 2]:
+                                        raise NotImplementedError("Gross out")
+                                    data += surfaces[4 * j:4 * j + 4]
+                write(data)
+
+    def validate(self, size):
+        """
+        Fix up the octree exactly like ``cube.validatec`` does for the
+        object tree: children of unit cubes are dropped (the cube is made
+        solid) and leaves larger than 0x1000 are split. validatec also
+        empties leaves with an invalid face, but that only changes their
+        ``faces``, which are neither stored here nor written, so their
+        octsav and edges are left alone.
+
+        :param size: Size of the root cubes, i.e. half the world size
+        :type size: int
+        """
+        octsav = self.octsav
+        child = self.child
+        stack = [(0, size)]
+        while stack:
+            block, size = stack.pop()
+            for node in range(block, block + 8):
+                if child[node] >= 0:
+                    if size <= 1:
+                        child[node] = -1
+                        octsav[node] = OCTSAV_SOLID
+                        self.edges[12 * node:12 * node + 12] = BLOCK_EDGES[:12]
+                    else:
+                        stack.append((child[node], size >> 1))
+                elif size > 0x1000:
+                    first = self.alloc()
+                    for j in range(8):
+                        self.copy_node(node, first + j)
+                    child[node] = first
+                    octsav[node] = OCTSAV_CHILDREN
+                    stack.append((first, size >> 1))
+
+    def leaves(self, size):
+        """
+        Every leaf of the octree and where it is. The tree is walked a
+        whole level at a time with NumPy instead of node by node, which is
+        what makes traversals of big stores fast. The per node fields of
+        the leaves can then be picked from the buffers, e.g.
+        ``np.frombuffer(store.octsav, np.uint8)[nodes]``.
+
+        :param size: Size of the root cubes, i.e. half the world size
+        :type size: int
+
+        :returns: the nodes, lowest corners (N x 3) and sizes of the leaves
+        :rtype: tuple(numpy.ndarray)
+        """
+        child = np.frombuffer(self.child, dtype=np.intc)
+        nodes = np.arange(8)
+        corners = CORNERS * size
+        found = ([], [], [])
+        while len(nodes):
+            first = child[nodes]
+            leaf = first < 0
+            found[0].append(nodes[leaf])
+            found[1].append(corners[leaf])
+            found[2].append(np.full(np.count_nonzero(leaf), size))
+            size >>= 1
+            nodes = (first[~leaf, None] + np.arange(8)).reshape(-1)
+            corners = (corners[~leaf, None, :] + CORNERS * size).reshape(-1, 3)
+        return tuple(np.concatenate(part) for part in found)
+
+    def copy_node(self, src, dst):
+        """Copy the fields (not the children) of node src to node dst"""
+        self.octsav[dst] = self.octsav[src]
+        self.edges[12 * dst:12 * dst + 12] = self.edges[12 * src:12 * src + 12]
+        self.textures[12 * dst:12 * dst + 12] = self.textures[12 * src:12 * src + 12]
+        self.material[dst] = self.material[src]
+        self.merged[dst] = self.merged[src]
+        self.surfmask[dst] = self.surfmask[src]
+        self.totalverts[dst] = self.totalverts[src]
+        self.surfaces[24 * dst:24 * dst + 24] = self.surfaces[24 * src:24 * src + 24]
+
+    def set_cube(self, node, c):
+        """Store the fields of cube c (not its children) in node"""
+        self.octsav[node] = c.octsav
+        if c.octsav & 0x7 == OCTSAV_NORMAL:
+            EDGES.pack_into(self.edges, 12 * node, *c.edges)
+        TEXTURE.pack_into(self.textures, 12 * node, *[t.value if isinstance(t, TextNum) else t for t in c.texture])
+        if c.octsav & 0x40:
+            self.material[node] = c.material
+        if c.octsav & 0x80:
+            self.merged[node] = c.merged
+        if c.octsav & 0x20:
+            self.surfmask[node] = c.surfmask
+            self.totalverts[node] = c.totalverts
+            for j in range(6):
+                if c.surfmask & (1 << j):
+                    surf = c.ext.surfaces[j]
+                    pos = 24 * node + 4 * j
+                    self.surfaces[pos:pos + 4] = bytes((surf.lmid[0], surf.lmid[1], surf.verts, surf.numverts))
+
+    def get_cube(self, node, textures=None):
+        """
+        A new cube with the fields (not the children) of node. Like the
+        parser it shares the surfaces of textured cubes, and the textures
+        through the ``textures`` dict if given.
+        """
+        # cube.newcube() with its faces set directly, this is called for
+        # every node
+        c = cube()
+        o = self.octsav[node]
+        c.octsav = o
+        kind = o & 0x7
+        if kind == OCTSAV_NORMAL:
+            c.faces = EMPTY_FACES
+            c.edges = EDGES.unpack_from(self.edges, 12 * node)
+        elif kind == OCTSAV_SOLID:
+            c.faces = SOLID_FACES
+        else:
+            c.faces = EMPTY_FACES
+        if kind == OCTSAV_LODCUBE:
+            c.haschildren = True
+        if kind != OCTSAV_CHILDREN:
+            # Not saved for a node with children, the parser leaves the
+            # default too
+            texture = TEXTURE.unpack_from(self.textures, 12 * node)
+            c.texture = texture if textures is None else textures.setdefault(texture, texture)
+        if o & 0x40:
+            c.material = self.material[node]
+        if o & 0x80:
+            c.merged = self.merged[node]
+        if o & 0x20:
+            mask = self.surfmask[node]
+            c.surfmask = mask
+            c.totalverts = self.totalverts[node]
+            if mask == 63 and not c.totalverts and self.surfaces[24 * node:24 * node + 24] == TEXCUBE_SURFACES:
+                c.ext = TEXCUBE_EXT
+                return c
+            c.ext = cubext(maxverts=c.totalverts)
+            for j in range(6):
+                if mask & (1 << j):
+                    pos = 24 * node + 4 * j
+                    c.ext.surfaces.append(SurfaceInfo(*self.surfaces[pos:pos + 4]))
+                else:
+                    c.ext.surfaces.append(None)
+        return c
+
+    @classmethod
+    def from_walk(cls, walk):
+        """
+        Build a store from a preorder walk of the octree, starting with the
+        8 root cubes: ``OCT.OCTSAV_CHILDREN`` for a node with children
+        (which follow it), None for an empty leaf, or a cube. See
+        ``VoxelWorld.octree_walk``.
+        """
+        store = cls()
+        stack = [(0, 0)]
+        for item in walk:
+            block, i = stack.pop()
+            node = block + i
+            if i < 7:
+                stack.append((block, i + 1))
+            if item is OCT.OCTSAV_CHILDREN:
+                store.octsav[node] = OCTSAV_CHILDREN
+                first = store.alloc()
+                store.child[node] = first
+                stack.append((first, 0))
+            elif item is not None:
+                store.set_cube(node, item)
+        return store
+
+    @classmethod
+    def from_cubes(cls, cube_arr):
+        """Build a store from the 8 root cubes of an object octree"""
+        def walk():
+            stack = [iter(cube_arr)]
+            while stack:
+                c = next(stack[-1], None)
+                if c is None:
+                    stack.pop()
+                elif c.octsav & 0x7 == OCTSAV_CHILDREN:
+                    yield OCT.OCTSAV_CHILDREN
+                    stack.append(iter(c.children))
+                else:
+                    yield c
+        return cls.from_walk(walk())
+
+    def to_cubes(self):
+        """Build the equivalent octree of cube objects"""
+        textures = {}
+        root = [self.get_cube(node, textures) for node in range(8)]
+        stack = [(0, root)]
+        while stack:
+            block, cubes = stack.pop()
+            for i in range(8):
+                first = self.child[block + i]
+                if first >= 0:
+                    cubes[i].children = [self.get_cube(first + j, textures) for j in range(8)]
+                    stack.append((first, cubes[i].children))
+        return root
+
+
+class LazyCubes(object):
+    """
+    The 8 children (or root cubes) starting at node ``first`` of an
+    :class:`OctreeStore` as cube objects, which are only built on first
+    access. Their own children are again lazy. Behaves like the list of 8
+    cubes it stands in for, like :class:`redeclipse.LazyChildren` does for
+    a lazily parsed map.
+    """
+
+    def __init__(self, store, first):
+        self.store = store
+        self.first = first
+        self.cubes = None
+
+    @property
+    def loaded(self):
+        return self.cubes is not None
+
+    def load(self):
+        """Build the cubes, returns the list of them"""
+        if self.cubes is None:
+            store = self.store
+            cubes = []
+            for node in range(self.first, self.first + 8):
+                c = store.get_cube(node)
+                if store.child[node] >= 0:
+                    c.children = LazyCubes(store, store.child[node])
+                cubes.append(c)
+            self.cubes = cubes
+        return self.cubes
+
+    def __len__(self):
+        return 8
+
+    def __bool__(self):
+        return True
+
+    def __getitem__(self, i):
+        return self.load()[i]
+
+    def __setitem__(self, i, value):
+        self.load()[i] = value
+
+    def __iter__(self):
+        return iter(self.load())
+
+
+class CubeView(object):
+    """
+    A single node of an :class:`OctreeStore` with the attributes of a
+    :class:`redeclipse.objects.cube`. Views are created on demand, changes
+    go straight to the store.
+    """
+    __slots__ = ('store', 'node')
+
+    def __init__(self, store, node):
+        self.store = store
+        self.node = node
+
+    @property
+    def octsav(self):
+        return self.store.octsav[self.node]
+
+    @octsav.setter
+    def octsav(self, value):
+        self.store.octsav[self.node] = value
+
+    @property
+    def children(self):
+        """
+        The 8 children as views, or None. A tuple: the children are always
+        the store's, change them through the views or :meth:`set_cube`.
+        """
+        first = self.store.child[self.node]
+        if first < 0:
+            return None
+        return tuple(CubeView(self.store, first + j) for j in range(8))
+
+    @property
+    def texture(self):
+        return TEXTURE.unpack_from(self.store.textures, 12 * self.node)
+
+    @texture.setter
+    def texture(self, value):
+        TEXTURE.pack_into(self.store.textures, 12 * self.node, *[t.value if isinstance(t, TextNum) else t for t in value])
+
+    @property
+    def edges(self):
+        return EDGES.unpack_from(self.store.edges, 12 * self.node)
+
+    @edges.setter
+    def edges(self, value):
+        EDGES.pack_into(self.store.edges, 12 * self.node, *value)
+
+    @property
+    def material(self):
+        return self.store.material[self.node]
+
+    @material.setter
+    def material(self, value):
+        self.store.material[self.node] = value
+
+    @property
+    def merged(self):
+        return self.store.merged[self.node]
+
+    @merged.setter
+    def merged(self, value):
+        self.store.merged[self.node] = value
+
+    @property
+    def surfmask(self):
+        return self.store.surfmask[self.node]
+
+    @property
+    def totalverts(self):
+        return self.store.totalverts[self.node]
+
+    @property
+    def ext(self):
+        """A copy of the surfaces, change them with :meth:`set_cube`"""
+        if not self.octsav & 0x20:
+            return None
+        return self.store.get_cube(self.node).ext
+
+    def to_cube(self):
+        """The fields of this node as a new cube, without children"""
+        return self.store.get_cube(self.node)
+
+    def to_dict(self, children=True):
+        """The node as a dictionary, like :meth:`redeclipse.objects.cube.to_dict`"""
+        d = self.to_cube().to_dict(children=False)
+        if children:
+            d['children'] = [x.to_dict() for x in self.children] if self.children else []
+        return d
+
+    def set_cube(self, c):
+        """Replace the fields of this node with those of cube c"""
+        self.store.set_cube(self.node, c)
@@ -0,0 +1,97 @@
+"""
+Block parallel gzip compression, in the style of pigz.
+
+The stream is cut into fixed size blocks which are deflated independently
+on a thread pool (zlib releases the GIL while compressing). Every block is
+primed with the last 32KiB of the previous one as a preset dictionary, so
+the ratio stays close to that of a single stream, and ends on a sync flush
+so the raw deflate outputs can simply be concatenated. The result is one
+ordinary gzip member that ``gzip``/``zlib`` (and the engine) read as usual.
+"""
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DICT_SIZE = 32 * 1024
+
+
+def _deflate(block, zdict, level):
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipFile(object):
+    """
+    Write only gzip file compressing blocks on ``threads`` threads.
+
+    :param path: Path to write to
+    :type path: str
+
+    :param compresslevel: gzip compression level
+    :type compresslevel: int
+
+    :param threads: Number of compression threads
+    :type threads: int
+
+    :param block_size: Size of the independently compressed blocks
+    :type block_size: int
+    """
+
+    def __init__(self, path, compresslevel=9, threads=4, block_size=1 << 18):
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.handle = open(path, 'wb')
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        # Compressed blocks, in order. Bounded so memory stays a few blocks
+        # per thread.
+        self.pending = deque()
+        self.max_pending = 2 * threads
+        self.block = bytearray()
+        self.zdict = b''
+        self.crc = 0
+        self.size = 0
+        # gzip header: magic, deflate, no flags, mtime, max compression, unix
+        self.handle.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, int(time.time()), 2 if compresslevel == 9 else 0, 3))
+
+    def write(self, data):
+        self.block += data
+        while len(self.block) >= self.block_size:
+            self._submit(bytes(self.block[:self.block_size]))
+            del self.block[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(self.pool.submit(_deflate, block, self.zdict, self.compresslevel))
+        self.zdict = block[-DICT_SIZE:]
+        while len(self.pending) > self.max_pending:
+            self.handle.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.handle is None:
+            return
+        try:
+            if self.block:
+                self._submit(bytes(self.block))
+                self.block = bytearray()
+            while self.pending:
+                self.handle.write(self.pending.popleft().result())
+            # Empty final block terminates the deflate stream
+            self.handle.write(zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH))
+            self.handle.write(struct.pack('<II', self.crc, self.size & 0xffffffff))
+        finally:
+            self.pool.shutdown()
+            self.handle.close()
+            self.handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
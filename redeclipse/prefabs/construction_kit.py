@@ -126,6 +126,28 @@ def wall_points(size, direction, limit_j=100, limit_i=100):
                 yield FineVector(size - 1, i, j)
 
 
+def cube_bounds(x, y, z):
+    """
+    The box drawn by ``cube_points(x, y, z)``.
+
+    :returns: Its lowest corner and the corner above it (exclusive)
+    :rtype: tuple(redeclipse.vector.FineVector)
+    """
+    def axis(n):
+        if n > 0:
+            return 0, n
+        else:
+            return n + 1, 1
+
+    (x_lower_bound, x_upper_bound) = axis(x)
+    (y_lower_bound, y_upper_bound) = axis(y)
+    (z_lower_bound, z_upper_bound) = axis(z)
+    return (
+        FineVector(x_lower_bound, y_lower_bound, z_lower_bound),
+        FineVector(x_upper_bound, y_upper_bound, z_upper_bound),
+    )
+
+
 def cube_points(x, y, z):
     """
     Yield points needed to draw a rectangular prism or cube.
@@ -140,31 +162,25 @@ def cube_points(x, y, z):
     :returns: An iterable of FineVectors
     :rtype: list(redeclipse.vector.FineVector)
     """
-    if x > 0:
-        x_lower_bound = 0
-        x_upper_bound = x
-    else:
-        x_lower_bound = x + 1
-        x_upper_bound = 1
+    (lower, upper) = cube_bounds(x, y, z)
+    for i in range(lower.x, upper.x):
+        for j in range(lower.y, upper.y):
+            for k in range(lower.z, upper.z):
+                yield FineVector(i, j, k)
 
-    if y > 0:
-        y_lower_bound = 0
-        y_upper_bound = y
-    else:
-        y_lower_bound = y + 1
-        y_upper_bound = 1
 
-    if z > 0:
-        z_lower_bound = 0
-        z_upper_bound = z
-    else:
-        z_lower_bound = z + 1
-        z_upper_bound = 1
+def box_points(boxes):
+    """
+    Yield the points of (lower, upper) boxes, as ``cube_points`` does.
 
-    for i in range(x_lower_bound, x_upper_bound):
-        for j in range(y_lower_bound, y_upper_bound):
-            for k in range(z_lower_bound, z_upper_bound):
-                yield FineVector(i, j, k)
+    :returns: An iterable of FineVectors
+    :rtype: list(redeclipse.vector.FineVector)
+    """
+    for (lower, upper) in boxes:
+        for i in range(int(upper.x - lower.x)):
+            for j in range(int(upper.y - lower.y)):
+                for k in range(int(upper.z - lower.z)):
+                    yield lower + FineVector(i, j, k)
 
 
 def subtract_or_skip(subtract, prob):
@@ -211,6 +227,16 @@ class ConstructionKitMixin(object):
         if 'prob' in kwargs:
             del kwargs['prob']
 
+        # Boxes are filled in bulk, unless points are skipped at random
+        boxes = getattr(self, 'box_' + construction, None)
+        if boxes is not None and prob >= 1 and hasattr(world, 'fill_box'):
+            for (lower, upper) in boxes(*args, **kwargs):
+                if subtract:
+                    world.clear_box(lower, upper)
+                else:
+                    world.fill_box(lower, upper, tex=tex)
+            return
+
         for point in func(*args, **kwargs):
             if subtract_or_skip(subtract, prob):
                 world.del_pointv(point)
@@ -241,34 +267,56 @@ class ConstructionKitMixin(object):
                 yield point + local_position
 
     def x_ceiling(self, offset, size=ROOM_SIZE):
-        yield from self.x_rectangular_prism(offset + FineVector(0, 0, 7), FineVector(size, size, 1))
+        yield from box_points(self.box_ceiling(offset, size))
 
     def x_floor(self, offset, size=ROOM_SIZE):
-        yield from self.x_rectangular_prism(offset, FineVector(size, size, 1))
+        yield from box_points(self.box_floor(offset, size))
 
     def x_low_wall(self, offset, face):
-        yield from self.x_wall(offset, face, limit_j=3)
+        yield from box_points(self.box_low_wall(offset, face))
 
     def x_wall(self, offset, face, limit_j=8):
+        yield from box_points(self.box_wall(offset, face, limit_j))
+
+    def x_ring(self, offset, size):
+        yield from box_points(self.box_ring(offset, size))
+
+    def x_rectangular_prism(self, offset, xyz):
+        yield from box_points(self.box_rectangular_prism(offset, xyz))
+
+    # The constructions above which are made of boxes, as (lower, upper)
+    # pairs. ``x`` fills these in bulk. A single cube is quicker to set as a
+    # point, it has none.
+
+    def box_ceiling(self, offset, size=ROOM_SIZE):
+        yield from self.box_rectangular_prism(offset + FineVector(0, 0, 7), FineVector(size, size, 1))
+
+    def box_floor(self, offset, size=ROOM_SIZE):
+        yield from self.box_rectangular_prism(offset, FineVector(size, size, 1))
+
+    def box_low_wall(self, offset, face):
+        yield from self.box_wall(offset, face, limit_j=3)
+
+    def box_wall(self, offset, face, limit_j=8):
         if face == EAST:
-            yield from self.x_rectangular_prism(offset + FineVector(7, 0, 0), FineVector(1, 8, limit_j))
+            yield from self.box_rectangular_prism(offset + FineVector(7, 0, 0), FineVector(1, 8, limit_j))
         elif face == WEST:
-            yield from self.x_rectangular_prism(offset + FineVector(0, 0, 0), FineVector(1, 8, limit_j))
+            yield from self.box_rectangular_prism(offset + FineVector(0, 0, 0), FineVector(1, 8, limit_j))
         elif face == NORTH:
-            yield from self.x_rectangular_prism(offset + FineVector(0, 7, 0), FineVector(8, 1, limit_j))
+            yield from self.box_rectangular_prism(offset + FineVector(0, 7, 0), FineVector(8, 1, limit_j))
         elif face == SOUTH:
-            yield from self.x_rectangular_prism(offset + FineVector(0, 0, 0), FineVector(8, 1, limit_j))
+            yield from self.box_rectangular_prism(offset + FineVector(0, 0, 0), FineVector(8, 1, limit_j))
 
-    def x_ring(self, offset, size):
+    def box_ring(self, offset, size):
         # world, FineVector(-2, -2, i), 12, tex=accent_tex)
-        yield from self.x_rectangular_prism(offset, FineVector(1, size - 1, 1))
-        yield from self.x_rectangular_prism(offset, FineVector(size - 1, 1, 1))
-        yield from self.x_rectangular_prism(offset + FineVector(0, size - 1, 0), FineVector(size, 1, 1))
-        yield from self.x_rectangular_prism(offset + FineVector(size - 1, 0, 0), FineVector(1, size, 1))
+        yield from self.box_rectangular_prism(offset, FineVector(1, size - 1, 1))
+        yield from self.box_rectangular_prism(offset, FineVector(size - 1, 1, 1))
+        yield from self.box_rectangular_prism(offset + FineVector(0, size - 1, 0), FineVector(size, 1, 1))
+        yield from self.box_rectangular_prism(offset + FineVector(size - 1, 0, 0), FineVector(1, size, 1))
 
-    def x_rectangular_prism(self, offset, xyz):
+    def box_rectangular_prism(self, offset, xyz):
         xyz = xyz.rotate(self.orientation).vox()
         local_position = self.pos + offset.offset_rotate(self.orientation, offset=TILE_VOX_OFF)
 
-        for point in cube_points(xyz.x, xyz.y, xyz.z):
-            yield point + local_position
+        (lower, upper) = cube_bounds(xyz.x, xyz.y, xyz.z)
+        yield (local_position + lower, local_position + upper)
@@ -33,8 +33,9 @@ class MagicaRoom(Room):
         self._colours = {}
         for vox in self.model.model_voxels.voxels:
             self.vox.set_point(vox.x, vox.y, vox.z, vox.c)
-            # For every colour in the palette, register it with the current
-            # class's colour atlas (non-global colour atlas).
+        # For every colour in the palette, register it with the current
+        # class's colour atlas (non-global colour atlas).
+        if self.model.model_voxels.voxels:
             for idx, colour in enumerate(self.model.palette.colours):
                 self._colours[idx] = (colour.r / 255, colour.g / 255, colour.b / 255)
 
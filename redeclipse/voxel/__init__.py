@@ -4,18 +4,65 @@ We can't work with octrees. Just... no.
 So we work in a voxel world, and then convert this to an octree with the small
 resolution cube that makes sense, and then let RE optimise the map when need be.
 """
-from redeclipse.objects import cube
+import itertools
+import os
+from bisect import bisect_left
+from redeclipse import leafkey
+from redeclipse.objects import cube, EMPTY
 from redeclipse.enums import OCT
+from redeclipse.octree import OctreeStore
+from redeclipse.voxel.chunked import ChunkedStorage, INDEX_DTYPE, _cell
+from redeclipse.voxel.disk import DiskChunkedStorage
+from redeclipse.voxel.overlay import OverlayStorage, DELETED
+from redeclipse.voxel.visibility import is_opaque, flood_fill, hidden, FACES, face, pad, shifted
+from redeclipse.voxel.morton import (  # noqa: F401
+    morton_encode, morton_decode, morton_encode_array, morton_decode_array,
+    MortonIndex, MORTON_MAX
+)
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import logging
 log = logging.getLogger(__name__)
+#: Yielded by ``VoxelWorld.octree_walk`` for a node split into 8 children
+OCTREE_CHILDREN = OCT.OCTSAV_CHILDREN
+#: Most blocks ``VoxelWorld.cull_hidden`` keeps one flag each for, over the
+#: bounds of the world's solid voxels
+CULL_BLOCK_LIMIT = 1 << 24
 
 
 class VoxelWorld:
+    """
+    :param size: Number of cubes from left to right
+    :type size: int
 
-    def __init__(self, size=2**7):
+    :param chunked: Keep the voxels in a
+                    :class:`redeclipse.voxel.chunked.ChunkedStorage` rather
+                    than a dict, a few bytes per voxel and with bulk array
+                    access
+    :type chunked: bool
+
+    :param morton_index: Keep a :class:`redeclipse.voxel.morton.MortonIndex`
+                         of the voxels in ``index``, for octree cell and
+                         bounding box queries
+    :type morton_index: bool
+
+    :param path: Keep the voxels in a
+                 :class:`redeclipse.voxel.disk.DiskChunkedStorage` in this
+                 file, for worlds larger than memory. An existing file is
+                 opened with its voxels. Call ``close`` when done.
+    :type path: str
+    """
+
+    def __init__(self, size=2**7, chunked=False, morton_index=False, path=None):
         # Size defines number of cubes from left to right.
         self.size = size
-        self.world = {}
+        if path is not None:
+            self.world = DiskChunkedStorage(path)
+        else:
+            self.world = ChunkedStorage() if chunked else {}
+        self.index = MortonIndex() if morton_index else None
+        #: The world an overlay was made on, see ``overlay``
+        self.parent = None
 
         # Boundaries
         self.xmax = 0
@@ -25,6 +72,23 @@ class VoxelWorld:
         self.zmax = 0
         self.zmin = size
 
+        if path is not None:
+            bounds = self.world.meta.get('bounds')
+            if bounds is not None:
+                (self.xmin, self.xmax, self.ymin, self.ymax, self.zmin, self.zmax) = bounds
+            if self.index is not None:
+                self.index.add_array(self.world.occupied()[0])
+
+    def flush(self):
+        """Save a world kept in a file (see ``path``)"""
+        self.world.meta['bounds'] = (self.xmin, self.xmax, self.ymin, self.ymax, self.zmin, self.zmax)
+        self.world.flush()
+
+    def close(self):
+        """Save and close a world kept in a file (see ``path``)"""
+        self.flush()
+        self.world.close()
+
     def _update_boundaries(self, x, y, z):
         if x > self.xmax:
             self.xmax = x
@@ -43,21 +107,26 @@ class VoxelWorld:
         log.debug("set_point (%d, %d, %d)", x, y, z)
         self._update_boundaries(x, y, z)
         self.world[x, y, z] = data
+        if self.index is not None:
+            self.index.add((x, y, z))
 
     def set_pointv(self, xyz, data):
         log.debug("set_point %s", xyz)
         self._update_boundaries(xyz.x, xyz.y, xyz.z)
         self.world[tuple(xyz)] = data
+        if self.index is not None:
+            self.index.add(tuple(xyz))
 
     def del_point(self, x, y, z):
         log.debug("del_point (%d, %d, %d)", x, y, z)
         if (x, y, z) in self.world:
             del self.world[x, y, z]
+            if self.index is not None:
+                self.index.discard((x, y, z))
 
     def del_pointv(self, xyz):
         (x, y, z) = xyz
-        if (x, y, z) in self.world:
-            del self.world[x, y, z]
+        self.del_point(x, y, z)
 
     def get_point(self, x, y, z):
         if (x, y, z) in self.world:
@@ -65,7 +134,753 @@ class VoxelWorld:
         else:
             return None
 
-    def to_octree(self, x_bounds=None, y_bounds=None, z_bounds=None, layers=False):
+    # Bulk operations. These write straight into the storage, with one
+    # boundary update per call and no logging per point.
+
+    def _fill_value(self, data, tex):
+        if tex is not None:
+            return cube.newtexcube(tex=tex)
+        return data
+
+    def fill_box(self, lower, upper, data=None, tex=None):
+        """
+        Set every cell with ``lower <= (x, y, z) < upper``
+
+        :param lower: Lowest corner of the box
+        :type lower: tuple or redeclipse.vector.FineVector
+
+        :param upper: Corner above the box (exclusive)
+        :type upper: tuple or redeclipse.vector.FineVector
+
+        :param data: Value to store
+        :param tex: Store ``cube.newtexcube(tex=tex)`` instead
+        :type tex: int or list
+        """
+        lower, upper, shape = _box(lower, upper)
+        if shape is None:
+            return
+        value = self._fill_value(data, tex)
+        if shape == (1, 1, 1):
+            # Not worth the arrays
+            self._update_boundaries(*lower)
+            self.world[lower] = value
+            if self.index is not None:
+                self.index.add(lower)
+            return
+        self._update_boundaries(*lower)
+        self._update_boundaries(*[u - 1 for u in upper])
+        if self.chunked:
+            index = self.world.palette_index(value)
+            self.world.set_block(lower, np.full(shape, index, dtype=INDEX_DTYPE))
+        else:
+            self.world.update(dict.fromkeys(_box_keys(lower, upper), value))
+        if self.index is not None:
+            self.index.add_array(_box_coords(lower, shape))
+
+    def fill_column(self, x, y, z_start, z_end, data=None, tex=None):
+        """
+        Set the cells ``(x, y, z)`` for ``z_start <= z < z_end``, see
+        ``fill_box``
+        """
+        self.fill_box((x, y, z_start), (x + 1, y + 1, z_end), data=data, tex=tex)
+
+    def clear_box(self, lower, upper, mask=None):
+        """
+        Delete every cell with ``lower <= (x, y, z) < upper``
+
+        :param mask: Only delete where this array (of the box's shape,
+                     indexed [x, y, z]) is True
+        :type mask: numpy.ndarray
+        """
+        lower, upper, shape = _box(lower, upper)
+        if shape is None:
+            return
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            count = int(np.count_nonzero(mask))
+        else:
+            count = shape[0] * shape[1] * shape[2]
+        if self.chunked:
+            self.world.clear_block(lower, shape, mask)
+        elif count <= len(self.world):
+            keys = _box_keys(lower, upper) if mask is None else _keys(np.argwhere(mask) + lower)
+            for key in keys:
+                self.world.pop(key, None)
+        else:
+            for key in list(self.world):
+                if all(lo <= k < up and k == int(k) for (lo, k, up) in zip(lower, key, upper)):
+                    if mask is None or mask[tuple(int(k) - lo for (k, lo) in zip(key, lower))]:
+                        del self.world[key]
+        if self.index is not None:
+            if mask is None:
+                self.index.discard_array(_box_coords(lower, shape))
+            else:
+                self.index.discard_array(np.argwhere(mask) + lower)
+
+    def paste(self, offset, textures, rotate=0, mask=None):
+        """
+        Stamp an array into the world with its ``[0, 0, 0]`` cell at
+        ``offset``.
+
+        :param textures: Array indexed [x, y, z] of texture numbers (cells
+                         below 0 are skipped) or of voxel values (None is
+                         skipped)
+        :type textures: numpy.ndarray
+
+        :param rotate: Number of 90 degree turns around the z axis,
+                       counterclockwise like ``FineVector.rotate``. The
+                       rotated array still starts at ``offset``.
+        :type rotate: int
+
+        :param mask: Only paste where this is True
+        :type mask: numpy.ndarray
+        """
+        textures = np.asarray(textures)
+        if textures.dtype == object:
+            keep = textures != None  # noqa: E711
+        else:
+            keep = textures >= 0
+        if mask is not None:
+            keep &= np.asarray(mask, dtype=bool)
+        if rotate % 4:
+            textures = np.rot90(textures, rotate, axes=(0, 1))
+            keep = np.rot90(keep, rotate, axes=(0, 1))
+        offset = _corner(offset)
+
+        cells = np.argwhere(keep)
+        if not len(cells):
+            return
+        coords = cells + offset
+        self._update_boundaries(*coords.min(axis=0).tolist())
+        self._update_boundaries(*coords.max(axis=0).tolist())
+
+        # One value per distinct texture (or object)
+        if textures.dtype == object:
+            values = []
+            seen = {}
+            inverse = []
+            for value in textures[keep].tolist():
+                if id(value) not in seen:
+                    seen[id(value)] = len(values)
+                    values.append(value)
+                inverse.append(seen[id(value)])
+            inverse = np.array(inverse, dtype=np.intp)
+        else:
+            distinct, inverse = np.unique(textures[keep], return_inverse=True)
+            values = [cube.newtexcube(tex=int(tex)) for tex in distinct.tolist()]
+
+        if self.chunked:
+            lookup = np.array([self.world.palette_index(value) for value in values], dtype=INDEX_DTYPE)
+            data = np.zeros(textures.shape, dtype=INDEX_DTYPE)
+            data[keep] = lookup[inverse.reshape(-1)]
+            self.world.set_block(offset, data, keep)
+        else:
+            self.world.update(zip(
+                _keys(coords),
+                [values[i] for i in inverse.reshape(-1).tolist()]
+            ))
+        if self.index is not None:
+            self.index.add_array(coords)
+
+    # Culling
+
+    def cull_hidden(self, seeds=(), data=None, tex=None, uniform=False):
+        """
+        Remove the solid voxels which can not be seen: those without a face
+        next to air reachable from outside the world's bounds or from one
+        of the seeds. Run before ``to_octree`` or writing the map.
+
+        A map that is closed all around (see ``aftereffects.box``) has no
+        air reachable from outside, give the places players can be as
+        seeds (e.g. the spawn points) or everything inside goes.
+
+        The world is worked on a block (chunk) at a time, the memory needed
+        follows the blocks holding solid voxels, not the bounds. Raises
+        ValueError if the solid voxels are spread over more than
+        ``CULL_BLOCK_LIMIT`` blocks' worth of bounds.
+
+        :param seeds: Cells (x, y, z) in the air players can reach
+        :type seeds: list
+
+        :param data: Replace the hidden voxels with this (or a cube of
+                     texture ``tex``) instead of removing them, a uniform
+                     solid collapses into larger cubes (see ``to_octree``)
+        :type data: object
+
+        :param uniform: Replace the hidden voxels with the value most of
+                        them have, the interior then mostly collapses with
+                        what is already there
+        :type uniform: bool
+
+        :returns: The number of hidden voxels
+        :rtype: int
+        """
+        blocks = _Blocks(self)
+        size = blocks.size
+        occupied = set(bkey for bkey in blocks.arrays if blocks.opaque(bkey).any())
+        if not occupied:
+            return 0
+
+        grid = _BlockGrid(occupied)
+        start = {}
+        for seed in seeds:
+            cell = tuple(int(s) for s in seed)
+            bkey = tuple(c // size for c in cell)
+            if bkey in occupied:
+                if bkey not in start:
+                    start[bkey] = np.zeros((size, size, size), dtype=bool)
+                start[bkey][tuple(c % size for c in cell)] = True
+            else:
+                grid.enter(bkey)
+        cells = _reach(blocks, occupied, grid, start)
+
+        def hide(bkey):
+            layers = []
+            for (axis, step) in FACES:
+                nkey = _neighbour(bkey, axis, step)
+                if nkey in occupied:
+                    near = cells.get(nkey)
+                    layers.append(False if near is None else near[face(axis, -step)])
+                else:
+                    layers.append(grid.reached(nkey))
+            own = cells.get(bkey)
+            if own is None:
+                own = np.zeros((size, size, size), dtype=bool)
+            return hidden(pad(blocks.opaque(bkey), [False] * 6), pad(own, layers))[1:-1, 1:-1, 1:-1]
+
+        value = self._fill_value(data, tex)
+        if uniform:
+            counts = np.zeros(len(blocks.palette), dtype=np.int64)
+            for bkey in occupied:
+                indices = blocks.arrays[bkey][0]
+                counts += np.bincount(indices[hide(bkey)], minlength=len(counts))[:len(counts)]
+            if counts.any():
+                value = blocks.palette[int(counts.argmax())]
+
+        count = 0
+        for bkey in sorted(occupied):
+            where = hide(bkey)
+            coords = np.argwhere(where) + blocks.origin(bkey)
+            if not len(coords):
+                continue
+            count += len(coords)
+            if value is None:
+                if self.chunked:
+                    self.world.clear_block(blocks.origin(bkey), where.shape, where)
+                else:
+                    for key in _keys(coords):
+                        del self.world[key]
+                if self.index is not None:
+                    self.index.discard_array(coords)
+            else:
+                self._set_grid(blocks.origin(bkey), where, [value], np.zeros(where.shape, dtype=np.uint8))
+        return count
+
+    def _set_grid(self, lower, where, values, indices):
+        """
+        Set the cells of the block at ``lower`` where ``where`` is True to
+        ``values[indices]``
+        """
+        if self.chunked:
+            lookup = np.array([self.world.palette_index(value) for value in values], dtype=INDEX_DTYPE)
+            self.world.set_block(lower, lookup[indices], where)
+        else:
+            for (key, i) in zip(_keys(np.argwhere(where) + lower), indices[where].tolist()):
+                self.world[key] = values[i]
+
+    # Snapshots and overlays
+
+    def _derive(self, world):
+        """A world of the same size and bounds, on the given storage"""
+        other = VoxelWorld(self.size)
+        other.world = world
+        other._copy_boundaries(self)
+        other.index = None if self.index is None else self.index.copy()
+        return other
+
+    def _copy_boundaries(self, other):
+        (self.xmin, self.xmax, self.ymin, self.ymax, self.zmin, self.zmax) = \
+            (other.xmin, other.xmax, other.ymin, other.ymax, other.zmin, other.zmax)
+
+    def snapshot(self):
+        """
+        An independent copy of the world, to experiment on.
+
+        For a chunked world this is O(1), the chunks are shared until either
+        world writes to them. A dict world is copied (the voxel values are
+        shared).
+        """
+        if isinstance(self.world, (ChunkedStorage, OverlayStorage)):
+            return self._derive(self.world.snapshot())
+        return self._derive(dict(self.world))
+
+    def overlay(self):
+        """
+        A layer on top of this world: it reads through to this world, but
+        its changes are kept apart until ``flatten`` applies them or
+        ``drop`` discards them. Layers can be stacked.
+        """
+        layer = self._derive(OverlayStorage(self.world))
+        layer.parent = self
+        return layer
+
+    def flatten(self):
+        """
+        Apply the changes of this overlay to the world underneath, and
+        start over with an empty overlay
+        """
+        if self.parent is None:
+            raise ValueError("Not an overlay")
+        parent = self.parent
+        for (key, value) in self.world.changes.items():
+            if value is DELETED:
+                parent.del_pointv(key)
+            else:
+                parent.world[key] = value
+                if parent.index is not None:
+                    parent.index.add(key)
+        # The overlay's boundaries started out as the parent's
+        parent.xmin = min(parent.xmin, self.xmin)
+        parent.ymin = min(parent.ymin, self.ymin)
+        parent.zmin = min(parent.zmin, self.zmin)
+        parent.xmax = max(parent.xmax, self.xmax)
+        parent.ymax = max(parent.ymax, self.ymax)
+        parent.zmax = max(parent.zmax, self.zmax)
+        self.world.clear_changes()
+
+    def drop(self):
+        """
+        Discard the changes of this overlay, it shows the world underneath
+        again
+        """
+        if self.parent is None:
+            raise ValueError("Not an overlay")
+        self.world.clear_changes()
+        self._copy_boundaries(self.parent)
+        self.index = None if self.parent.index is None else self.parent.index.copy()
+
+    @property
+    def chunked(self):
+        return isinstance(self.world, ChunkedStorage)
+
+    def _octree_items(self):
+        """
+        (key, value) of the voxels ``to_octree`` would pick up: inside the
+        world, integer coordinates and not None.
+        """
+        size = self.size
+        if self.chunked:
+            coords, indices = self.world.occupied()
+            inside = ((coords >= 0) & (coords < size)).all(axis=1)
+            palette = self.world.palette
+            items = []
+            for (key, index) in zip(_keys(coords[inside]), indices[inside].tolist()):
+                value = palette[index]
+                if value is not None:
+                    items.append((key, value))
+            return items
+
+        items = []
+        for (key, value) in self.world.items():
+            if value is None:
+                continue
+            if all(0 <= k < size and k == int(k) for k in key):
+                items.append((key, value))
+        return items
+
+    def octree_walk(self, collapse=False):
+        """
+        Walk the world in octree order without building any cube objects,
+        only the occupied parts of the world are visited.
+
+        Starting with the 8 root cubes it yields, depth first, the same
+        structure ``to_octree`` builds: ``OCTREE_CHILDREN`` for a node that
+        is split into its 8 children (which follow it), None for an empty
+        subtree and the stored data for an occupied unit cube (or a
+        collapsed octant, see ``to_octree``).
+        """
+        if self.chunked and self._chunk_walkable():
+            for node in self._chunked_walk(collapse):
+                yield node
+            return
+
+        # Explicit stack of (x, y, z, size, items) for the nodes still to do
+        stack = []
+        merge_keys = {}
+        empty_key = _merge_key(EMPTY)
+
+        def uniform(items, size):
+            # The value the octant collapses to: None if it only holds
+            # empty leaves, else the value of the first item. False if it
+            # does not collapse. Same result as merging bottom-up.
+            first = None
+            for (key, value) in items:
+                try:
+                    mkey = merge_keys[id(value)]
+                except KeyError:
+                    mkey = merge_keys[id(value)] = _merge_key(value)
+                if mkey is None or (first is not None and mkey != first):
+                    return False
+                first = mkey
+            if first == empty_key:
+                return None
+            if len(items) == size ** 3:
+                return items[0][1]
+            return False
+
+        def push_children(x0, y0, z0, size, items):
+            half = size >> 1
+            xm = x0 + half
+            ym = y0 + half
+            zm = z0 + half
+            parts = [[], [], [], [], [], [], [], []]
+            for item in items:
+                key = item[0]
+                parts[(key[0] >= xm) | ((key[1] >= ym) << 1) | ((key[2] >= zm) << 2)].append(item)
+            for i in range(7, -1, -1):
+                stack.append((
+                    xm if i & 1 else x0,
+                    ym if i & 2 else y0,
+                    zm if i & 4 else z0,
+                    half,
+                    parts[i]
+                ))
+
+        push_children(0, 0, 0, self.size, self._octree_items())
+        while stack:
+            (x0, y0, z0, size, items) = stack.pop()
+            if not items:
+                yield None
+            elif size == 1:
+                yield items[0][1]
+            else:
+                if collapse and size < self.size >> 1:
+                    leaf = uniform(items, size)
+                    if leaf is not False:
+                        yield leaf
+                        continue
+                yield OCTREE_CHILDREN
+                push_children(x0, y0, z0, size, items)
+
+    def _chunk_walkable(self):
+        size = self.size
+        return size >= 2 and not size & (size - 1) and size >= 2 * self.world.chunk_size
+
+    def _chunked_walk(self, collapse=False):
+        """
+        ``octree_walk`` of a chunked world, one chunk at a time: above the
+        chunk size the nodes are split by chunk coordinates, inside a chunk
+        by its arrays. Only the chunks of the node being walked are read,
+        so this works for worlds much larger than memory.
+        """
+        storage = self.world
+        cs = storage.chunk_size
+        shift = storage.shift
+        # Chunks along an edge of the world
+        extent = self.size >> shift
+        palette = storage.palette
+        valid = np.array([value is not None for value in palette] or [False])
+
+        # Merge classes by palette index: 0 is empty (or no voxel), -1 does
+        # not merge, leaves merging with each other share a class
+        classes = None
+        if collapse:
+            empty_key = _merge_key(EMPTY)
+            ids = {empty_key: 0}
+            found = []
+            for value in palette:
+                mkey = _merge_key(value)
+                if mkey is None:
+                    found.append(-1)
+                else:
+                    found.append(ids.setdefault(mkey, len(ids)))
+            classes = np.array(found or [-1], dtype=np.int64)
+
+        def pyramid(chunk):
+            # Occupancy and merge class of the nodes of every size in a
+            # chunk, as nested lists by size
+            mask = chunk.mask & valid[chunk.data]
+            occupied = {}
+            uniform = {}
+            cls = None
+            if collapse:
+                cls = np.where(mask, classes[chunk.data], 0)
+            size = 1
+            while size <= cs:
+                n = cs // size
+                if size == 1:
+                    occ = mask
+                else:
+                    occ = mask.reshape(n, size, n, size, n, size).any(axis=(1, 3, 5))
+                occupied[size] = occ.tolist()
+                if collapse:
+                    if size > 1:
+                        blocks = cls.reshape(n, 2, n, 2, n, 2).transpose(0, 2, 4, 1, 3, 5).reshape(n, n, n, 8)
+                        first = blocks[..., 0]
+                        cls = np.where((blocks == first[..., None]).all(axis=-1), first, -1)
+                    uniform[size] = cls.tolist()
+                size <<= 1
+            return mask, occupied, uniform
+
+        chunk_classes = {}
+
+        def chunk_class(ckey):
+            if ckey not in chunk_classes:
+                chunk_classes[ckey] = pyramid(storage.chunks[ckey])[2][cs][0][0][0]
+            return chunk_classes[ckey]
+
+        def uniform_above(ckeys, size):
+            # The class of a node of several chunks, -1 if it is not uniform
+            first = None
+            for ckey in ckeys:
+                c = chunk_class(ckey)
+                if c == -1 or (first is not None and c != first):
+                    return -1
+                first = c
+            if first == 0 or len(ckeys) == (size >> shift) ** 3:
+                return first
+            return -1
+
+        def walk_chunk(ckey, top_collapse):
+            chunk = storage.chunks[ckey]
+            mask, occupied, uniform = pyramid(chunk)
+            stack = [(0, 0, 0, cs)]
+            top = True
+            while stack:
+                (x, y, z, size) = stack.pop()
+                if not occupied[size][x // size][y // size][z // size]:
+                    yield None
+                elif size == 1:
+                    yield palette[chunk.data[x, y, z]]
+                else:
+                    if collapse and (top_collapse or not top):
+                        c = uniform[size][x // size][y // size][z // size]
+                        if c == 0:
+                            yield None
+                            continue
+                        elif c > 0:
+                            yield palette[chunk.data[x, y, z]]
+                            continue
+                    yield OCTREE_CHILDREN
+                    half = size >> 1
+                    for i in range(7, -1, -1):
+                        stack.append((
+                            x + half if i & 1 else x,
+                            y + half if i & 2 else y,
+                            z + half if i & 4 else z,
+                            half
+                        ))
+                top = False
+
+        # Chunk keys inside the world
+        ckeys = [
+            ckey for ckey in storage.chunks
+            if 0 <= ckey[0] < extent and 0 <= ckey[1] < extent and 0 <= ckey[2] < extent
+        ]
+        if not valid.all():
+            # Chunks of None values only count as empty
+            ckeys = [ckey for ckey in ckeys if valid[storage.chunks[ckey].data[storage.chunks[ckey].mask]].any()]
+        # Explicit stack of (x, y, z, size, chunk keys), in chunks
+        stack = []
+
+        def push_children(x0, y0, z0, size, keys):
+            half = size >> 1
+            xm = x0 + half
+            ym = y0 + half
+            zm = z0 + half
+            parts = [[], [], [], [], [], [], [], []]
+            for key in keys:
+                parts[(key[0] >= xm) | ((key[1] >= ym) << 1) | ((key[2] >= zm) << 2)].append(key)
+            for i in range(7, -1, -1):
+                stack.append((
+                    xm if i & 1 else x0,
+                    ym if i & 2 else y0,
+                    zm if i & 4 else z0,
+                    half,
+                    parts[i]
+                ))
+
+        push_children(0, 0, 0, extent, ckeys)
+        while stack:
+            (x0, y0, z0, size, keys) = stack.pop()
+            if not keys:
+                yield None
+            elif size == 1:
+                # Root octants are never collapsed
+                for node in walk_chunk(keys[0], cs < self.size >> 1):
+                    yield node
+            else:
+                if collapse and size < extent >> 1:
+                    c = uniform_above(keys, size << shift)
+                    if c == 0:
+                        yield None
+                        continue
+                    elif c > 0:
+                        yield palette[storage.chunks[keys[0]].data[0, 0, 0]]
+                        continue
+                yield OCTREE_CHILDREN
+                push_children(x0, y0, z0, size, keys)
+
+    def to_store(self, collapse=False):
+        """
+        The octree as an :class:`redeclipse.octree.OctreeStore`, built
+        from ``octree_walk`` without creating cube objects
+        """
+        return OctreeStore.from_walk(self.octree_walk(collapse=collapse))
+
+    def to_octree(self, x_bounds=None, y_bounds=None, z_bounds=None, layers=False, collapse=False, workers=1, split=1):
+        """
+        Build the octree of cube objects for the world: the list of the 8
+        root cubes.
+
+        Only the occupied parts of the world are built. The keys are sorted
+        by Morton code once (or taken from ``index``), after which the
+        voxels of every octant are a contiguous run of them. Empty octants
+        become the shared ``objects.EMPTY`` leaf. The root cubes are never
+        shared, callers like to modify those.
+
+        :param collapse: Merge octants bottom-up: one whose 8 children are
+                         the same solid leaf becomes that leaf, one with only
+                         empty children becomes empty. Only the canonical
+                         leaves (see ``redeclipse.leafkey``) with the same
+                         material are merged, their textures and surfaces
+                         do not depend on the size of the cube. The 8 root
+                         cubes are never merged.
+        :type collapse: bool
+
+        :param workers: Number of processes building the octants, None for
+                        one per CPU. With 1 everything is built in this
+                        process.
+        :type workers: int
+
+        :param split: With several workers, the world is cut into the
+                      ``8 ** split`` octants ``split`` levels down, each
+                      built by a worker from arrays of Morton codes and
+                      palette indices. The levels above are put together
+                      here.
+        :type split: int
+        """
+        size = self.size
+        if x_bounds is not None or size < 2 or size & (size - 1):
+            # A part of the world, or one that cannot be split evenly
+            return self._to_octree_dense(x_bounds, y_bounds, z_bounds)
+
+        depth = size.bit_length() - 1
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers != 1 and size <= MORTON_MAX:
+            return self._to_octree_parallel(depth, collapse, workers, min(max(split, 1), depth))
+
+        if self.index is not None and size <= MORTON_MAX:
+            codes, values = self._indexed_items()
+        elif size <= MORTON_MAX:
+            codes, indices, palette = self._octree_arrays()
+            codes = codes.tolist()
+            values = [palette[i] for i in indices.tolist()]
+        else:
+            keyed = sorted(
+                ((morton_encode(int(key[0]), int(key[1]), int(key[2])), value) for (key, value) in self._octree_items()),
+                key=lambda item: item[0]
+            )
+            codes = [code for (code, value) in keyed]
+            values = [value for (code, value) in keyed]
+
+        root = _OctreeBuilder(codes, values, depth, collapse).children(0, len(codes), 0, depth)
+        return _own_root(root)
+
+    def _octree_arrays(self):
+        """
+        Sorted Morton codes (uint64 array) of the voxels ``to_octree``
+        would pick up, their palette indices and the palette
+        """
+        if self.chunked:
+            coords, indices = self.world.occupied()
+            palette = self.world.palette
+            inside = ((coords >= 0) & (coords < self.size)).all(axis=1)
+            valid = np.array([value is not None for value in palette] or [False])
+            inside &= valid[indices]
+            coords = coords[inside]
+            indices = indices[inside]
+        else:
+            if self.index is not None and self.size <= MORTON_MAX:
+                codes, values = self._indexed_items()
+                coords = morton_decode_array(np.array(codes, dtype=np.uint64))
+            else:
+                items = self._octree_items()
+                coords = np.array([key for (key, value) in items], dtype=np.int64).reshape(-1, 3)
+                values = [value for (key, value) in items]
+            # Group the values by identity, they need not be hashable
+            palette = []
+            seen = {}
+            indices = np.empty(len(values), dtype=np.uint32)
+            for (i, value) in enumerate(values):
+                try:
+                    indices[i] = seen[id(value)]
+                except KeyError:
+                    indices[i] = seen[id(value)] = len(palette)
+                    palette.append(value)
+        codes = morton_encode_array(coords)
+        order = np.argsort(codes, kind='stable')
+        return codes[order], indices[order], palette
+
+    def _to_octree_parallel(self, depth, collapse, workers, split):
+        codes, indices, palette = self._octree_arrays()
+        level = depth - split
+        step = 1 << (3 * level)
+        bounds = np.searchsorted(codes, np.arange(8 ** split + 1, dtype=np.uint64) * np.uint64(step)).tolist()
+
+        # (octant, has voxels) in Morton order, the levels above are
+        # built from them here
+        nodes = [(EMPTY, False)] * (8 ** split)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for i in range(8 ** split):
+                (lo, hi) = (bounds[i], bounds[i + 1])
+                if lo < hi:
+                    part = indices[lo:hi]
+                    used = np.unique(part)
+                    futures[i] = (used, pool.submit(
+                        _build_octant, codes[lo:hi], np.searchsorted(used, part).astype(np.uint32),
+                        [palette[j] for j in used.tolist()], i * step, level, depth, collapse
+                    ))
+            for (i, (used, future)) in futures.items():
+                nodes[i] = (_decode_octant(future.result(), used, palette), True)
+
+        builder = _OctreeBuilder((), (), depth, collapse)
+        while level < depth - 1:
+            level += 1
+            parents = []
+            for i in range(0, len(nodes), 8):
+                group = nodes[i:i + 8]
+                if not any(full for (node, full) in group):
+                    parents.append((EMPTY, False))
+                else:
+                    parents.append((builder.node([node for (node, full) in group], level), True))
+            nodes = parents
+        return _own_root([node for (node, full) in nodes])
+
+    def _indexed_items(self):
+        """
+        Morton codes and values of the voxels ``to_octree`` would pick up,
+        straight from the sorted index
+        """
+        codes = self.index.sorted_codes()
+        # Inside the world exactly when below size ** 3
+        codes = codes[:int(np.searchsorted(codes, np.uint64(self.size ** 3)))]
+        world = self.world
+        kept = []
+        values = []
+        for (code, key) in zip(codes.tolist(), morton_decode_array(codes).tolist()):
+            value = world[tuple(key)]
+            if value is not None:
+                kept.append(code)
+                values.append(value)
+        return kept, values
+
+    def _to_octree_dense(self, x_bounds=None, y_bounds=None, z_bounds=None):
+        """
+        The original to_octree, visiting every cell of the given bounds
+        """
         if x_bounds is None:
             x_bounds = (
                 0, self.size
@@ -84,59 +899,396 @@ class VoxelWorld:
             return self.get_point(x_bounds[0], y_bounds[0], z_bounds[0])
 
         # Otherwise, split into 8 smaller cubes
-        current_level_cubes = [
-            self.to_octree(
-                (x_bounds[0], (sum(x_bounds) // 2)),
-                (y_bounds[0], (sum(y_bounds) // 2)),
-                (z_bounds[0], (sum(z_bounds) // 2))
-            ),
-            self.to_octree(
-                ((sum(x_bounds) // 2), x_bounds[1]),
-                (y_bounds[0], (sum(y_bounds) // 2)),
-                (z_bounds[0], (sum(z_bounds) // 2))
-            ),
-            self.to_octree(
-                (x_bounds[0], (sum(x_bounds) // 2)),
-                ((sum(y_bounds) // 2), y_bounds[1]),
-                (z_bounds[0], (sum(z_bounds) // 2))
-            ),
-            self.to_octree(
-                ((sum(x_bounds) // 2), x_bounds[1]),
-                ((sum(y_bounds) // 2), y_bounds[1]),
-                (z_bounds[0], (sum(z_bounds) // 2))
-            ),
-            self.to_octree(
-                (x_bounds[0], (sum(x_bounds) // 2)),
-                (y_bounds[0], (sum(y_bounds) // 2)),
-                ((sum(z_bounds) // 2), z_bounds[1])
-            ),
-            self.to_octree(
-                ((sum(x_bounds) // 2), x_bounds[1]),
-                (y_bounds[0], (sum(y_bounds) // 2)),
-                ((sum(z_bounds) // 2), z_bounds[1])
-            ),
-            self.to_octree(
-                (x_bounds[0], (sum(x_bounds) // 2)),
-                ((sum(y_bounds) // 2), y_bounds[1]),
-                ((sum(z_bounds) // 2), z_bounds[1])
-            ),
-            self.to_octree(
-                ((sum(x_bounds) // 2), x_bounds[1]),
-                ((sum(y_bounds) // 2), y_bounds[1]),
-                ((sum(z_bounds) // 2), z_bounds[1])
-            )
-            # new cube * 8
-        ]
+        current_level_cubes = []
+        for i in range(8):
+            current_level_cubes.append(self._to_octree_dense(
+                ((sum(x_bounds) // 2), x_bounds[1]) if i & 1 else (x_bounds[0], (sum(x_bounds) // 2)),
+                ((sum(y_bounds) // 2), y_bounds[1]) if i & 2 else (y_bounds[0], (sum(y_bounds) // 2)),
+                ((sum(z_bounds) // 2), z_bounds[1]) if i & 4 else (z_bounds[0], (sum(z_bounds) // 2)),
+            ))
 
         # Worldroot is an array not a cube
         if x_bounds[0] == 0 and x_bounds[1] == self.size:
-            return [cube.newcube() if x is None else x for x in current_level_cubes]
+            return _own_root([EMPTY if x is None else x for x in current_level_cubes])
         elif all([x is None for x in current_level_cubes]):
             # If they're all empty, return
             return None
         else:
             # Some of them are non-empty, replace the others with empty cubes.
             c = cube.newcube()
-            c.children = [cube.newcube() if x is None else x for x in current_level_cubes]
+            c.children = [EMPTY if x is None else x for x in current_level_cubes]
             c.octsav = OCT.OCTSAV_CHILDREN.value
             return c
+
+
+class _OctreeBuilder(object):
+    """
+    Builds the nodes of ``to_octree`` from the Morton codes (sorted) and
+    values of the voxels in a world of ``2 ** depth`` cubes
+    """
+
+    def __init__(self, codes, values, depth, collapse):
+        self.codes = codes
+        self.values = values
+        self.depth = depth
+        self.collapse = collapse
+        self.merge_keys = {}
+
+    def merged(self, nodes):
+        # The leaf 8 identical leaves collapse to, or None
+        first = None
+        for node in nodes:
+            try:
+                mkey = self.merge_keys[id(node)]
+            except KeyError:
+                mkey = self.merge_keys[id(node)] = _merge_key(node)
+            if mkey is None or (first is not None and mkey != first):
+                return None
+            first = mkey
+        return nodes[0]
+
+    def node(self, nodes, level):
+        """The node of the given level with these 8 children"""
+        if self.collapse and level < self.depth - 1:
+            leaf = self.merged(nodes)
+            if leaf is not None:
+                return leaf
+        c = cube.newcube()
+        c.children = nodes
+        c.octsav = OCT.OCTSAV_CHILDREN.value
+        return c
+
+    def build(self, lo, hi, base, level):
+        # Node covering the codes [base, base + 8 ** level), holding the
+        # voxels lo:hi
+        if level == 0:
+            return self.values[lo]
+        return self.node(self.children(lo, hi, base, level), level)
+
+    def children(self, lo, hi, base, level):
+        codes = self.codes
+        step = 1 << (3 * (level - 1))
+        result = []
+        for i in range(8):
+            end = bisect_left(codes, base + step, lo, hi)
+            result.append(EMPTY if lo == end else self.build(lo, end, base, level - 1))
+            lo = end
+            base += step
+        return result
+
+
+# The octants built by the workers are sent back as a preorder array of
+# palette indices and these
+_OCTANT_CHILDREN = -1
+_OCTANT_EMPTY = -2
+
+
+def _build_octant(codes, indices, palette, base, level, depth, collapse):
+    """
+    Build one octant of ``to_octree`` in a worker process, as a preorder
+    array of palette indices, ``_OCTANT_CHILDREN`` and ``_OCTANT_EMPTY``
+    """
+    values = [palette[i] for i in indices.tolist()]
+    node = _OctreeBuilder(codes.tolist(), values, depth, collapse).build(0, len(values), base, level)
+    ids = {id(value): i for (i, value) in enumerate(palette)}
+    result = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        index = ids.get(id(node))
+        if index is not None:
+            result.append(index)
+        elif node is EMPTY:
+            result.append(_OCTANT_EMPTY)
+        else:
+            result.append(_OCTANT_CHILDREN)
+            stack.extend(reversed(node.children))
+    return np.array(result, dtype=np.int32)
+
+
+def _decode_octant(encoded, used, palette):
+    """The octant ``_build_octant`` built, from this process' palette"""
+    # Leaves by index, _OCTANT_EMPTY (-2) picks the last entry
+    leaves = [palette[i] for i in used.tolist()] + [EMPTY, EMPTY]
+    children = OCT.OCTSAV_CHILDREN.value
+    # Backwards through the preorder the 8 children of a node are on top
+    # of the stack, first child last
+    stack = []
+    for index in reversed(encoded.tolist()):
+        if index == _OCTANT_CHILDREN:
+            c = cube.newcube()
+            c.children = stack[:-9:-1]
+            del stack[-8:]
+            c.octsav = children
+            stack.append(c)
+        else:
+            stack.append(leaves[index])
+    return stack[0]
+
+
+def _merge_key(value):
+    """
+    What leaves must share to be merged into one larger cube, None if the
+    value is not a canonical leaf
+    """
+    if not isinstance(value, cube) or value.children:
+        return None
+    key = leafkey(value)
+    if key is None:
+        return None
+    return (key, value.material)
+
+
+def _corner(point):
+    """Integer coordinates of a box corner"""
+    corner = tuple(int(c) for c in point)
+    if any(c != p for (c, p) in zip(corner, point)):
+        raise ValueError("Box corners must be at integer coordinates: %s" % (point, ))
+    return corner
+
+
+def _box(lower, upper):
+    """Integer corners and the shape of a box, None if it is empty"""
+    lower = _corner(lower)
+    upper = _corner(upper)
+    shape = tuple(u - l for (l, u) in zip(lower, upper))
+    if min(shape) <= 0:
+        return lower, upper, None
+    return lower, upper, shape
+
+
+def _box_keys(lower, upper):
+    return itertools.product(*[range(l, u) for (l, u) in zip(lower, upper)])
+
+
+def _own_root(root):
+    """
+    The 8 root cubes of an octree with the shared ones (see
+    ``cube.mutable``) replaced by cubes of their own, callers like to
+    modify those
+    """
+    return [cube.newcube() if x is EMPTY else x.mutable() if isinstance(x, cube) else x for x in root]
+
+
+class _Blocks(object):
+    """
+    The voxels of a world at integer coordinates in cubic blocks, to work
+    on them a block at a time: the chunks of a chunked world, else blocks
+    of 16^3. ``arrays`` maps the key of each block (its lowest corner over
+    the block size) to the palette indices and the occupancy mask of its
+    cells, indexed [x, y, z].
+    """
+
+    def __init__(self, world):
+        if world.chunked:
+            storage = world.world
+            self.size = storage.chunk_size
+            self.palette = storage.palette
+            self.arrays = {ckey: (chunk.data, chunk.mask) for (ckey, chunk) in storage.chunks.items()}
+        else:
+            self.size = 16
+            self.palette = []
+            self.arrays = {}
+            self._group(world.world)
+        self._opaque = np.zeros(0, dtype=bool)
+
+    def _group(self, world):
+        # Group the values by identity, they need not be hashable
+        seen = {}
+        cells = []
+        found = []
+        for (key, value) in world.items():
+            key = _cell(key)
+            if key is not None:
+                index = seen.get(id(value))
+                if index is None:
+                    index = seen[id(value)] = len(self.palette)
+                    self.palette.append(value)
+                found.append(index)
+                cells.append(key)
+        if not cells:
+            return
+        coords = np.array(cells, dtype=np.int64)
+        found = np.array(found, dtype=np.min_scalar_type(len(self.palette)))
+        bkeys = coords // self.size
+        order = np.lexsort(bkeys.T[::-1])
+        bkeys = bkeys[order]
+        local = (coords[order] - bkeys * self.size).astype(np.uint8)
+        found = found[order]
+        starts = np.flatnonzero(np.concatenate([[True], (bkeys[1:] != bkeys[:-1]).any(axis=1)]))
+        ends = np.append(starts[1:], len(bkeys))
+        shape = (self.size, ) * 3
+        for (bkey, i, j) in zip(_keys(bkeys[starts]), starts.tolist(), ends.tolist()):
+            indices = np.zeros(shape, dtype=found.dtype)
+            mask = np.zeros(shape, dtype=bool)
+            where = tuple(local[i:j].T)
+            indices[where] = found[i:j]
+            mask[where] = True
+            self.arrays[bkey] = (indices, mask)
+
+    def origin(self, bkey):
+        """Lowest corner of a block"""
+        return tuple(k * self.size for k in bkey)
+
+    def opaque(self, bkey, where=Ellipsis):
+        """
+        The opaque cells of a block (or the part ``where`` of it), all
+        False for a block without voxels
+        """
+        arrays = self.arrays.get(bkey)
+        if arrays is None:
+            return np.zeros((self.size, ) * 3, dtype=bool)[where]
+        # Values set since are looked up too
+        if len(self._opaque) < len(self.palette):
+            added = [is_opaque(value) for value in self.palette[len(self._opaque):]]
+            self._opaque = np.append(self._opaque, np.array(added, dtype=bool))
+        (indices, mask) = arrays
+        return mask[where] & self._opaque[indices[where]]
+
+
+def _neighbour(bkey, axis, step):
+    """The key of the block next to a block"""
+    key = list(bkey)
+    key[axis] += step
+    return tuple(key)
+
+
+class _BlockGrid(object):
+    """
+    Which of the blocks without opaque voxels ``VoxelWorld.cull_hidden``
+    reached, one flag per block over the bounds of the occupied ones with
+    a layer of outside around them. The layers of blocks between two that
+    hold occupied blocks are squeezed into one: all of it is reached from
+    outside, so far apart voxels only cost the layers they are in.
+    """
+
+    def __init__(self, occupied):
+        keys = np.array(sorted(occupied), dtype=np.int64)
+        # Grid index of the kept layers by block coordinate, per axis
+        self.index = []
+        self.coords = []
+        for axis in range(3):
+            index = {}
+            coords = [None]
+            for k in np.unique(keys[:, axis]).tolist():
+                if coords[-1] is not None and k > coords[-1] + 1:
+                    coords.append(None)
+                index[k] = len(coords)
+                coords.append(k)
+            coords.append(None)
+            self.index.append(index)
+            self.coords.append(coords)
+        shape = tuple(len(coords) for coords in self.coords)
+        if int(np.prod(shape, dtype=np.float64)) > CULL_BLOCK_LIMIT:
+            raise ValueError("Too many blocks to cull the world in, %s" % (shape, ))
+        self.free = np.ones(shape, dtype=bool)
+        for bkey in _keys(keys):
+            self.free[self.local(bkey)] = False
+        self.flags = np.ones(shape, dtype=bool)
+        self.flags[1:-1, 1:-1, 1:-1] = False
+        self.entered = set()
+
+    def local(self, bkey):
+        """Grid index of a block, None if it is in a squeezed layer"""
+        try:
+            return tuple(index[k] for (index, k) in zip(self.index, bkey))
+        except KeyError:
+            return None
+
+    def reached(self, bkey):
+        local = self.local(bkey)
+        return True if local is None else bool(self.flags[local])
+
+    def enter(self, bkey):
+        """Mark an empty block reached on the next ``fill``"""
+        local = self.local(bkey)
+        if local is not None and not self.flags[local]:
+            self.entered.add(local)
+
+    def fill(self):
+        """
+        Spread the reached flags over the empty blocks, returns the keys
+        of the occupied blocks next to newly reached ones
+        """
+        before = self.flags
+        self.flags = before.copy()
+        for local in self.entered:
+            self.flags[local] = True
+        self.entered = set()
+        self.flags = flood_fill(self.free, self.flags)
+        added = self.flags & ~before
+        near = np.zeros(added.shape, dtype=bool)
+        for (axis, step) in FACES:
+            near |= shifted(added, axis, step)
+        return set(
+            tuple(coords[i] for (coords, i) in zip(self.coords, local))
+            for local in _keys(np.argwhere(near & ~self.free))
+        )
+
+
+def _reach(blocks, occupied, grid, start):
+    """
+    The cells of the occupied blocks reachable from outside or the seeds.
+
+    The blocks are filled one at a time from what their neighbours reached
+    on their faces, those whose faces gained cells are filled again, until
+    nothing changes. The blocks without opaque voxels are filled all at
+    once on ``grid``, a :class:`_BlockGrid`.
+
+    :returns: Reached cells by block key, only of blocks with any
+    :rtype: dict
+    """
+    size = blocks.size
+    cells = {}
+    grid.fill()
+    todo = set(occupied)
+    while todo:
+        more = set()
+        for bkey in sorted(todo):
+            seed = start.get(bkey)
+            seed = np.zeros((size, size, size), dtype=bool) if seed is None else seed.copy()
+            old = cells.get(bkey)
+            if old is not None:
+                seed |= old
+            for (axis, step) in FACES:
+                nkey = _neighbour(bkey, axis, step)
+                if nkey in occupied:
+                    near = cells.get(nkey)
+                    if near is not None:
+                        seed[face(axis, step)] |= near[face(axis, -step)]
+                elif grid.reached(nkey):
+                    seed[face(axis, step)] = True
+            new = flood_fill(~blocks.opaque(bkey), seed)
+            if not new.any() or (old is not None and np.array_equal(new, old)):
+                continue
+            cells[bkey] = new
+            for (axis, step) in FACES:
+                side = new[face(axis, step)]
+                if old is not None:
+                    side = side & ~old[face(axis, step)]
+                if not side.any():
+                    continue
+                nkey = _neighbour(bkey, axis, step)
+                if nkey in occupied:
+                    more.add(nkey)
+                else:
+                    grid.enter(nkey)
+        if grid.entered:
+            more |= grid.fill()
+        todo = more
+    return cells
+
+
+def _keys(coords):
+    """
+    The (x, y, z) tuples of an N x 3 array. Converting it column by column
+    creates far fewer objects than ``tolist()`` of the rows, which matters
+    once the world holds millions of keys (the garbage collector visits
+    them all).
+    """
+    return zip(*np.asarray(coords).reshape(-1, 3).T.tolist())
+
+
+def _box_coords(lower, shape):
+    """N x 3 array of the cells of a box"""
+    return np.indices(shape).reshape(3, -1).T + lower
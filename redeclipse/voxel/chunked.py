@@ -0,0 +1,344 @@
+"""
+Chunked storage for the voxels of a :class:`redeclipse.voxel.VoxelWorld`.
+
+The world is cut into cubic chunks (16^3 by default) which are allocated
+when the first voxel in them is set. A chunk holds a small integer array
+of indices into the storage's palette of distinct voxel values, plus a
+boolean occupancy mask. As voxels are nearly always one of a few shared
+cubes (see ``cube.newtexcube``) this is a few bytes per voxel, and whole
+chunks can be processed with NumPy at once.
+
+The storage is a mapping of ``(x, y, z)`` to value like the plain dict it
+replaces. Keys that are not integer coordinates are kept in a plain dict
+on the side.
+
+``snapshot()`` is O(1): both storages share every chunk until one of them
+writes to it, then that storage copies the chunk (copy on write).
+"""
+from collections.abc import MutableMapping
+
+import numpy as np
+
+#: dtype of the palette indices
+INDEX_DTYPE = np.uint16
+
+
+class Chunk(object):
+    __slots__ = ('data', 'mask', 'count')
+
+    def __init__(self, size):
+        self.data = np.zeros((size, size, size), dtype=INDEX_DTYPE)
+        self.mask = np.zeros((size, size, size), dtype=bool)
+        self.count = 0
+
+    def copy(self):
+        chunk = Chunk.__new__(Chunk)
+        chunk.data = self.data.copy()
+        chunk.mask = self.mask.copy()
+        chunk.count = self.count
+        return chunk
+
+
+def _cell(key):
+    """Integer coordinates of a key, or None if it is not a cell"""
+    x, y, z = key
+    if type(x) is int and type(y) is int and type(z) is int:
+        return key
+    try:
+        if x == int(x) and y == int(y) and z == int(z):
+            return (int(x), int(y), int(z))
+    except (TypeError, ValueError, OverflowError):
+        pass
+    return None
+
+
+class ChunkedStorage(MutableMapping):
+    """
+    Mapping of ``(x, y, z)`` to voxel value, stored in lazily allocated
+    chunks of palette indices.
+
+    :param chunk_size: Edge length of a chunk, a power of two
+    :type chunk_size: int
+    """
+
+    def __init__(self, chunk_size=16):
+        if chunk_size < 1 or chunk_size & (chunk_size - 1):
+            raise ValueError("Chunk size must be a power of two")
+        self.chunk_size = chunk_size
+        self.shift = chunk_size.bit_length() - 1
+        #: Allocated chunks by chunk coordinate (x >> shift, ...)
+        self.chunks = {}
+        #: Distinct voxel values, indexed by the chunk data
+        self.palette = []
+        self._palette_index = {}
+        # Voxels at non integer coordinates
+        self.extra = {}
+        self._len = 0
+        # Keys of the chunks only this storage uses, the others are copied
+        # before writing to them
+        self._owned = set()
+        # The chunks and extra dicts are shared with a snapshot
+        self._shared = False
+
+    def snapshot(self):
+        """
+        A copy of the storage, sharing all chunks until they are written
+        to. The palette only ever grows, so it is simply shared.
+        """
+        other = ChunkedStorage.__new__(ChunkedStorage)
+        other.chunk_size = self.chunk_size
+        other.shift = self.shift
+        other.chunks = self.chunks
+        other.palette = self.palette
+        other._palette_index = self._palette_index
+        other.extra = self.extra
+        other._len = self._len
+        other._owned = set()
+        other._shared = True
+        self._owned = set()
+        self._shared = True
+        return other
+
+    def _unshare(self):
+        if self._shared:
+            self.chunks = dict(self.chunks)
+            self.extra = dict(self.extra)
+            self._shared = False
+
+    def _new_chunk(self):
+        return Chunk(self.chunk_size)
+
+    def _copy_chunk(self, chunk):
+        return chunk.copy()
+
+    def _writable(self, ckey, create=False):
+        """The chunk at ckey, copied first if it is shared"""
+        self._unshare()
+        chunk = self.chunks.get(ckey)
+        if chunk is None:
+            if not create:
+                return None
+            chunk = self.chunks[ckey] = self._new_chunk()
+        elif ckey not in self._owned:
+            chunk = self.chunks[ckey] = self._copy_chunk(chunk)
+        self._owned.add(ckey)
+        return chunk
+
+    def _drop(self, ckey):
+        del self.chunks[ckey]
+        self._owned.discard(ckey)
+
+    @staticmethod
+    def _palette_key(value):
+        try:
+            key = (type(value), value)
+            hash(key)
+        except TypeError:
+            # Unhashable, go by identity. The palette keeps it alive.
+            key = ('id', id(value))
+        return key
+
+    def palette_index(self, value):
+        """
+        Index of value in the palette, it is added if needed
+        """
+        key = self._palette_key(value)
+        try:
+            return self._palette_index[key]
+        except KeyError:
+            pass
+        index = len(self.palette)
+        if index > np.iinfo(INDEX_DTYPE).max:
+            raise ValueError("Too many distinct voxel values for a chunked world")
+        self.palette.append(value)
+        self._palette_index[key] = index
+        return index
+
+    def _locate(self, cell):
+        s = self.shift
+        m = self.chunk_size - 1
+        return (cell[0] >> s, cell[1] >> s, cell[2] >> s), (cell[0] & m, cell[1] & m, cell[2] & m)
+
+    def __getitem__(self, key):
+        cell = _cell(key)
+        if cell is None:
+            return self.extra[key]
+        ckey, local = self._locate(cell)
+        chunk = self.chunks.get(ckey)
+        if chunk is None or not chunk.mask[local]:
+            raise KeyError(key)
+        return self.palette[chunk.data[local]]
+
+    def __setitem__(self, key, value):
+        cell = _cell(key)
+        if cell is None:
+            self._unshare()
+            self.extra[key] = value
+            return
+        ckey, local = self._locate(cell)
+        chunk = self._writable(ckey, create=True)
+        if not chunk.mask[local]:
+            chunk.mask[local] = True
+            chunk.count += 1
+            self._len += 1
+        chunk.data[local] = self.palette_index(value)
+
+    def __delitem__(self, key):
+        cell = _cell(key)
+        if cell is None:
+            self._unshare()
+            del self.extra[key]
+            return
+        ckey, local = self._locate(cell)
+        chunk = self.chunks.get(ckey)
+        if chunk is None or not chunk.mask[local]:
+            raise KeyError(key)
+        if chunk.count == 1:
+            self._unshare()
+            self._drop(ckey)
+        else:
+            chunk = self._writable(ckey)
+            chunk.mask[local] = False
+            chunk.count -= 1
+        self._len -= 1
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for ((cx, cy, cz), chunk) in list(self.chunks.items()):
+            xs, ys, zs = np.nonzero(chunk.mask)
+            x0 = cx << self.shift
+            y0 = cy << self.shift
+            z0 = cz << self.shift
+            for (x, y, z) in zip(xs.tolist(), ys.tolist(), zs.tolist()):
+                yield (x0 + x, y0 + y, z0 + z)
+        for key in list(self.extra):
+            yield key
+
+    def __len__(self):
+        return self._len + len(self.extra)
+
+    # Bulk access
+
+    def chunk_items(self, writable=False):
+        """
+        Yield ``(origin, data, mask)`` for every allocated chunk, origin
+        being the coordinates of its lowest corner. The arrays are the
+        chunk's own: only change them with ``writable=True`` (which copies
+        shared chunks) and call :meth:`recount` after changing a mask.
+        """
+        for ckey in list(self.chunks):
+            chunk = self._writable(ckey) if writable else self.chunks[ckey]
+            yield (ckey[0] << self.shift, ckey[1] << self.shift, ckey[2] << self.shift), chunk.data, chunk.mask
+
+    def recount(self):
+        """Update the counts after masks were changed directly"""
+        self._len = 0
+        for ckey in list(self.chunks):
+            chunk = self.chunks[ckey]
+            count = int(np.count_nonzero(chunk.mask))
+            if not count:
+                self._unshare()
+                self._drop(ckey)
+            elif count != chunk.count:
+                self._writable(ckey).count = count
+            self._len += count
+
+    def occupied(self):
+        """
+        Coordinates (N x 3 array) and palette indices (N array) of all
+        voxels at integer coordinates
+        """
+        coords = []
+        indices = []
+        for (origin, data, mask) in self.chunk_items():
+            local = np.argwhere(mask)
+            coords.append(local + origin)
+            indices.append(data[mask])
+        if not coords:
+            return np.zeros((0, 3), dtype=np.int64), np.zeros(0, dtype=INDEX_DTYPE)
+        return np.concatenate(coords).astype(np.int64), np.concatenate(indices)
+
+    def _overlaps(self, origin, shape):
+        """
+        Yield (chunk key, chunk slice, block slice) for the chunks
+        overlapping the box at origin with the given shape
+        """
+        size = self.chunk_size
+        lo = [int(o) for o in origin]
+        hi = [o + int(n) for (o, n) in zip(lo, shape)]
+        ranges = [range(lo[d] >> self.shift, ((hi[d] - 1) >> self.shift) + 1) for d in range(3)]
+        for cx in ranges[0]:
+            for cy in ranges[1]:
+                for cz in ranges[2]:
+                    csl = []
+                    bsl = []
+                    for (d, c) in enumerate((cx, cy, cz)):
+                        start = max(lo[d], c * size)
+                        end = min(hi[d], (c + 1) * size)
+                        csl.append(slice(start - c * size, end - c * size))
+                        bsl.append(slice(start - lo[d], end - lo[d]))
+                    yield (cx, cy, cz), tuple(csl), tuple(bsl)
+
+    def get_block(self, origin, shape):
+        """
+        Palette indices and occupancy mask of the box of ``shape`` cells at
+        ``origin``, as dense arrays indexed [x, y, z]
+        """
+        data = np.zeros(shape, dtype=INDEX_DTYPE)
+        mask = np.zeros(shape, dtype=bool)
+        for (ckey, csl, bsl) in self._overlaps(origin, shape):
+            chunk = self.chunks.get(ckey)
+            if chunk is not None:
+                data[bsl] = chunk.data[csl]
+                mask[bsl] = chunk.mask[csl]
+        return data, mask
+
+    def set_block(self, origin, data, mask=None):
+        """
+        Set the cells of the box at ``origin`` to the palette indices in
+        ``data``, only where ``mask`` is True if it is given. See
+        :meth:`palette_index`.
+        """
+        data = np.asarray(data)
+        if mask is None:
+            mask = np.ones(data.shape, dtype=bool)
+        for (ckey, csl, bsl) in self._overlaps(origin, data.shape):
+            m = mask[bsl]
+            if not m.any():
+                continue
+            chunk = self._writable(ckey, create=True)
+            target = chunk.mask[csl]
+            added = int(np.count_nonzero(m & ~target))
+            chunk.data[csl] = np.where(m, data[bsl], chunk.data[csl])
+            chunk.mask[csl] = target | m
+            chunk.count += added
+            self._len += added
+
+    def clear_block(self, origin, shape, mask=None):
+        """
+        Remove the voxels in the box at ``origin``, only where ``mask`` is
+        True if it is given
+        """
+        for (ckey, csl, bsl) in self._overlaps(origin, shape):
+            chunk = self.chunks.get(ckey)
+            if chunk is None:
+                continue
+            target = chunk.mask[csl]
+            remove = target if mask is None else target & mask[bsl]
+            removed = int(np.count_nonzero(remove))
+            if not removed:
+                continue
+            self._len -= removed
+            if removed == chunk.count:
+                self._unshare()
+                self._drop(ckey)
+                continue
+            chunk = self._writable(ckey)
+            chunk.mask[csl] = target & ~remove
+            chunk.count -= removed
@@ -0,0 +1,274 @@
+"""
+Chunked voxel storage in a memory mapped file, for worlds larger than RAM.
+
+The chunks of a :class:`redeclipse.voxel.chunked.ChunkedStorage` are kept
+as fixed size records in a file, each record holding the palette indices
+of a chunk followed by its occupancy mask::
+
+    header    magic b'RVW1', chunk size, records per segment
+    record 0  data (chunk_size^3 uint16), mask (chunk_size^3 bool)
+    record 1  ...
+
+The file is mapped in segments of records, growing it maps another segment
+so the arrays of the chunks already handed out stay valid. Which records
+are in memory is left to the OS page cache: only the chunk directory (chunk
+coordinates to record), the palette and the non integer keys are kept in
+Python, and written to ``<path>.dir`` by :meth:`DiskChunkedStorage.flush`.
+
+A snapshot shares the file: both storages hold the records of the chunks
+they share, a storage writing to a record the other one holds copies it to
+a new record first. A record is free again once no storage holds it, when
+it is dropped or copied, or when a snapshot is closed or garbage collected.
+"""
+import os
+import pickle
+import struct
+import weakref
+
+import numpy as np
+
+from redeclipse.voxel.chunked import Chunk, ChunkedStorage, INDEX_DTYPE
+
+MAGIC = b'RVW1'
+HEADER = struct.Struct('<4sII')
+#: Bytes before the first record
+HEADER_SIZE = 64
+
+
+class DiskChunk(Chunk):
+    __slots__ = ('record', )
+
+
+class _Records(object):
+    """The records of a chunk file, shared by a storage and its snapshots"""
+
+    def __init__(self):
+        self.segments = []
+        #: Records in the file
+        self.count = 0
+        #: Records no storage holds
+        self.free = []
+        #: record -> number of storages holding it
+        self.refs = {}
+
+    def hold(self, records):
+        for record in records:
+            self.refs[record] = self.refs.get(record, 0) + 1
+
+    def release(self, records):
+        for record in records:
+            self.refs[record] -= 1
+            if not self.refs[record]:
+                del self.refs[record]
+                self.free.append(record)
+
+
+class DiskChunkedStorage(ChunkedStorage):
+    """
+    A :class:`redeclipse.voxel.chunked.ChunkedStorage` keeping its chunks
+    in a memory mapped file. An existing file is opened with the chunks it
+    holds, as of the last :meth:`flush`.
+
+    :param path: The chunk file, the directory goes next to it
+    :type path: str
+
+    :param chunk_size: Edge length of a chunk, a power of two. Ignored when
+                       opening an existing file.
+    :type chunk_size: int
+
+    :param segment_records: Number of records mapped at once
+    :type segment_records: int
+    """
+
+    def __init__(self, path, chunk_size=16, segment_records=256):
+        self.path = path
+        self.directory_path = path + '.dir'
+        #: Free form values saved with the directory, e.g. the bounds of
+        #: the world
+        self.meta = {}
+        self._file = _Records()
+        self._snapshot = False
+        self._hold(())
+        if os.path.exists(path):
+            with open(path, 'rb') as handle:
+                (magic, chunk_size, segment_records) = HEADER.unpack(handle.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError("Not a voxel chunk file: %s" % path)
+            super(DiskChunkedStorage, self).__init__(chunk_size)
+            self.segment_records = segment_records
+            self._load()
+        else:
+            super(DiskChunkedStorage, self).__init__(chunk_size)
+            self.segment_records = segment_records
+            with open(path, 'wb') as handle:
+                handle.write(HEADER.pack(MAGIC, chunk_size, segment_records).ljust(HEADER_SIZE, b'\0'))
+
+    def _hold(self, records):
+        """Hold records, until they are dropped or the storage goes away"""
+        self._held = set(records)
+        self._file.hold(self._held)
+        self._release_all = weakref.finalize(self, self._file.release, self._held)
+
+    def _release(self, record):
+        self._held.discard(record)
+        self._file.release((record, ))
+
+    def snapshot(self):
+        """
+        A copy of the storage in the same file, sharing all records until
+        either storage writes to them. The snapshot is not saved by
+        :meth:`flush`, it is dropped with its records when closed or
+        garbage collected.
+        """
+        other = DiskChunkedStorage.__new__(DiskChunkedStorage)
+        other.path = self.path
+        other.directory_path = self.directory_path
+        other.meta = dict(self.meta)
+        other.chunk_size = self.chunk_size
+        other.shift = self.shift
+        other.segment_records = self.segment_records
+        other.chunks = dict(self.chunks)
+        other.palette = self.palette
+        other._palette_index = self._palette_index
+        other.extra = dict(self.extra)
+        other._len = self._len
+        other._owned = set()
+        other._shared = False
+        other._file = self._file
+        other._snapshot = True
+        other._hold(self._held)
+        return other
+
+    @property
+    def cells(self):
+        return self.chunk_size ** 3
+
+    @property
+    def record_size(self):
+        return self.cells * (np.dtype(INDEX_DTYPE).itemsize + 1)
+
+    def _map_segment(self):
+        """Grow the file by a segment of records and map it"""
+        length = self.segment_records * self.record_size
+        offset = HEADER_SIZE + len(self._file.segments) * length
+        with open(self.path, 'r+b') as handle:
+            handle.seek(0, os.SEEK_END)
+            if handle.tell() < offset + length:
+                handle.truncate(offset + length)
+        self._file.segments.append(np.memmap(self.path, dtype=np.uint8, mode='r+', offset=offset, shape=(length, )))
+
+    def _chunk(self, record, count):
+        """The chunk stored in a record, its arrays are views of the file"""
+        segments = self._file.segments
+        while record >= len(segments) * self.segment_records:
+            self._map_segment()
+        segment = segments[record // self.segment_records]
+        start = (record % self.segment_records) * self.record_size
+        split = start + self.cells * np.dtype(INDEX_DTYPE).itemsize
+        shape = (self.chunk_size, ) * 3
+        chunk = DiskChunk.__new__(DiskChunk)
+        chunk.data = segment[start:split].view(INDEX_DTYPE).reshape(shape)
+        chunk.mask = segment[split:start + self.record_size].view(bool).reshape(shape)
+        chunk.count = count
+        chunk.record = record
+        return chunk
+
+    def _new_chunk(self):
+        records = self._file
+        if records.free:
+            record = records.free.pop()
+            chunk = self._chunk(record, 0)
+            # Left over from the chunk that had the record before
+            chunk.data[...] = 0
+            chunk.mask[...] = False
+        else:
+            record = records.count
+            records.count += 1
+            chunk = self._chunk(record, 0)
+        records.hold((record, ))
+        self._held.add(record)
+        return chunk
+
+    def _copy_chunk(self, chunk):
+        copy = self._new_chunk()
+        copy.data[...] = chunk.data
+        copy.mask[...] = chunk.mask
+        copy.count = chunk.count
+        return copy
+
+    def _writable(self, ckey, create=False):
+        """The chunk at ckey, copied first if a snapshot holds its record"""
+        chunk = self.chunks.get(ckey)
+        if chunk is None:
+            if not create:
+                return None
+            chunk = self.chunks[ckey] = self._new_chunk()
+        elif self._file.refs[chunk.record] > 1:
+            self.chunks[ckey] = self._copy_chunk(chunk)
+            self._release(chunk.record)
+            chunk = self.chunks[ckey]
+        return chunk
+
+    def _drop(self, ckey):
+        record = self.chunks[ckey].record
+        super(DiskChunkedStorage, self)._drop(ckey)
+        self._release(record)
+
+    def flush(self):
+        """Write the chunks to disk and save the directory"""
+        if self._snapshot:
+            raise ValueError("A snapshot is not saved, only the storage it was taken from")
+        for segment in self._file.segments:
+            segment.flush()
+        directory = {
+            'chunk_size': self.chunk_size,
+            'chunks': {ckey: (chunk.record, chunk.count) for (ckey, chunk) in self.chunks.items()},
+            'palette': self.palette,
+            'extra': self.extra,
+            'meta': self.meta,
+        }
+        # Replace the old directory only once the new one is complete
+        with open(self.directory_path + '.tmp', 'wb') as handle:
+            pickle.dump(directory, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.directory_path + '.tmp', self.directory_path)
+
+    def close(self):
+        """
+        Flush and let go of the file, the storage is not used after this.
+        Its records are unmapped once no snapshot holds them.
+        """
+        if not self._snapshot:
+            self.flush()
+        self._release_all()
+        self.chunks = {}
+        self._len = 0
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _load(self):
+        if not os.path.exists(self.directory_path):
+            return
+        with open(self.directory_path, 'rb') as handle:
+            directory = pickle.load(handle)
+        # By position, the chunk data indexes the palette as saved
+        self.palette = list(directory['palette'])
+        for (index, value) in enumerate(self.palette):
+            self._palette_index.setdefault(self._palette_key(value), index)
+        self.extra = directory['extra']
+        self.meta = directory['meta']
+        size = os.path.getsize(self.path) - HEADER_SIZE
+        records = self._file
+        records.count = max(size // self.record_size, 0)
+        for (ckey, (record, count)) in directory['chunks'].items():
+            self.chunks[ckey] = self._chunk(record, count)
+            self._len += count
+        self._held.update(chunk.record for chunk in self.chunks.values())
+        records.hold(self._held)
+        # Records not in the directory were freed, or copied before a
+        # snapshot was written to
+        records.free = sorted(set(range(records.count)) - self._held, reverse=True)
@@ -0,0 +1,270 @@
+"""
+3D Morton codes (Z-order), the order of the cubes in the octree.
+
+The bits of x, y and z are interleaved with x lowest, so the 3 bits of
+every level are the index of the child cube (see ``VoxelWorld.to_octree``)
+and the voxels of every octree cell are a contiguous run of codes.
+
+The array variants handle coordinates up to ``MORTON_MAX`` (21 bits, the
+codes fit an uint64), the scalar ones have no limit.
+"""
+import numpy as np
+
+MORTON_BITS = 21
+#: Coordinates must be below this for the array variants and ``MortonIndex``
+MORTON_MAX = 1 << MORTON_BITS
+
+# (shift, mask) steps spreading 21 bits to every third bit
+_SPREAD = (
+    (32, 0x1f00000000ffff),
+    (16, 0x1f0000ff0000ff),
+    (8, 0x100f00f00f00f00f),
+    (4, 0x10c30c30c30c30c3),
+    (2, 0x1249249249249249),
+)
+# and back
+_COMPACT = (
+    (2, 0x10c30c30c30c30c3),
+    (4, 0x100f00f00f00f00f),
+    (8, 0x1f0000ff0000ff),
+    (16, 0x1f00000000ffff),
+    (32, MORTON_MAX - 1),
+)
+
+
+def morton_encode(x, y, z):
+    """Interleave the bits of x, y and z (x lowest), i.e. octree order"""
+    code = 0
+    bit = 0
+    while x or y or z:
+        code |= ((x & 1) | ((y & 1) << 1) | ((z & 1) << 2)) << bit
+        x >>= 1
+        y >>= 1
+        z >>= 1
+        bit += 3
+    return code
+
+
+def morton_decode(code):
+    """The (x, y, z) of a Morton code"""
+    x = y = z = 0
+    bit = 0
+    while code:
+        x |= (code & 1) << bit
+        y |= ((code >> 1) & 1) << bit
+        z |= ((code >> 2) & 1) << bit
+        code >>= 3
+        bit += 1
+    return (x, y, z)
+
+
+def _spread(a):
+    a = a & (MORTON_MAX - 1)
+    for (shift, mask) in _SPREAD:
+        a = (a | (a << np.uint64(shift))) & np.uint64(mask)
+    return a
+
+
+def _compact(a):
+    a = a & np.uint64(_SPREAD[-1][1])
+    for (shift, mask) in _COMPACT:
+        a = (a ^ (a >> np.uint64(shift))) & np.uint64(mask)
+    return a
+
+
+def morton_encode_array(coords):
+    """
+    Morton codes (uint64 array) of an N x 3 array of coordinates
+    """
+    coords = np.asarray(coords)
+    if coords.size and (coords.min() < 0 or coords.max() >= MORTON_MAX):
+        raise ValueError("Coordinates must be in [0, %d)" % MORTON_MAX)
+    coords = coords.astype(np.uint64).reshape(-1, 3)
+    return _spread(coords[:, 0]) | (_spread(coords[:, 1]) << np.uint64(1)) | (_spread(coords[:, 2]) << np.uint64(2))
+
+
+def morton_decode_array(codes):
+    """
+    N x 3 array (int64) of the coordinates of an array of Morton codes
+    """
+    codes = np.asarray(codes, dtype=np.uint64)
+    coords = np.empty((len(codes), 3), dtype=np.int64)
+    for axis in range(3):
+        coords[:, axis] = _compact(codes >> np.uint64(axis))
+    return coords
+
+
+class MortonIndex(object):
+    """
+    Sorted Morton codes of a set of voxels, for octree cell and bounding box
+    queries. Only integer coordinates in ``[0, MORTON_MAX)`` are indexed.
+
+    Changes, of single points or whole arrays, are collected and merged
+    into the sorted array on the next query, so building the index point by
+    point or box by box stays cheap.
+    """
+
+    def __init__(self, keys=()):
+        self.codes = np.zeros(0, dtype=np.uint64)
+        # code -> present, the point changes not merged yet
+        self._pending = {}
+        # (codes, present) of the changes before those, in order
+        self._batches = []
+        for key in keys:
+            self.add(key)
+
+    def copy(self):
+        """A copy of the index, sharing the (never modified) code arrays"""
+        other = MortonIndex()
+        other.codes = self.codes
+        other._pending = dict(self._pending)
+        other._batches = list(self._batches)
+        return other
+
+    @staticmethod
+    def _code(key):
+        x, y, z = key
+        try:
+            if x != int(x) or y != int(y) or z != int(z):
+                return None
+        except (TypeError, ValueError, OverflowError):
+            return None
+        if 0 <= x < MORTON_MAX and 0 <= y < MORTON_MAX and 0 <= z < MORTON_MAX:
+            return morton_encode(int(x), int(y), int(z))
+        return None
+
+    def add(self, key):
+        code = self._code(key)
+        if code is not None:
+            self._pending[code] = True
+
+    def discard(self, key):
+        code = self._code(key)
+        if code is not None:
+            self._pending[code] = False
+
+    @staticmethod
+    def _array_codes(coords):
+        coords = np.asarray(coords).reshape(-1, 3)
+        coords = coords[((coords >= 0) & (coords < MORTON_MAX)).all(axis=1)]
+        return morton_encode_array(coords)
+
+    def add_array(self, coords):
+        """Add an N x 3 array of coordinates"""
+        self._queue(self._array_codes(coords), True)
+
+    def discard_array(self, coords):
+        """Remove an N x 3 array of coordinates"""
+        self._queue(self._array_codes(coords), False)
+
+    def _queue(self, codes, present):
+        self._flush_points()
+        if len(codes):
+            self._batches.append((codes, np.full(len(codes), present, dtype=bool)))
+
+    def _flush_points(self):
+        # Move the point changes behind the batches, keeping their order
+        if self._pending:
+            count = len(self._pending)
+            codes = np.fromiter(self._pending.keys(), dtype=np.uint64, count=count)
+            present = np.fromiter(self._pending.values(), dtype=bool, count=count)
+            self._pending = {}
+            self._batches.append((codes, present))
+
+    def _sync(self):
+        self._flush_points()
+        if not self._batches:
+            return
+        codes = np.concatenate([c for (c, _) in self._batches])
+        present = np.concatenate([p for (_, p) in self._batches])
+        self._batches = []
+        # The last change of a code wins
+        last = len(codes) - 1 - np.unique(codes[::-1], return_index=True)[1]
+        codes = codes[last]
+        present = present[last]
+        result = self.codes
+        if not present.all():
+            result = np.setdiff1d(result, codes[~present], assume_unique=True)
+        if present.any():
+            result = np.union1d(result, codes[present])
+        self.codes = result
+
+    def __len__(self):
+        self._sync()
+        return len(self.codes)
+
+    def sorted_codes(self):
+        """All codes, sorted"""
+        self._sync()
+        return self.codes
+
+    def span(self, x, y, z, size):
+        """
+        (start, end) positions in ``sorted_codes()`` of the voxels of the
+        octree cell of edge ``size`` (a power of two) at x, y, z
+        """
+        if size & (size - 1) or x % size or y % size or z % size:
+            raise ValueError("Not an octree cell")
+        self._sync()
+        base = morton_encode(x, y, z)
+        start, end = np.searchsorted(self.codes, np.array([base, base + size ** 3], dtype=np.uint64))
+        return int(start), int(end)
+
+    def cell(self, x, y, z, size):
+        """
+        Coordinates (N x 3 array, in Z-order) of the voxels in the octree
+        cell of edge ``size`` at x, y, z
+        """
+        start, end = self.span(x, y, z, size)
+        return morton_decode_array(self.codes[start:end])
+
+    def box(self, lo, hi):
+        """
+        Coordinates (N x 3 array, in Z-order) of the voxels with
+        ``lo <= (x, y, z) < hi``.
+
+        The box is split into octree cells, cells entirely inside it are a
+        single run of codes, runs in a partially covered cell are filtered
+        once they are small.
+        """
+        self._sync()
+        lo = [max(int(c), 0) for c in lo]
+        hi = [min(int(c), MORTON_MAX) for c in hi]
+        if len(self.codes) == 0 or any(h <= l for (l, h) in zip(lo, hi)):
+            return np.zeros((0, 3), dtype=np.int64)
+        (lx, ly, lz) = lo
+        (hx, hy, hz) = hi
+
+        runs = []
+        # Explicit stack of (x, y, z, size, start, end)
+        stack = [(0, 0, 0, MORTON_MAX, 0, len(self.codes))]
+        while stack:
+            (x, y, z, size, start, end) = stack.pop()
+            if x + size <= lx or y + size <= ly or z + size <= lz or x >= hx or y >= hy or z >= hz:
+                continue
+            if x >= lx and y >= ly and z >= lz and x + size <= hx and y + size <= hy and z + size <= hz:
+                runs.append(morton_decode_array(self.codes[start:end]))
+                continue
+            if end - start <= 64 or size == 1:
+                found = morton_decode_array(self.codes[start:end])
+                runs.append(found[((found >= lo) & (found < hi)).all(axis=1)])
+                continue
+            half = size >> 1
+            step = half ** 3
+            base = morton_encode(x, y, z)
+            bounds = self.codes[start:end].searchsorted(np.array([base + step * (i + 1) for i in range(7)], dtype=np.uint64))
+            ends = [start + int(b) for b in bounds] + [end]
+            children = []
+            for i in range(8):
+                if ends[i] > start:
+                    children.append((
+                        x + half if i & 1 else x,
+                        y + half if i & 2 else y,
+                        z + half if i & 4 else z,
+                        half, start, ends[i]
+                    ))
+                start = ends[i]
+            stack.extend(reversed(children))
+        if not runs:
+            return np.zeros((0, 3), dtype=np.int64)
+        return np.concatenate(runs)
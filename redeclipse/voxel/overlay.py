@@ -0,0 +1,79 @@
+"""
+Overlay layers over the voxels of a :class:`redeclipse.voxel.VoxelWorld`.
+
+An overlay only records what was changed on top of its base: reads fall
+through to the base for every cell it did not touch, writes and deletes
+stay in the overlay until it is flattened into the base or dropped. See
+``VoxelWorld.overlay``.
+"""
+from collections.abc import MutableMapping
+
+#: Marks a cell deleted in the overlay
+DELETED = object()
+
+
+class OverlayStorage(MutableMapping):
+    """
+    Mapping of ``(x, y, z)`` to value, changes on top of ``base``.
+
+    :param base: The mapping underneath, which is never modified here
+    :type base: collections.abc.Mapping
+    """
+
+    def __init__(self, base, changes=None):
+        self.base = base
+        #: key -> new value, or DELETED
+        self.changes = {} if changes is None else changes
+
+    def snapshot(self):
+        """A copy of the overlay, on the same base"""
+        return OverlayStorage(self.base, dict(self.changes))
+
+    def __getitem__(self, key):
+        try:
+            value = self.changes[key]
+        except KeyError:
+            return self.base[key]
+        if value is DELETED:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.base:
+            self.changes[key] = DELETED
+        else:
+            del self.changes[key]
+
+    def __contains__(self, key):
+        try:
+            value = self.changes[key]
+        except KeyError:
+            return key in self.base
+        return value is not DELETED
+
+    def __iter__(self):
+        changes = self.changes
+        for key in self.base:
+            if key not in changes:
+                yield key
+        for (key, value) in list(changes.items()):
+            if value is not DELETED:
+                yield key
+
+    def __len__(self):
+        count = len(self.base)
+        for (key, value) in self.changes.items():
+            if key in self.base:
+                if value is DELETED:
+                    count -= 1
+            elif value is not DELETED:
+                count += 1
+        return count
+
+    def clear_changes(self):
+        self.changes = {}
@@ -0,0 +1,128 @@
+"""
+Visibility of the voxels of a :class:`redeclipse.voxel.VoxelWorld`, on
+dense boolean grids indexed [x, y, z]. The world is worked on a block at a
+time, :func:`pad` gives a block the layer of cells around it it needs
+from its neighbours.
+
+The flood fill spreads along whole runs of passable cells, one axis at a
+time, until nothing changes. That takes one pass per turn in the paths
+through the grid rather than one per cell of their length.
+"""
+import numpy as np
+
+from redeclipse.objects import cube, SOLID_FACES
+
+
+def is_opaque(value):
+    """Whether a voxel value is a solid leaf, which hides its neighbours"""
+    return isinstance(value, cube) and not value.children and value.faces == SOLID_FACES
+
+
+def _spread(passable, reached, axis):
+    """Spread reached cells over the passable runs along an axis"""
+    a = np.moveaxis(passable, axis, -1)
+    r = np.moveaxis(reached, axis, -1)
+    # Runs start at a passable cell after a blocked one (or the edge)
+    starts = a.copy()
+    starts[..., 1:] &= ~a[..., :-1]
+    ids = np.cumsum(starts, dtype=np.int64 if a.size >= 2 ** 31 else np.int32).reshape(a.shape)
+    runs = np.zeros(int(ids[..., -1].max()) + 1 if a.size else 1, dtype=bool)
+    runs[ids[r & a]] = True
+    return np.moveaxis(a & runs[ids], -1, axis)
+
+
+def flood_fill(passable, seeds):
+    """
+    The passable cells connected to the seed cells through the faces of
+    passable cells
+
+    :param passable: Cells that can be passed through
+    :type passable: numpy.ndarray
+
+    :param seeds: Cells to start from, only the passable ones count
+    :type seeds: numpy.ndarray
+
+    :rtype: numpy.ndarray
+    """
+    reached = passable & seeds
+    count = int(np.count_nonzero(reached))
+    while True:
+        for axis in range(passable.ndim):
+            reached = _spread(passable, reached, axis)
+        new = int(np.count_nonzero(reached))
+        if new == count:
+            return reached
+        count = new
+
+
+#: The face directions in orient order (-x, +x, -y, +y, -z, +z), as
+#: (axis, step)
+FACES = [(axis, step) for axis in range(3) for step in (-1, 1)]
+
+
+def shifted(grid, axis, step, fill=False):
+    """
+    Per cell, the value of grid at its neighbour ``step`` cells along
+    ``axis``, ``fill`` outside the grid
+    """
+    result = np.full(grid.shape, fill, dtype=grid.dtype)
+    src = [slice(None)] * grid.ndim
+    dst = [slice(None)] * grid.ndim
+    if step > 0:
+        src[axis] = slice(step, None)
+        dst[axis] = slice(None, -step)
+    else:
+        src[axis] = slice(None, step)
+        dst[axis] = slice(-step, None)
+    result[tuple(dst)] = grid[tuple(src)]
+    return result
+
+
+def neighbours(grid):
+    """
+    Per cell, a list of the 6 values of grid at its face neighbours, in
+    the order of ``FACES``. Outside the grid counts as False.
+    """
+    return [shifted(grid, axis, step) for (axis, step) in FACES]
+
+
+def face(axis, step, ndim=3):
+    """Index of the layer of cells of a block on the side (axis, step)"""
+    index = [slice(None)] * ndim
+    index[axis] = -1 if step > 0 else 0
+    return tuple(index)
+
+
+def pad(block, layers):
+    """
+    The block with a layer of cells around it, on the side of face i of
+    ``FACES`` set to ``layers[i]``: the facing layer of the neighbour
+    block (see :func:`face`) or a scalar. The edges and corners are False.
+
+    :param block: The block
+    :type block: numpy.ndarray
+
+    :param layers: The 6 layers around it
+    :type layers: list
+
+    :rtype: numpy.ndarray
+    """
+    result = np.zeros(tuple(n + 2 for n in block.shape), dtype=block.dtype)
+    inner = [slice(1, -1)] * block.ndim
+    result[tuple(inner)] = block
+    for ((axis, step), layer) in zip(FACES, layers):
+        index = list(inner)
+        index[axis] = -1 if step > 0 else 0
+        result[tuple(index)] = layer
+    return result
+
+
+def hidden(opaque, reachable):
+    """
+    The opaque cells without a face next to a reachable cell, which can
+    not be seen from anywhere reachable
+    """
+    seen = np.zeros(opaque.shape, dtype=bool)
+    for near in neighbours(reachable):
+        seen |= near
+    return opaque & ~seen
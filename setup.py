@@ -17,7 +17,8 @@ REQUIRES = [
     'noise',
     'tqdm',
     'bresenham',
-    'kaitaistruct'
+    'kaitaistruct',
+    'numpy'
 ]
 
 setup(
@@ -35,6 +36,7 @@ setup(
         'console_scripts': [
                 'redeclipse_iso = redeclipse.cli.iso:main',
                 'redeclipse_to_json = redeclipse.cli.to_json:main',
+                'redeclipse_parse_many = redeclipse.cli.parse_many:main',
                 'redeclipse_from_json = redeclipse.cli.from_json:main',
                 'redeclipse_addtrees = redeclipse.cli.add_trees:main',
                 'redeclipse_cfg = redeclipse.cli.cfg_gen:main',
@@ -1,3 +1,7 @@
+import random
+
+import numpy as np
+
 from redeclipse import aftereffects as ae
 from redeclipse.voxel import VoxelWorld
 from redeclipse.upm import UnusedPositionManager
@@ -26,6 +30,12 @@ def test_vg2_inv():
     assert ae.vertical_gradient2inv(0, 0, 0) == 0
 
 
+def test_arrays():
+    z = np.arange(0, 1100, 50)
+    for f in (ae.vertical_gradient, ae.gradient3, ae.vertical_gradient2, ae.vertical_gradient2inv):
+        assert list(f(0, 0, z)) == [f(0, 0, int(c)) for c in z]
+
+
 def test_grid():
     v = VoxelWorld(size=10)
     # grid only goes to zmax
@@ -53,6 +63,32 @@ def test_decay():
     assert 400 < len(v.world.keys()) < 600
 
 
+def test_decay_seed():
+    def world():
+        v = VoxelWorld(size=16, chunked=True)
+        v.fill_box((0, 0, 0), (16, 16, 9), tex=2)
+        return v
+
+    # Same voxels for the same seed, and random continues from the same
+    # state as one random.random() per cell would
+    random.seed(4)
+    a = world()
+    ae.decay(a, lambda x, y, z: np.where(z < 4, 0.5, 0.8))
+    after = random.random()
+
+    random.seed(4)
+    b = world()
+    # Position functions which only take single coordinates work too
+    ae.decay(b, lambda x, y, z: 0.5 if z < 4 else 0.8)
+    assert random.random() == after
+    assert sorted(a.world) == sorted(b.world)
+
+    random.seed(4)
+    keep = [random.random() <= (0.5 if z < 4 else 0.8) for z in range(8) for x in range(16) for y in range(16)]
+    assert len(a.world) == sum(keep) + 16 * 16
+    assert random.random() == after
+
+
 def test_growth():
     v = VoxelWorld(size=10)
     # Decay 0.5 on average.
@@ -76,6 +112,12 @@ def test_box():
             x == world_size - 1 or \
             y == world_size - 1 or \
             z == world_size - 1
+    assert len(v.world) == 10 ** 3 - 8 ** 3
+
+    v = VoxelWorld(size=world_size)
+    ae.box(v, height=4)
+    assert len(v.world) == 10 * 10 + 4 * 36 - 36
+    assert max(z for (x, y, z) in v.world.keys()) == 3
 
 
 def test_endcap():
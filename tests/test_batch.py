@@ -0,0 +1,58 @@
+import gzip
+import os
+import pickle
+
+import pytest
+
+from redeclipse import MapParser
+from redeclipse.batch import parse_many, MapSummary
+
+FILES = os.path.join(os.path.dirname(__file__), 'files')
+
+
+@pytest.fixture
+def paths(tmpdir):
+    broken = str(tmpdir.join('broken.mpz'))
+    with gzip.open(broken, 'wb') as handle:
+        handle.write(b'NOPE')
+    return [os.path.join(FILES, name) for name in ('scaff1.mpz', 'scaff2.mpz', 'empty.mpz')] + [broken]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_parse_many(paths, workers):
+    results = {r.path: r for r in parse_many(paths, workers=workers)}
+    assert set(results) == set(paths)
+    assert not results[paths[-1]].ok
+    assert 'Not a mapz file' in results[paths[-1]].error
+
+    m = results[paths[0]].value
+    expected = MapParser().read(paths[0])
+    assert m.meta == expected.meta
+    assert [c.texture for c in m.world] == [c.texture for c in expected.world]
+    # The raw world is not sent back on top of the cubes
+    assert m.world_bytes is None
+
+
+def test_summary(paths):
+    results = {r.path: r for r in parse_many(paths, workers=2, summary=True)}
+    s = results[paths[0]].value
+    assert isinstance(s, MapSummary)
+    m = MapParser().read(paths[0])
+    assert s.numents == len(m.ents)
+    assert sum(s.entity_types.values()) == s.numents
+    assert s.meta['gameident'] == 'fps'
+
+
+def test_cancel(paths):
+    results = parse_many(paths * 4, workers=2, summary=True)
+    next(results)
+    # Remaining files are dropped, the pool shuts down
+    results.close()
+
+
+def test_pickle_map(tmpdir):
+    m = MapParser().read(os.path.join(FILES, 'scaff1.mpz'), keep_world_bytes=True)
+    copy = pickle.loads(pickle.dumps(m))
+    out = str(tmpdir.join('copy.mpz'))
+    copy.write(out, reuse_world=True)
+    assert MapParser().read(out).meta == m.meta
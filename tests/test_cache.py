@@ -0,0 +1,127 @@
+import gzip
+import os
+import pickle
+import zlib
+
+import pytest
+
+from redeclipse import MapParser
+from redeclipse.cache import MapCache, CACHE_HEADER, CACHE_MAGIC
+from redeclipse.octree import OctreeStore, LazyCubes
+
+FILES = os.path.join(os.path.dirname(__file__), 'files')
+
+
+def raw(path):
+    with gzip.open(path) as handle:
+        return handle.read()
+
+
+def walk(cube_arr):
+    textures = []
+    for c in cube_arr:
+        textures.append(list(c.texture))
+        if c.children:
+            textures.extend(walk(c.children))
+    return textures
+
+
+def test_cache(tmpdir):
+    src = os.path.join(FILES, 'scaff3.mpz')
+    cache = MapCache(str(tmpdir.join('cache')))
+
+    cold = cache.read(src, lazy=True)
+    assert len(os.listdir(cache.directory)) == 1
+    warm = cache.read(src, lazy=True)
+    assert warm.meta == cold.meta
+    assert warm.map_vars == cold.map_vars
+    assert isinstance(warm.world, LazyCubes) and not warm.world.loaded
+    assert walk(warm.world) == walk(MapParser().read(src).world)
+
+    out = str(tmpdir.join('warm.mpz'))
+    cache.read(src, lazy=True).write(out)
+    assert raw(out) == raw(src)
+    warm.write(out)
+    assert raw(out) == raw(src)
+    # Partly built, the rest is written from the store
+    part = cache.read(src, lazy=True)
+    assert part.world[4].children[7].octsav == warm.world[4].children[7].octsav
+    part.write(out)
+    assert raw(out) == raw(src)
+    cache.read(src, keep_world_bytes=True).write(out, reuse_world=True)
+    assert raw(out) == raw(src)
+
+
+def test_cache_warm(tmpdir, monkeypatch):
+    # A warm load neither inflates the map nor decodes its octree
+    src = os.path.join(FILES, 'scaff2.mpz')
+    cache = MapCache(str(tmpdir.join('cache')))
+    expected = cache.read(src)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Parsed again")
+    monkeypatch.setattr(gzip, 'decompress', fail)
+    monkeypatch.setattr(OctreeStore, 'decode', fail)
+    monkeypatch.setattr(MapParser, '_loadchildren', fail)
+    monkeypatch.setattr(MapParser, '_indexchildren', fail)
+    out = str(tmpdir.join('out.mpz'))
+    for mode in ({}, {'lazy': True}, {'arrays': True}):
+        m = cache.read(src, **mode)
+        assert m.map_vars == expected.map_vars
+        m.write(out)
+        assert raw(out) == raw(src)
+
+
+@pytest.mark.parametrize('mode', [{}, {'arrays': True}, {'keep_world_bytes': True}])
+def test_cache_modes(tmpdir, mode):
+    src = os.path.join(FILES, 'scaff1.mpz')
+    cache = MapCache(str(tmpdir.join('cache')))
+    expected = MapParser().read(src, **mode)
+    for m in (cache.read(src, **mode), cache.read(src, **mode)):
+        # Same as the parser returns with these options
+        assert type(m.world) is type(expected.world)
+        assert m.world_bytes == expected.world_bytes
+        out = str(tmpdir.join('out.mpz'))
+        m.write(out)
+        assert raw(out) == raw(src)
+        if isinstance(m.world, OctreeStore):
+            assert list(m.world.octsav) == list(expected.world.octsav)
+        else:
+            assert walk(m.world) == walk(expected.world)
+
+
+def test_cache_evict(tmpdir):
+    cache = MapCache(str(tmpdir.join('cache')), max_size=1)
+    for name in ('scaff1.mpz', 'scaff2.mpz'):
+        cache.read(os.path.join(FILES, name))
+    # Nothing fits
+    assert os.listdir(cache.directory) == []
+
+    cache = MapCache(str(tmpdir.join('bypass')))
+    cache.read(os.path.join(FILES, 'scaff1.mpz'), bypass=True)
+    assert not os.path.exists(cache.directory)
+
+
+@pytest.mark.parametrize('content', ['garbage', 'octree', 'pickle'])
+def test_cache_broken_entry(tmpdir, content):
+    src = os.path.join(FILES, 'scaff1.mpz')
+    cache = MapCache(str(tmpdir.join('cache')))
+    cache.read(src)
+    entry = cache.entry(cache.key(src))
+    with open(entry, 'rb') as handle:
+        good = handle.read()
+    (magic, world_start, vslots_start, world_end, head_size, octree_size) = CACHE_HEADER.unpack_from(good)
+    head = good[CACHE_HEADER.size:CACHE_HEADER.size + head_size]
+    if content == 'garbage':
+        data = b'garbage'
+    else:
+        # Well formed, but the octree is cut short or something else
+        # entirely, which is never unpickled
+        octree = zlib.compress(b'\0' * 7) if content == 'octree' else zlib.compress(pickle.dumps(Exception()))
+        data = CACHE_HEADER.pack(CACHE_MAGIC, world_start, vslots_start, world_end, head_size, len(octree)) + head + octree
+    with open(entry, 'wb') as handle:
+        handle.write(data)
+    assert cache.read(src).meta == MapParser().read(src).meta
+    # Replaced with a good entry
+    with open(entry, 'rb') as handle:
+        assert handle.read() == good
@@ -0,0 +1,123 @@
+import io
+import random
+
+import numpy as np
+import pytest
+
+from redeclipse.magicavoxel.writer import to_magicavoxel
+from redeclipse.objects import cube
+from redeclipse.textures import DefaultThemedTextureManager
+from redeclipse.voxel import VoxelWorld
+from redeclipse.voxel.chunked import ChunkedStorage
+
+
+def fill(v, seed=5):
+    random.seed(seed)
+    for i in range(600):
+        v.set_point(random.randrange(64), random.randrange(64), random.randrange(64), cube.newtexcube(tex=random.randrange(1, 9)))
+    v.set_point(2.0, 3.0, 4.0, cube.newtexcube(tex=11))
+    v.set_point(70, 0, 0, cube.newtexcube(tex=12))
+    v.set_point(-3, 0, 0, cube.newtexcube(tex=12))
+    v.set_point(1.5, 0, 0, cube.newtexcube(tex=13))
+    v.set_point(5, 5, 5, None)
+    v.del_point(5, 5, 5)
+    v.set_point(6, 6, 6, None)
+    return v
+
+
+def test_mapping():
+    s = ChunkedStorage()
+    s[1, 2, 3] = 'a'
+    s[-1, -2, -40] = 'b'
+    s[1.0, 2.0, 4.0] = 'c'
+    s[1.5, 0, 0] = 'd'
+    s[7, 7, 7] = None
+    s[8, 8, 8] = [1]
+
+    assert len(s) == 6
+    assert s[1, 2, 3] == 'a'
+    assert s[-1, -2, -40] == 'b'
+    assert s[1, 2, 4] == 'c'
+    assert s[1.5, 0, 0] == 'd'
+    assert s[7, 7, 7] is None
+    assert s[8, 8, 8] == [1]
+    assert (2, 2, 2) not in s
+    assert (7, 7, 7) in s
+    with pytest.raises(KeyError):
+        s[2, 2, 2]
+    assert sorted(map(str, s.keys())) == sorted(map(str, [(1, 2, 3), (-1, -2, -40), (1, 2, 4), (1.5, 0, 0), (7, 7, 7), (8, 8, 8)]))
+
+    s[1, 2, 3] = 'e'
+    assert len(s) == 6
+    del s[1, 2, 3]
+    del s[1.5, 0, 0]
+    with pytest.raises(KeyError):
+        del s[1, 2, 3]
+    assert len(s) == 4
+
+    # Chunks go away once empty
+    del s[-1, -2, -40]
+    assert (-1, -1, -3) not in s.chunks
+    # One palette entry per distinct value
+    s[9, 9, 9] = 'c'
+    assert s.palette.count('c') == 1
+
+
+def test_same_as_dict():
+    plain = fill(VoxelWorld(size=64))
+    chunked = fill(VoxelWorld(size=64, chunked=True))
+
+    assert dict(plain.world.items()) == dict(chunked.world.items())
+    assert list(plain.octree_walk()) == list(chunked.octree_walk())
+    a = plain.to_store()
+    b = chunked.to_store()
+    assert bytes(a.octsav) == bytes(b.octsav) and bytes(a.textures) == bytes(b.textures)
+
+
+def test_magicavoxel_writer():
+    texman = DefaultThemedTextureManager()
+    plain = fill(VoxelWorld(size=64))
+    chunked = fill(VoxelWorld(size=64, chunked=True))
+    chunked.del_point(6, 6, 6)
+    plain.del_point(6, 6, 6)
+    outputs = []
+    for v in (plain, chunked):
+        handle = io.BytesIO()
+        to_magicavoxel(v, handle, texman)
+        outputs.append(handle.getvalue())
+    # Same header, same voxels (in another order)
+    header = 60
+    assert outputs[0][:header] == outputs[1][:header]
+    records = [sorted(out[header:-1036][i:i + 4] for i in range(0, len(out) - header - 1036, 4)) for out in outputs]
+    assert records[0] == records[1]
+
+
+def test_blocks():
+    s = ChunkedStorage(chunk_size=4)
+    a = s.palette_index('a')
+    b = s.palette_index('b')
+    data = np.full((6, 5, 3), a, dtype=np.uint16)
+    data[0] = b
+    mask = np.ones(data.shape, dtype=bool)
+    mask[1, 1, 1] = False
+    s.set_block((-2, 1, 3), data, mask)
+
+    assert len(s) == 6 * 5 * 3 - 1
+    assert s[-2, 1, 3] == 'b'
+    assert s[-1, 1, 3] == 'a'
+    assert (-1, 2, 4) not in s
+    assert sum(int(m.sum()) for (origin, d, m) in s.chunk_items()) == len(s)
+
+    got, got_mask = s.get_block((-3, 0, 2), (8, 7, 5))
+    assert (got_mask[1:7, 1:6, 1:4] == mask).all()
+    assert not got_mask[0].any() and not got_mask[:, 6].any()
+    assert (got[1:7, 1:6, 1:4][mask] == data[mask]).all()
+
+    coords, indices = s.occupied()
+    assert len(coords) == len(s)
+    assert sorted(map(tuple, coords.tolist())) == sorted(s.keys())
+
+    s.clear_block((-2, 1, 3), (1, 5, 3))
+    assert len(s) == 5 * 5 * 3 - 1
+    s.clear_block((-10, -10, -10), (30, 30, 30))
+    assert len(s) == 0 and not s.chunks
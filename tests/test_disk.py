@@ -0,0 +1,115 @@
+import pytest
+
+from redeclipse import aftereffects as ae
+from redeclipse.objects import cube
+from redeclipse.voxel import VoxelWorld
+from redeclipse.voxel.disk import DiskChunkedStorage
+
+from test_chunked import fill
+
+
+def test_same_as_memory(tmpdir):
+    memory = fill(VoxelWorld(size=64, chunked=True))
+    disk = fill(VoxelWorld(size=64, path=str(tmpdir.join('world'))))
+
+    assert dict(memory.world.items()) == dict(disk.world.items())
+    for collapse in (False, True):
+        assert list(memory.octree_walk(collapse)) == list(disk.octree_walk(collapse))
+    a = memory.to_store()
+    b = disk.to_store()
+    assert bytes(a.octsav) == bytes(b.octsav) and bytes(a.textures) == bytes(b.textures)
+
+
+def test_reopen(tmpdir):
+    path = str(tmpdir.join('world'))
+    v = VoxelWorld(size=64, path=path)
+    v.fill_box((0, 0, 0), (64, 64, 8), tex=3)
+    v.fill_box((40, 40, 8), (48, 48, 30), tex=4)
+    v.set_point(1.5, 0, 0, 'odd')
+    v.clear_box((0, 0, 0), (16, 16, 8))
+    before = dict(v.world.items())
+    walk = list(v.octree_walk())
+    v.close()
+
+    w = VoxelWorld(size=64, path=path, morton_index=True)
+    assert dict(w.world.items()) == before
+    assert list(w.octree_walk()) == walk
+    assert (w.xmin, w.xmax, w.zmin, w.zmax) == (0, 63, 0, 29)
+    assert len(w.index) == len(w.world) - 1
+    assert w.get_point(40, 40, 8) is cube.newtexcube(tex=4)
+
+    # Freed records are reused
+    records = w.world._file.count
+    w.fill_box((0, 0, 0), (16, 16, 8), tex=5)
+    assert w.world._file.count == records
+    w.close()
+
+
+def test_snapshot(tmpdir):
+    s = DiskChunkedStorage(str(tmpdir.join('world')), chunk_size=4, segment_records=2)
+    for i in range(20):
+        s[i, 0, 0] = i
+    assert len(s._file.segments) == 3
+    t = s.snapshot()
+    s[0, 0, 0] = 'changed'
+    del s[4, 0, 0]
+    assert t[0, 0, 0] == 0 and t[4, 0, 0] == 4
+    assert s[0, 0, 0] == 'changed' and (4, 0, 0) not in s
+    s.close()
+
+    # Aftereffects work on a disk world like any other
+    v = VoxelWorld(size=16, path=str(tmpdir.join('ae')))
+    ae.box(v, height=8)
+    m = VoxelWorld(size=16, chunked=True)
+    ae.box(m, height=8)
+    assert dict(v.world.items()) == dict(m.world.items())
+
+
+def test_snapshot_records(tmpdir):
+    s = DiskChunkedStorage(str(tmpdir.join('world')), chunk_size=4, segment_records=2)
+    for i in range(32):
+        s[i, 0, 0] = i
+    assert s._file.count == 8
+    t = s.snapshot()
+    assert isinstance(t, DiskChunkedStorage)
+
+    # Both hold the records, writing copies them
+    for i in range(32):
+        s[i, 0, 0] = -i
+    assert s._file.count == 16 and not s._file.free
+    assert [t[i, 0, 0] for i in range(32)] == list(range(32))
+
+    # The records only the snapshot held are free once it is gone
+    del t
+    assert len(s._file.free) == 8
+    for i in range(32):
+        del s[i, 0, 0]
+    for i in range(32):
+        s[i, 0, 0] = i
+    assert s._file.count == 16 and len(s._file.free) == 8
+
+    # Without a snapshot holding them, records are written in place
+    s.snapshot().close()
+    s[0, 0, 0] = 'changed'
+    assert s._file.count == 16 and len(s._file.free) == 8
+    with pytest.raises(ValueError):
+        s.snapshot().flush()
+    s.close()
+
+
+def test_reopen_palette(tmpdir):
+    path = str(tmpdir.join('world'))
+    s = DiskChunkedStorage(path, chunk_size=4)
+    s[0, 0, 0] = 'a'
+    s[1, 0, 0] = 'b'
+    s[2, 0, 0] = 'c'
+    # Two entries with the same key, as a palette saved by an older version
+    # might hold
+    s.palette[1] = 'a'
+    s.close()
+
+    t = DiskChunkedStorage(path)
+    assert t.palette == ['a', 'a', 'c']
+    assert [t[i, 0, 0] for i in range(3)] == ['a', 'a', 'c']
+    assert t.palette_index('a') == 0 and t.palette_index('d') == 3
+    t.close()
@@ -0,0 +1,303 @@
+import gzip
+import inspect
+import os
+import struct
+import sys
+import tracemalloc
+
+import pytest
+
+from redeclipse import MapParser, BlockWriter, INT, SECTIONS, leafkey
+from redeclipse.entities import Sunlight
+from redeclipse.enums import OCT, EntType
+from redeclipse.objects import cube, SurfaceInfo
+from redeclipse.voxel import VoxelWorld
+
+FILES = os.path.join(os.path.dirname(__file__), 'files')
+
+
+def raw(path):
+    with gzip.open(path) as handle:
+        return handle.read()
+
+
+@pytest.mark.parametrize('name', ['scaff1.mpz', 'scaff2.mpz', 'empty-large.mpz'])
+def test_roundtrip(tmpdir, name):
+    src = os.path.join(FILES, name)
+    out = str(tmpdir.join(name))
+
+    m = MapParser().read(src)
+    m.write(out)
+    assert raw(out) == raw(src)
+
+
+def test_parse():
+    m = MapParser().read(os.path.join(FILES, 'scaff1.mpz'))
+    assert m.magic == b'MAPZ'
+    assert m.meta['gameident'] == b'fps'
+    assert len(m.ents) == m.meta['numents']
+    assert len(m.world) == 8
+    # Fixed width records decoded in one go.
+    for c in m.world:
+        assert len(c.texture) == 6
+
+
+def test_streaming(tmpdir):
+    src = os.path.join(FILES, 'scaff2.mpz')
+    out = str(tmpdir.join('scaff2.mpz'))
+
+    mp = MapParser()
+    # Tiny window, forces a refill in the middle of most fields.
+    mp.window_size = 7
+    m = mp.read(src, streaming=True)
+    assert len(mp.bytes) < 64
+    m.write(out)
+    assert raw(out) == raw(src)
+
+
+def test_truncated(tmpdir):
+    src = os.path.join(FILES, 'scaff1.mpz')
+    out = str(tmpdir.join('truncated.mpz'))
+    with gzip.open(out, 'wb') as handle:
+        handle.write(raw(src)[:2000])
+
+    for streaming in (False, True):
+        with pytest.raises(EOFError):
+            MapParser().read(out, streaming=streaming)
+
+
+def walk(cube_arr):
+    for c in cube_arr:
+        if c.children:
+            walk(c.children)
+
+
+def test_lazy(tmpdir):
+    src = os.path.join(FILES, 'scaff3.mpz')
+
+    m = MapParser().read(src, lazy=True)
+    assert not m.world.loaded
+    # Untouched subtrees are copied verbatim
+    m.write(str(tmpdir.join('untouched.mpz')))
+    assert raw(str(tmpdir.join('untouched.mpz'))) == raw(src)
+
+    # Fully decoded, the same as the eager parser
+    walk(m.world)
+    m.write(str(tmpdir.join('loaded.mpz')))
+    assert raw(str(tmpdir.join('loaded.mpz'))) == raw(src)
+
+
+def test_lazy_edit(tmpdir):
+    src = os.path.join(FILES, 'scaff3.mpz')
+    out = str(tmpdir.join('edited.mpz'))
+
+    m = MapParser().read(src, lazy=True)
+    c = m.world[7]
+    while c.children:
+        c = c.children[7]
+    c.texture = (5, 5, 5, 5, 5, 5)
+    # Only the path down to the edited cube was decoded
+    assert not m.world[0].children.loaded
+    m.write(out)
+
+    c = MapParser().read(out).world[7]
+    while c.children:
+        c = c.children[7]
+    assert c.texture == (5, 5, 5, 5, 5, 5)
+
+
+def test_lazy_streaming():
+    with pytest.raises(ValueError):
+        MapParser().read(os.path.join(FILES, 'scaff1.mpz'), streaming=True, lazy=True)
+
+
+def test_deep(tmpdir):
+    # A single voxel at the bottom of a 2**13 world
+    m = MapParser().read(os.path.join(FILES, 'empty.mpz'))
+    m.meta['worldsize'] = 2 ** 13
+    m.world = cube.newcubes()
+    c = m.world[0]
+    for level in range(12):
+        c.octsav = OCT.OCTSAV_CHILDREN.value
+        c.children = cube.newcubes()
+        c = c.children[0]
+    cube.texturize(c, tex=4)
+
+    out = str(tmpdir.join('deep.mpz'))
+    limit = sys.getrecursionlimit()
+    # Enough for the call stack of the test, not for recursing per level
+    sys.setrecursionlimit(len(inspect.stack()) + 24)
+    try:
+        m.write(out)
+        for lazy in (False, True):
+            c = MapParser().read(out, lazy=lazy).world[0]
+            for level in range(12):
+                c = c.children[0]
+            assert c.texture == (4, 4, 4, 4, 4, 4)
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+def test_compresslevel(tmpdir):
+    src = os.path.join(FILES, 'scaff3.mpz')
+    m = MapParser().read(src)
+
+    fast = str(tmpdir.join('fast.mpz'))
+    small = str(tmpdir.join('small.mpz'))
+    m.write(fast, compresslevel=1)
+    m.write(small, compresslevel=9)
+    assert raw(fast) == raw(small) == raw(src)
+    assert os.path.getsize(small) < os.path.getsize(fast)
+
+
+def test_block_writer():
+    class Sink(object):
+        def __init__(self):
+            self.writes = []
+
+        def write(self, data):
+            self.writes.append(bytes(data))
+
+    sink = Sink()
+    w = BlockWriter(sink, block_size=16)
+    for i in range(10):
+        w.pack(INT, i)
+    # Larger than the block, the buffer grows
+    w.write(b'x' * 100)
+    w.flush()
+    data = b''.join(sink.writes)
+    assert data == struct.pack('10i', *range(10)) + b'x' * 100
+    assert len(sink.writes) < 10
+
+
+def test_leafkey():
+    assert leafkey(cube.newcube()) is not None
+    assert leafkey(cube.newtexcube(tex=3)) == leafkey(cube.newtexcube(tex=3))
+    assert leafkey(cube.newtexcube(tex=3)) != leafkey(cube.newtexcube(tex=4))
+
+    c = cube.newtexcube(tex=3).mutable()
+    c.setsurface(2, SurfaceInfo(1, 0, 0, 32))
+    assert leafkey(c) is None
+    c = cube.newtexcube(tex=3).mutable()
+    c.edges = (0,) + c.edges[1:]
+    assert leafkey(c) is None
+    c = cube.newtexcube(tex=3).mutable()
+    c.octsav |= 0x40
+    assert leafkey(c) is None
+    # The shared cube is unchanged
+    assert leafkey(cube.newtexcube(tex=3)) is not None
+
+
+def test_leaf_cache(tmpdir):
+    m = MapParser().read(os.path.join(FILES, 'empty.mpz'))
+    m.meta['worldsize'] = 8
+    m.world = cube.newcubes()
+    m.world[1] = cube.newtexcube(tex=[1, 2, 3, 4, 5, 6])
+    m.world[2] = cube.newtexcube(tex=[1, 2, 3, 4, 5, 6])
+    odd = cube.newtexcube(tex=[1, 2, 3, 4, 5, 6]).mutable()
+    odd.setsurface(0, SurfaceInfo(2, 7, 0, 32))
+    m.world[3] = odd
+
+    out = str(tmpdir.join('leaves.mpz'))
+    m.write(out)
+    world = MapParser().read(out).world
+    assert world[0].octsav == OCT.OCTSAV_EMPTY.value
+    assert world[1].texture == world[2].texture == (1, 2, 3, 4, 5, 6)
+    assert world[2].ext.surfaces[0].lmid == (2, 0)
+    assert world[3].ext.surfaces[0].lmid == (2, 7)
+
+
+@pytest.mark.parametrize('mode', [{'keep_world_bytes': True}, {'lazy': True}, {'streaming': True, 'keep_world_bytes': True}])
+def test_reuse_world(tmpdir, mode):
+    src = os.path.join(FILES, 'scaff2.mpz')
+    reused = str(tmpdir.join('reused.mpz'))
+    full = str(tmpdir.join('full.mpz'))
+
+    mp = MapParser()
+    mp.window_size = 100
+    m = mp.read(src, **mode)
+    m.ents.append(Sunlight(red=10, green=20, blue=30, offset=45))
+    m.map_vars[b'maptitle'] = b'patched'
+    m.write(reused, reuse_world=True)
+    m.write(full)
+    assert raw(reused) == raw(full)
+
+    m = MapParser().read(reused)
+    assert m.map_vars[b'maptitle'] == b'patched'
+    assert m.ents[-1].type == EntType.ET_SUNLIGHT
+
+
+def test_reuse_replaced_world(tmpdir):
+    m = MapParser().read(os.path.join(FILES, 'scaff1.mpz'), keep_world_bytes=True)
+    m.world = cube.newcubes()
+    with pytest.raises(ValueError):
+        m.write(str(tmpdir.join('out.mpz')), reuse_world=True)
+
+    # Not kept by default
+    m = MapParser().read(os.path.join(FILES, 'scaff1.mpz'))
+    assert m.world_bytes is None
+    with pytest.raises(ValueError):
+        m.write(str(tmpdir.join('out.mpz')), reuse_world=True)
+
+
+def test_streaming_memory(tmpdir):
+    src = str(tmpdir.join('big.mpz'))
+    m = MapParser().read(os.path.join(FILES, 'scaff1.mpz'))
+    v = VoxelWorld(size=m.meta['worldsize'])
+    for x in range(32):
+        for y in range(32):
+            for z in range(0, 16, 2):
+                v.set_point(x, y, z + (x + y) % 2, cube.newtexcube(tex=1 + (x * y + z) % 5))
+    m.write(src, voxels=v)
+    size = len(raw(src))
+    assert size > 1 << 19
+
+    def peak(**kwargs):
+        mp = MapParser()
+        tracemalloc.start()
+        try:
+            m = mp.read(src, **kwargs)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return m, peak - current
+
+    # Nothing beyond the cubes is held while streaming, however big the
+    # map is
+    m, extra = peak(streaming=True)
+    assert extra < 1 << 17
+    assert m.world_bytes is None
+    m, extra = peak(streaming=True, keep_world_bytes=True)
+    assert extra > size
+    assert m.world_bytes == MapParser().read(src, keep_world_bytes=True).world_bytes
+
+
+def test_sections(tmpdir):
+    src = os.path.join(FILES, 'scaff3.mpz')
+    full = MapParser().read(src)
+
+    mp = MapParser()
+    mp.window_size = 64
+    m = mp.read(src, sections=['ents'])
+    assert m.meta == full.meta
+    assert m.map_vars == full.map_vars
+    assert [e.to_dict() for e in m.ents] == [e.to_dict() for e in full.ents]
+    assert m.vslots is None and m.world is None
+    # Decompression stopped right after the entities
+    assert mp.offset + len(mp.bytes) < len(raw(src)) - mp.window_size
+    with pytest.raises(ValueError):
+        m.write(str(tmpdir.join('out.mpz')))
+
+    # A template without its world, for writing a new one
+    m = MapParser().read(src, sections=SECTIONS[:-1])
+    assert m.chg == full.chg
+    out = str(tmpdir.join('template.mpz'))
+    v = VoxelWorld(size=m.meta['worldsize'])
+    v.set_point(1, 2, 3, cube.newtexcube(tex=4))
+    m.write(out, voxels=v)
+    written = MapParser().read(out)
+    assert written.map_vars == full.map_vars
+    assert written.chg == full.chg
+
+    with pytest.raises(ValueError):
+        MapParser().read(src, sections=['lights'])
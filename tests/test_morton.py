@@ -0,0 +1,116 @@
+import random
+
+import numpy as np
+import pytest
+
+from redeclipse.objects import cube
+from redeclipse.voxel import VoxelWorld
+from redeclipse.voxel.morton import (
+    morton_encode, morton_decode, morton_encode_array, morton_decode_array,
+    MortonIndex, MORTON_MAX
+)
+
+from test_voxel import shape
+
+
+def test_encode():
+    assert morton_encode(0, 0, 0) == 0
+    assert morton_encode(1, 0, 0) == 1
+    assert morton_encode(0, 1, 0) == 2
+    assert morton_encode(0, 0, 1) == 4
+    assert morton_encode(3, 3, 3) == 63
+    assert morton_encode(2, 0, 0) == 8
+    random.seed(1)
+    for i in range(200):
+        key = tuple(random.randrange(1 << 30) for j in range(3))
+        assert morton_decode(morton_encode(*key)) == key
+
+
+def test_arrays():
+    random.seed(2)
+    coords = np.array([[random.randrange(MORTON_MAX) for j in range(3)] for i in range(500)] + [[MORTON_MAX - 1] * 3])
+    codes = morton_encode_array(coords)
+    assert codes.dtype == np.uint64
+    assert codes.tolist() == [morton_encode(*key) for key in coords.tolist()]
+    assert (morton_decode_array(codes) == coords).all()
+    with pytest.raises(ValueError):
+        morton_encode_array([[MORTON_MAX, 0, 0]])
+    with pytest.raises(ValueError):
+        morton_encode_array([[-1, 0, 0]])
+
+
+def brute(keys, lo, hi):
+    return sorted(k for k in keys if all(l <= c < h for (l, c, h) in zip(lo, k, hi)))
+
+
+def test_index():
+    random.seed(3)
+    keys = set(tuple(random.randrange(100) for j in range(3)) for i in range(3000))
+    index = MortonIndex(keys)
+    index.add((-1, 0, 0))
+    index.add((1.5, 0, 0))
+    gone = sorted(keys)[:100]
+    for key in gone:
+        index.discard(key)
+    keys -= set(gone)
+    index.add_array(np.array([[200, 200, 200], [201, 200, 200]]))
+    index.discard_array(np.array([[201, 200, 200]]))
+    keys.add((200, 200, 200))
+
+    assert len(index) == len(keys)
+    codes = index.sorted_codes()
+    assert (np.diff(codes.astype(np.int64)) > 0).all()
+
+    cell = index.cell(32, 64, 0, 32)
+    assert sorted(map(tuple, cell.tolist())) == brute(keys, (32, 64, 0), (64, 96, 32))
+    assert index.cell(0, 0, 0, 1024).shape == (len(keys), 3)
+    with pytest.raises(ValueError):
+        index.cell(3, 0, 0, 4)
+
+    for (lo, hi) in [((10, 20, 30), (50, 41, 99)), ((0, 0, 0), (100, 100, 100)), ((5, 5, 5), (6, 6, 6)), ((-5, 0, 0), (3, 300, 300)), ((9, 9, 9), (9, 10, 10))]:
+        found = index.box(lo, hi)
+        assert sorted(map(tuple, found.tolist())) == brute(keys, lo, hi)
+        # In Z-order
+        assert morton_encode_array(found).tolist() == sorted(morton_encode_array(found).tolist())
+
+
+def test_world_index():
+    random.seed(4)
+    plain = VoxelWorld(size=64)
+    indexed = VoxelWorld(size=64, morton_index=True)
+    for v in (plain, indexed):
+        random.seed(4)
+        for i in range(500):
+            v.set_point(random.randrange(64), random.randrange(64), random.randrange(64), cube.newtexcube(tex=random.randrange(1, 9)))
+        v.set_point(2.0, 3.0, 4.0, cube.newtexcube(tex=11))
+        v.set_point(70, 0, 0, cube.newtexcube(tex=12))
+        v.set_point(5, 5, 5, None)
+        v.del_point(2, 3, 4)
+
+    assert shape(indexed.to_octree()) == shape(plain.to_octree())
+    assert sorted(map(tuple, indexed.index.box((0, 0, 0), (64, 64, 64)).tolist())) == brute(plain.world.keys(), (0, 0, 0), (64, 64, 64))
+
+
+def test_small_fills():
+    # Many small boxes, mixed with point changes: nothing is merged until
+    # the index is asked, and the order of the changes holds
+    random.seed(5)
+    plain = VoxelWorld(size=64)
+    indexed = VoxelWorld(size=64, morton_index=True)
+    for v in (plain, indexed):
+        random.seed(5)
+        for i in range(3000):
+            (x, y, z) = (random.randrange(60) for j in range(3))
+            op = random.randrange(4)
+            if op == 0:
+                v.fill_box((x, y, z), (x + 1, y + 1, z + 1), tex=2)
+            elif op == 1:
+                v.fill_box((x, y, z), (x + 2, y + 1, z + 3), tex=3)
+            elif op == 2:
+                v.clear_box((x, y, z), (x + 2, y + 2, z + 1))
+            else:
+                v.del_point(x, y, z)
+                v.set_point(x + 1, y, z, cube.newtexcube(tex=4))
+    assert len(indexed.index.codes) == 0
+    assert len(indexed.index) == len(plain.world)
+    assert sorted(map(tuple, indexed.index.box((0, 0, 0), (64, 64, 64)).tolist())) == sorted(plain.world)
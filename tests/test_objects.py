@@ -0,0 +1,85 @@
+import pickle
+
+import pytest
+
+from redeclipse import objects
+from redeclipse.objects import cube, SurfaceInfo, EMPTY
+
+
+def test_flyweights():
+    a = cube.newtexcube(tex=3)
+    assert a is cube.newtexcube(tex=[3] * 6)
+    assert a is not cube.newtexcube(tex=4)
+    assert a.texture == (3,) * 6
+    with pytest.raises(TypeError):
+        a.octsav = 0
+    with pytest.raises(TypeError):
+        EMPTY.texture = (1,) * 6
+    with pytest.raises(AttributeError):
+        cube().unknown = 1
+
+
+def test_copy_on_write():
+    shared = cube.newtexcube(tex=3)
+    c = shared.mutable()
+    assert c is not shared and not c.shared
+    assert c.mutable() is c
+    c.texture = (1,) * 6
+    c.setsurface(0, SurfaceInfo(2, 7, 0, 32))
+    assert shared.texture == (3,) * 6
+    assert shared.ext.surfaces[0].lmid == (2, 0)
+    assert c.ext.surfaces[1].lmid == (2, 0)
+
+    # Textured cubes of your own still share the surfaces until changed
+    own = cube.texturize(cube.newcube(), tex=5)
+    other = cube.texturize(cube.newcube(), tex=5)
+    own.setsurface(0, SurfaceInfo(3, 0, 0, 32))
+    assert other.ext.surfaces[0].lmid == (2, 0)
+
+
+def test_cube_ids(monkeypatch):
+    assert cube().cube_id is None
+    monkeypatch.setattr(objects, 'TRACK_CUBE_IDS', True)
+    a = cube()
+    b = cube()
+    assert b.cube_id > a.cube_id
+
+
+def test_pickle():
+    a = cube.newtexcube(tex=3)
+    assert pickle.loads(pickle.dumps(a)) is a
+    assert pickle.loads(pickle.dumps(EMPTY)) is EMPTY
+    c = a.mutable()
+    assert pickle.loads(pickle.dumps(c)).texture == c.texture
+
+
+def test_validatec_shared():
+    children = [EMPTY] * 7 + [cube.newtexcube(3)]
+    cube.validatec(children, 4)
+    # Nothing to change, still shared
+    assert children[0] is EMPTY and children[7] is cube.newtexcube(3)
+
+    # Changes go to copies
+    bad = cube.newtexcube(4)
+    children = [bad] + [EMPTY] * 7
+    object.__setattr__(bad, 'faces', (0x01010101, ) * 3)
+    try:
+        cube.validatec(children, 4)
+    finally:
+        object.__setattr__(bad, 'faces', objects.SOLID_FACES)
+    assert children[0] is not bad and not children[0].shared
+    assert children[0].faces == objects.EMPTY_FACES
+
+    parent = cube.newcube()
+    parent.children = [cube.newtexcube(3)] * 8
+    parent.octsav = 0
+    root = [parent] + [EMPTY] * 7
+    cube.validatec(root, 1)
+    assert root[0].children is None
+    assert root[0].faces == objects.SOLID_FACES
+    assert root[0].octsav == 2
+
+    root = [cube.newtexcube(3)] + [EMPTY] * 7
+    cube.validatec(root, 0x2000)
+    assert not root[0].shared and root[0].octsav == 0
+    assert [c.texture for c in root[0].children] == [(3, ) * 6] * 8
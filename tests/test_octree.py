@@ -0,0 +1,171 @@
+import gzip
+import os
+import random
+
+import pytest
+
+from redeclipse import MapParser
+from redeclipse.enums import OCT
+from redeclipse.objects import cube
+from redeclipse.octree import OctreeStore
+from redeclipse.voxel import VoxelWorld
+
+FILES = os.path.join(os.path.dirname(__file__), 'files')
+
+
+def raw(path):
+    with gzip.open(path) as handle:
+        return handle.read()
+
+
+def textures(cube_arr):
+    found = []
+    stack = [iter(cube_arr)]
+    while stack:
+        c = next(stack[-1], None)
+        if c is None:
+            stack.pop()
+            continue
+        if c.children:
+            found.append(c.octsav)
+            stack.append(iter(c.children))
+        else:
+            found.append((c.octsav, tuple(c.texture)))
+    return found
+
+
+@pytest.mark.parametrize('name', ['scaff1.mpz', 'scaff3.mpz', 'empty-large.mpz'])
+def test_roundtrip(tmpdir, name):
+    src = os.path.join(FILES, name)
+    out = str(tmpdir.join(name))
+
+    m = MapParser().read(src, arrays=True)
+    assert isinstance(m.world, OctreeStore)
+    m.write(out)
+    assert raw(out) == raw(src)
+
+    # Views look like the cubes of the object tree
+    assert textures(m.world) == textures(MapParser().read(src).world)
+    assert textures(m.world.to_cubes()) == textures(m.world)
+
+
+def test_views(tmpdir):
+    src = os.path.join(FILES, 'scaff3.mpz')
+    out = str(tmpdir.join('edited.mpz'))
+    m = MapParser().read(src, arrays=True)
+    c = m.world[7]
+    while c.children:
+        c = c.children[7]
+    c.texture = (5, 5, 5, 5, 5, 5)
+    m.write(out)
+
+    c = MapParser().read(out).world[7]
+    while c.children:
+        c = c.children[7]
+    assert c.texture == (5, 5, 5, 5, 5, 5)
+
+
+def test_from_voxels(tmpdir):
+    random.seed(5)
+    v = VoxelWorld(size=32)
+    for i in range(300):
+        v.set_point(random.randrange(32), random.randrange(32), random.randrange(32), cube.newtexcube(tex=random.randrange(5)))
+    store = v.to_store()
+    world = v.to_octree()
+    assert textures(store) == textures(OctreeStore.from_cubes(world))
+    assert [c.octsav for c in store] == [c.octsav for c in world]
+
+
+def write(tmpdir, world, name):
+    m = MapParser().read(os.path.join(FILES, 'scaff1.mpz'))
+    m.world = world
+    out = str(tmpdir.join(name))
+    m.write(out)
+    return raw(out)
+
+
+@pytest.mark.parametrize('name', sorted(os.listdir(FILES)))
+def test_validate_parity(tmpdir, name):
+    # Both ways of reading a map write the same bytes
+    src = os.path.join(FILES, name)
+    assert write(tmpdir, MapParser().read(src, arrays=True).world, 'arrays.mpz') == \
+        write(tmpdir, MapParser().read(src).world, 'cubes.mpz')
+
+
+@pytest.mark.parametrize('size', [1, 0x2000])
+def test_validate(tmpdir, size):
+    def world():
+        root = cube.newcubes()
+        # A flat (invalid) deformed cube
+        root[3].octsav = OCT.OCTSAV_NORMAL.value
+        root[3].edges = (0, ) * 12
+        root[4] = cube.newtexcube(tex=4)
+        # Children, of a unit cube with size 1
+        root[5].octsav = OCT.OCTSAV_CHILDREN.value
+        root[5].children = [cube.newtexcube(tex=3)] * 8
+        return root
+
+    store = OctreeStore.from_cubes(world())
+    store.validate(size)
+    cubes = world()
+    cube.validatec(cubes, size)
+    assert write(tmpdir, store, 'arrays.mpz') == write(tmpdir, cubes, 'cubes.mpz')
+
+    if size == 1:
+        # Invalid faces are only emptied in the faces, which are not stored
+        assert store[3].octsav == OCT.OCTSAV_NORMAL.value
+        assert store[3].edges == (0, ) * 12
+        assert store[5].octsav == OCT.OCTSAV_SOLID.value
+        assert store[5].children is None
+    else:
+        assert [c.octsav for c in store[3].children] == [OCT.OCTSAV_NORMAL.value] * 8
+        assert [c.texture for c in store[4].children] == [(4, ) * 6] * 8
+
+
+def test_leaves():
+    random.seed(6)
+    v = VoxelWorld(size=32)
+    for i in range(300):
+        v.set_point(random.randrange(32), random.randrange(32), random.randrange(32), cube.newtexcube(tex=random.randrange(5)))
+    store = v.to_store()
+    nodes, corners, sizes = store.leaves(16)
+
+    expected = []
+    stack = [(0, 0, 0, 0, 16)]
+    while stack:
+        block, x, y, z, size = stack.pop()
+        for i in range(8):
+            corner = (x + (i & 1) * size, y + (i >> 1 & 1) * size, z + (i >> 2 & 1) * size)
+            if store.child[block + i] >= 0:
+                stack.append((store.child[block + i], ) + corner + (size >> 1, ))
+            else:
+                expected.append((block + i, ) + corner + (size, ))
+    found = [(n, ) + tuple(c) + (s, ) for (n, c, s) in zip(nodes.tolist(), corners.tolist(), sizes.tolist())]
+    assert sorted(found) == sorted(expected)
+    # Every voxel is a unit leaf
+    textured = [tuple(c) for (n, c) in zip(nodes.tolist(), corners.tolist()) if store.octsav[n] != OCT.OCTSAV_EMPTY.value]
+    assert sorted(textured) == sorted(v.world)
+
+
+def test_truncated():
+    data = raw(os.path.join(FILES, 'scaff1.mpz'))
+    m = MapParser().read(os.path.join(FILES, 'scaff1.mpz'), keep_world_bytes=True)
+    start = len(data) - len(m.world_bytes) + 4 * len(m.chg)
+    with pytest.raises(EOFError):
+        OctreeStore.decode(memoryview(data)[:start + 50], start)
+
+
+def test_views_to_dict():
+    src = os.path.join(FILES, 'scaff3.mpz')
+    arrays = MapParser().read(src, arrays=True).to_dict()
+    cubes = MapParser().read(src).to_dict()
+    assert list(arrays['world']) == list(cubes['world'])
+
+
+def test_views_children_read_only():
+    m = MapParser().read(os.path.join(FILES, 'scaff3.mpz'), arrays=True)
+    c = m.world[7]
+    assert isinstance(c.children, tuple)
+    # Replacing a child would only change a throwaway list
+    with pytest.raises(TypeError):
+        c.children[0] = m.world[0]
@@ -0,0 +1,92 @@
+import random
+
+from redeclipse import aftereffects as ae
+from redeclipse.objects import cube
+from redeclipse.voxel import VoxelWorld
+from redeclipse.voxel.overlay import OverlayStorage
+
+from test_voxel import shape
+
+
+def base(**kwargs):
+    v = VoxelWorld(size=32, **kwargs)
+    v.fill_box((0, 0, 0), (32, 32, 4), tex=3)
+    v.fill_box((4, 4, 4), (8, 8, 20), tex=4)
+    v.set_point(1.5, 0, 0, 'odd')
+    return v
+
+
+def test_snapshot():
+    for kwargs in ({}, {'chunked': True}, {'morton_index': True}):
+        v = base(**kwargs)
+        before = dict(v.world.items())
+        octree = shape(v.to_octree())
+
+        s = v.snapshot()
+        random.seed(1)
+        ae.decay(s, lambda x, y, z: 0.5)
+        s.set_point(20, 20, 20, cube.newtexcube(tex=9))
+        s.del_point(1.5, 0, 0)
+        assert s.zmax == 20
+        assert len(s.world) < len(before)
+
+        # The original is untouched
+        assert dict(v.world.items()) == before
+        assert shape(v.to_octree()) == octree
+        assert v.zmax == 19
+
+        # And so is the snapshot by later writes to the original
+        t = s.snapshot()
+        snapped = dict(s.world.items())
+        v.fill_box((0, 0, 0), (32, 32, 32), tex=5)
+        assert dict(s.world.items()) == snapped
+        s.clear_box((0, 0, 0), (32, 32, 32))
+        assert dict(t.world.items()) == snapped
+        assert len(v.world) == 32 ** 3 + 1
+
+
+def test_snapshot_shares_chunks():
+    v = base(chunked=True)
+    s = v.snapshot()
+    assert s.world.chunks is v.world.chunks
+    s.set_point(0, 0, 0, cube.newtexcube(tex=7))
+    changed = [key for key in v.world.chunks if s.world.chunks[key] is not v.world.chunks[key]]
+    assert changed == [(0, 0, 0)]
+    assert v.get_point(0, 0, 0) is cube.newtexcube(tex=3)
+
+
+def test_overlay():
+    for kwargs in ({}, {'chunked': True}):
+        v = base(**kwargs)
+        before = dict(v.world.items())
+        layer = v.overlay()
+        assert isinstance(layer.world, OverlayStorage)
+        assert dict(layer.world.items()) == before
+
+        ae.grid(layer, size=8)
+        layer.del_point(4, 4, 4)
+        layer.set_point(30, 30, 30, cube.newtexcube(tex=8))
+        seen = dict(layer.world.items())
+        assert (4, 4, 4) not in seen and (30, 30, 30) in seen
+        assert len(layer.world) == len(seen)
+        assert dict(v.world.items()) == before
+
+        # Layers stack
+        top = layer.overlay()
+        top.clear_box((0, 0, 0), (32, 32, 32))
+        assert len(top.world) == 1
+        top.drop()
+        assert dict(top.world.items()) == seen
+
+        layer.drop()
+        assert dict(layer.world.items()) == before
+        assert (layer.zmax, layer.xmax) == (v.zmax, v.xmax)
+
+        layer.del_point(4, 4, 4)
+        layer.set_point(30, 30, 30, cube.newtexcube(tex=8))
+        layer.flatten()
+        assert (4, 4, 4) not in v.world
+        assert v.get_point(30, 30, 30) is cube.newtexcube(tex=8)
+        assert v.zmax == 30
+        assert not layer.world.changes
+        assert dict(layer.world.items()) == dict(v.world.items())
@@ -0,0 +1,43 @@
+import gzip
+import os
+import random
+
+from redeclipse import MapParser
+from redeclipse.pgzip import ParallelGzipFile
+
+FILES = os.path.join(os.path.dirname(__file__), 'files')
+
+
+def test_pgzip(tmpdir):
+    out = str(tmpdir.join('data.gz'))
+    random.seed(4)
+    data = bytes(random.randrange(16) for i in range(50000)) * 3
+
+    with ParallelGzipFile(out, threads=3, block_size=4096) as handle:
+        for i in range(0, len(data), 1000):
+            handle.write(data[i:i + 1000])
+
+    with gzip.open(out) as handle:
+        assert handle.read() == data
+
+
+def test_empty(tmpdir):
+    out = str(tmpdir.join('empty.gz'))
+    with ParallelGzipFile(out, threads=2):
+        pass
+
+    with gzip.open(out) as handle:
+        assert handle.read() == b''
+
+
+def test_map_threads(tmpdir):
+    src = os.path.join(FILES, 'scaff3.mpz')
+    out = str(tmpdir.join('threaded.mpz'))
+
+    m = MapParser().read(src)
+    m.write(out, threads=4)
+    with gzip.open(out) as a, gzip.open(src) as b:
+        assert a.read() == b.read()
+
+    for streaming in (False, True):
+        assert len(MapParser().read(out, streaming=streaming).world) == 8
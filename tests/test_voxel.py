@@ -1,5 +1,17 @@
-from redeclipse.voxel import VoxelWorld
-from redeclipse.objects import cube
+import gzip
+import os
+import random
+
+import numpy as np
+import pytest
+
+from redeclipse import MapParser
+from redeclipse.voxel import VoxelWorld, OCTREE_CHILDREN
+from redeclipse.objects import cube, EMPTY
+from redeclipse.vector import FineVector
+from redeclipse.voxel.visibility import is_opaque, flood_fill, hidden
+
+FILES = os.path.join(os.path.dirname(__file__), 'files')
 
 
 def test_octree():
@@ -13,3 +25,334 @@ def test_octree():
 
     assert q[0].children[0] == True
     assert q[7].children[7] == True
+
+
+@pytest.mark.parametrize('size', [2, 3])
+def test_octree_root_mutable(size):
+    # Roots which are leaves are never the shared ones
+    v = VoxelWorld(size=size)
+    v.set_point(0, 0, 0, cube.newtexcube(tex=3))
+    for collapse in (False, True):
+        q = v.to_octree(collapse=collapse)
+        assert not any(c.shared for c in q)
+        q[0].octsav = 0
+        assert q[0].texture == (3, ) * 6
+
+
+def two_step(tmpdir, v):
+    m = MapParser().read(os.path.join(FILES, 'empty.mpz'))
+    out = str(tmpdir.join('two_step.mpz'))
+    m.world = v.to_octree()
+    m.world[0].octsav = 0
+    m.write(out)
+    with gzip.open(out) as handle:
+        return handle.read()
+
+
+def fused(tmpdir, v):
+    m = MapParser().read(os.path.join(FILES, 'empty.mpz'))
+    out = str(tmpdir.join('fused.mpz'))
+    m.write(out, voxels=v)
+    with gzip.open(out) as handle:
+        return handle.read()
+
+
+def test_fused_writer(tmpdir):
+    random.seed(3)
+    v = VoxelWorld(size=32)
+    for i in range(400):
+        v.set_point(
+            random.randrange(32), random.randrange(32), random.randrange(16),
+            cube.newtexcube(tex=random.randrange(4))
+        )
+    # Never looked at by to_octree
+    v.set_point(40, 0, 0, cube.newtexcube(tex=9))
+    v.set_point(-1, 0, 0, cube.newtexcube(tex=9))
+    v.set_point(3, 3, 3, None)
+    v.set_pointv(FineVector(5, 5, 5), cube.newtexcube(tex=2))
+
+    assert fused(tmpdir, v) == two_step(tmpdir, v)
+
+
+def test_fused_writer_empty_root(tmpdir):
+    v = VoxelWorld(size=16)
+    # First root octant stays empty
+    v.set_point(15, 15, 15, cube.newtexcube(tex=3))
+    assert fused(tmpdir, v) == two_step(tmpdir, v)
+
+    v = VoxelWorld(size=16)
+    assert fused(tmpdir, v) == two_step(tmpdir, v)
+
+
+def test_octree_walk():
+    v = VoxelWorld(size=4)
+    v.set_point(0, 0, 0, 'a')
+    v.set_point(3, 3, 3, 'b')
+
+    walk = list(v.octree_walk())
+    assert walk[0] is OCTREE_CHILDREN
+    assert walk[1:9] == ['a'] + [None] * 7
+    assert walk[9:15] == [None] * 6
+    assert walk[15] is OCTREE_CHILDREN
+    assert walk[16:] == [None] * 7 + ['b']
+
+
+def shape(cube_arr):
+    """Nested description of an octree, leaves by identity"""
+    result = []
+    for c in cube_arr:
+        if isinstance(c, cube) and c.children:
+            result.append(shape(c.children))
+        elif isinstance(c, cube) and c.octsav == cube.newcube().octsav:
+            result.append('empty')
+        else:
+            result.append(id(c))
+    return result
+
+
+def test_sparse_octree():
+    random.seed(7)
+    v = VoxelWorld(size=64)
+    for i in range(500):
+        v.set_point(random.randrange(64), random.randrange(64), random.randrange(64), cube.newtexcube(tex=random.randrange(1, 9)))
+    v.set_point(2.0, 3.0, 4.0, cube.newtexcube(tex=11))
+    v.set_point(70, 0, 0, cube.newtexcube(tex=12))
+    v.set_point(1.5, 0, 0, cube.newtexcube(tex=13))
+    v.set_point(5, 5, 5, None)
+
+    assert shape(v.to_octree()) == shape(v._to_octree_dense())
+
+    # Only occupied space is visited
+    v = VoxelWorld(size=2 ** 10)
+    v.set_point(1000, 3, 600, cube.newtexcube(tex=3))
+    node = v.to_octree()
+    for bit in range(9, -1, -1):
+        node = (node if bit == 9 else node.children)[((1000 >> bit) & 1) | (((3 >> bit) & 1) << 1) | (((600 >> bit) & 1) << 2)]
+    assert node.texture == (3,) * 6
+
+
+def test_collapse(tmpdir):
+    v = VoxelWorld(size=32)
+    # A solid 8x8x8 block of one texture, aligned to an octree cell
+    for x in range(8, 16):
+        for y in range(8):
+            for z in range(8):
+                v.set_point(x, y, z, cube.newtexcube(tex=4))
+    # Explicitly empty cells merge with the missing ones
+    for x in range(4):
+        for y in range(4):
+            v.set_point(x, y, 0, cube.newcube())
+    # Not uniform: one different texture
+    for x in range(4):
+        for y in range(4):
+            for z in range(4):
+                v.set_point(x, y, z + 8, cube.newtexcube(tex=5 if (x, y, z) == (1, 1, 1) else 6))
+
+    q = v.to_octree(collapse=True)
+    root = q[0]
+    assert root.children[1] is cube.newtexcube(tex=4)
+    assert root.children[0] is EMPTY or not root.children[0].children
+    assert root.children[4].children[0].children
+
+    # Same octree as without collapsing, only with larger leaves
+    full = v.to_octree()
+    assert len(shape(full)[0][1]) == 8
+    assert shape(v.to_octree(collapse=True)) == shape(q)
+
+    # The streamed writer collapses the same way
+    m = MapParser().read(os.path.join(FILES, 'empty.mpz'))
+    out = str(tmpdir.join('two_step.mpz'))
+    m.world = q
+    m.world[0].octsav = 0
+    m.write(out)
+    with gzip.open(out) as handle:
+        expected = handle.read()
+
+    out = str(tmpdir.join('fused.mpz'))
+    m.write(out, voxels=v, collapse=True)
+    with gzip.open(out) as handle:
+        assert handle.read() == expected
+    assert len(expected) < len(fused(tmpdir, v))
+
+    # The root cubes are never merged
+    v = VoxelWorld(size=4)
+    for x in range(2):
+        for y in range(2):
+            for z in range(2):
+                v.set_point(x, y, z, cube.newtexcube(tex=4))
+    assert v.to_octree(collapse=True)[0].children
+
+
+def bulk(v):
+    v.fill_box((1, 2, 3), (5, 4, 9), tex=3)
+    v.fill_box((0, 0, 0), (0, 5, 5), tex=3)
+    v.fill_column(7, 7, 2, 6, data=cube.newtexcube(tex=4))
+    v.clear_box((2, 2, 4), (4, 3, 6))
+    textures = np.full((3, 2, 1), -1)
+    textures[0, 0, 0] = 5
+    textures[2, 1, 0] = 6
+    v.paste((10, 10, 0), textures, rotate=1)
+    v.paste((20, 0, 0), np.array([[[cube.newtexcube(tex=7), None]]], dtype=object))
+    return v
+
+
+def points(v):
+    v.set_point(-1, -1, -1, True)
+    for x in range(1, 5):
+        for y in range(2, 4):
+            for z in range(3, 9):
+                v.set_point(x, y, z, cube.newtexcube(tex=3))
+    for z in range(2, 6):
+        v.set_point(7, 7, z, cube.newtexcube(tex=4))
+    for x in range(2, 4):
+        for z in range(4, 6):
+            v.del_point(x, 2, z)
+    # (0, 0) -> (0, 0) and (2, 1) -> (-1, 2) turned a quarter, shifted
+    # back to start at the offset: x in 0..1, y in 0..2
+    v.set_point(11, 10, 0, cube.newtexcube(tex=5))
+    v.set_point(10, 12, 0, cube.newtexcube(tex=6))
+    v.set_point(20, 0, 0, cube.newtexcube(tex=7))
+    v.del_point(-1, -1, -1)
+    return v
+
+
+def test_bulk():
+    expected = points(VoxelWorld(size=32))
+    assert expected.get_point(11, 10, 0) is not None
+    for kwargs in ({}, {'chunked': True}, {'morton_index': True}):
+        v = bulk(VoxelWorld(size=32, **kwargs))
+        assert dict(v.world.items()) == dict(expected.world.items())
+        assert (v.xmin, v.xmax, v.ymin, v.ymax, v.zmin, v.zmax) == (1, 20, 0, 12, 0, 8)
+        assert shape(v.to_octree()) == shape(expected.to_octree())
+        if v.index is not None:
+            assert len(v.index) == len(expected.world)
+
+    # Clearing more than there is in the world
+    v = bulk(VoxelWorld(size=32))
+    v.clear_box((0, 0, 0), (32, 32, 32))
+    assert not v.world
+
+    with pytest.raises(ValueError):
+        v.fill_box((0.5, 0, 0), (1, 1, 1), tex=2)
+
+
+def test_parallel():
+    random.seed(3)
+    v = VoxelWorld(size=64)
+    for i in range(2000):
+        v.set_point(random.randrange(64), random.randrange(64), random.randrange(16), cube.newtexcube(tex=random.randrange(1, 3)))
+    v.fill_box((32, 32, 32), (64, 64, 64), tex=4)
+    v.fill_box((0, 0, 48), (8, 8, 56), data=EMPTY)
+    v.set_point(70, 0, 0, cube.newtexcube(tex=12))
+    v.set_point(5, 5, 5, None)
+    for kwargs in ({}, {'chunked': True}, {'morton_index': True}):
+        w = VoxelWorld(size=64, **kwargs)
+        for (key, value) in v.world.items():
+            w.set_point(*key, data=value)
+        for collapse in (False, True):
+            expected = shape(w.to_octree(collapse=collapse))
+            for split in (1, 2):
+                assert shape(w.to_octree(collapse=collapse, workers=2, split=split)) == expected
+
+    # Split down to the unit cubes
+    v = VoxelWorld(size=4)
+    v.set_point(0, 0, 0, cube.newtexcube(tex=3))
+    v.set_point(3, 3, 3, cube.newtexcube(tex=4))
+    assert shape(v.to_octree(workers=2, split=5)) == shape(v.to_octree())
+
+
+def test_cull_hidden():
+    for kwargs in ({}, {'chunked': True}, {'morton_index': True}):
+        v = VoxelWorld(size=32, **kwargs)
+        v.fill_box((2, 2, 2), (10, 10, 10), tex=3)
+        # A sealed cavity, and an empty cube which is air all the same
+        v.clear_box((5, 5, 5), (7, 7, 7))
+        v.set_point(2, 5, 5, EMPTY)
+        v.set_point(20, 20, 20, True)
+
+        s = v.snapshot()
+        # Only the outer shell (and what the empty cube shows) is left, the
+        # cavity can't be reached
+        assert s.cull_hidden() == 6 ** 3 - 8 - 1
+        assert s.get_point(2, 3, 3) is cube.newtexcube(tex=3)
+        assert s.get_point(3, 5, 5) is cube.newtexcube(tex=3)
+        assert s.get_point(4, 5, 5) is None
+        assert s.get_point(20, 20, 20) is True
+        if s.index is not None:
+            assert len(s.index) == len(s.world)
+
+        # Unless it is where the players are
+        s = v.snapshot()
+        assert s.cull_hidden(seeds=[(5, 5, 5)]) == 6 ** 3 - 8 - 1 - 6 * 4
+        assert s.get_point(4, 5, 5) is cube.newtexcube(tex=3)
+
+        # Or fill the hidden part with one texture, which collapses
+        s = v.snapshot()
+        s.cull_hidden(tex=4)
+        assert len(s.world) == len(v.world)
+        assert s.get_point(4, 4, 4) is cube.newtexcube(tex=4)
+        assert s.get_point(2, 3, 3) is cube.newtexcube(tex=3)
+
+        # Or with what most of it is already
+        s = v.snapshot()
+        s.set_point(4, 4, 4, cube.newtexcube(tex=5))
+        s.cull_hidden(uniform=True)
+        assert s.get_point(4, 4, 4) is cube.newtexcube(tex=3)
+        assert len(s.world) == len(v.world)
+
+    assert VoxelWorld().cull_hidden() == 0
+
+
+def dense_hidden(v, seeds=()):
+    # The hidden voxels worked out on one grid over the whole bounds
+    cells = np.array([key for (key, value) in v.world.items() if is_opaque(value)])
+    lower = cells.min(axis=0) - 1
+    opaque = np.zeros(cells.max(axis=0) - lower + 2, dtype=bool)
+    opaque[tuple((cells - lower).T)] = True
+    start = np.ones(opaque.shape, dtype=bool)
+    start[1:-1, 1:-1, 1:-1] = False
+    for seed in seeds:
+        start[tuple(np.array(seed) - lower)] = True
+    hide = hidden(opaque, flood_fill(~opaque, start))
+    return set(map(tuple, (np.argwhere(hide) + lower).tolist()))
+
+
+def test_cull_blocks():
+    # Walls with holes in them across many blocks, and a closed box with a
+    # winding way in, as one grid would see them
+    rng = random.Random(3)
+    for kwargs in ({}, {'chunked': True}):
+        v = VoxelWorld(size=64, **kwargs)
+        v.fill_box((1, 1, 1), (50, 50, 50), tex=3)
+        v.clear_box((2, 2, 2), (49, 49, 49))
+        for x in range(6, 46, 7):
+            v.fill_box((x, 2, 2), (x + 1, 49, 49), tex=3)
+            for _ in range(3):
+                y, z = rng.randrange(2, 49), rng.randrange(2, 49)
+                v.del_point(x, y, z)
+        for _ in range(500):
+            v.set_point(rng.randrange(2, 49), rng.randrange(2, 49), rng.randrange(2, 49), cube.newtexcube(tex=4))
+        for seeds in ([], [(3, 3, 3)], [(3, 3, 3), (47, 47, 47)]):
+            s = v.snapshot()
+            expected = dense_hidden(s, seeds)
+            assert s.cull_hidden(seeds=seeds) == len(expected)
+            assert all(s.get_point(*key) is None for key in expected)
+            assert len(s.world) == len(v.world) - len(expected)
+
+    # Far apart voxels only need the blocks they are in
+    for kwargs in ({}, {'chunked': True}):
+        v = VoxelWorld(size=4096, **kwargs)
+        v.fill_box((0, 0, 0), (3, 3, 3), tex=3)
+        v.fill_box((4000, 4000, 4000), (4003, 4003, 4003), tex=3)
+        assert v.cull_hidden() == 2
+
+        v.set_point(-10 ** 6, 0, 0, cube.newtexcube(tex=3))
+        assert v.cull_hidden() == 0
+        assert v.get_point(1, 1, 1) is None
+        assert v.get_point(-10 ** 6, 0, 0) is cube.newtexcube(tex=3)
+
+        # Unless there are too many of them
+        for i in range(130):
+            v.set_point(32 * i, 32 * i, 32 * i, cube.newtexcube(tex=3))
+        with pytest.raises(ValueError):
+            v.cull_hidden()